@@ -0,0 +1,105 @@
+"""
+Порівняння розкладки колажу: стара (до 500 випадкових спроб на фото з перевіркою
+перекриттів) проти plan_collage_layout із collage_layout.py.
+
+Рахуються лише габарити, без рендеру, тож міряється саме алгоритм розміщення.
+Обидві розкладки оцінюються однаково: фото вважається розміщеним, якщо воно
+в межах полотна й не перетинається з жодним іншим (поріг перекриття 0).
+Запуск (сервер і сховище не потрібні):
+
+    python bench_collage_layout.py --trials 200 --counts 2 3 4 5 8 12
+"""
+import argparse
+import random
+import statistics
+import time
+
+from collage_layout import PHOTO_SIZES_BY_COUNT, COLLAGE_MARGIN, COLLAGE_MAX_ANGLE, plan_collage_layout, rotated_box
+
+CANVAS = (1080, 1920)
+ASPECTS = [(4, 3), (3, 4), (16, 9), (9, 16), (1, 1)]
+
+
+def check_overlap(box1, box2, max_overlap_ratio=0.15):
+    inter_left, inter_top = max(box1[0], box2[0]), max(box1[1], box2[1])
+    inter_right, inter_bottom = min(box1[2], box2[2]), min(box1[3], box2[3])
+    if inter_right > inter_left and inter_bottom > inter_top:
+        inter_area = (inter_right - inter_left) * (inter_bottom - inter_top)
+        box1_area = (box1[2] - box1[0]) * (box1[3] - box1[1])
+        if box1_area > 0 and inter_area / box1_area > max_overlap_ratio: return True
+    return False
+
+
+def photo_sizes(count: int, rng: random.Random) -> list:
+    """Розміри фото після thumbnail((target, target)), як у create_collage_and_save."""
+    target = PHOTO_SIZES_BY_COUNT.get(count, 600)
+    sizes = []
+    for _ in range(count):
+        aw, ah = rng.choice(ASPECTS)
+        scale = target / max(aw, ah)
+        sizes.append((int(aw * scale), int(ah * scale)))
+    return sizes
+
+
+def count_placed(boxes: list) -> int:
+    """Фото в межах полотна, що не перетинаються з жодним іншим."""
+    placed = 0
+    for i, box in enumerate(boxes):
+        inside = box[0] >= 0 and box[1] >= 0 and box[2] <= CANVAS[0] and box[3] <= CANVAS[1]
+        if inside and not any(check_overlap(box, other, 0.0) for j, other in enumerate(boxes) if j != i): placed += 1
+    return placed
+
+
+def legacy_layout(sizes: list, rng: random.Random) -> list:
+    """Колишній алгоритм (сам допускав до 15% перекриття): повертає рамки розміщених фото."""
+    placed_boxes = []
+    for w, h in sizes:
+        bw, bh = rotated_box(int(w), int(h), rng.randint(-COLLAGE_MAX_ANGLE, COLLAGE_MAX_ANGLE))
+        if CANVAS[0] - bw - COLLAGE_MARGIN < COLLAGE_MARGIN or CANVAS[1] - bh - COLLAGE_MARGIN < COLLAGE_MARGIN: continue
+        for _ in range(500):
+            x = rng.randint(COLLAGE_MARGIN, CANVAS[0] - bw - COLLAGE_MARGIN)
+            y = rng.randint(COLLAGE_MARGIN, CANVAS[1] - bh - COLLAGE_MARGIN)
+            new_box = (x, y, x + bw, y + bh)
+            if not any(check_overlap(new_box, box) for box in placed_boxes):
+                placed_boxes.append(new_box)
+                break
+    return placed_boxes
+
+
+def new_layout(sizes: list, seed: int) -> list:
+    boxes = []
+    for x, y, w, h, angle in plan_collage_layout(sizes, CANVAS, seed=seed):
+        bw, bh = rotated_box(w, h, angle)
+        boxes.append((x, y, x + bw, y + bh))
+    return boxes
+
+
+def bench(count: int, trials: int) -> dict:
+    rng = random.Random(count)
+    results = {"legacy": ([], 0), "grid": ([], 0)}
+    for trial in range(trials):
+        sizes = photo_sizes(count, rng)
+        for name, run in (("legacy", lambda: legacy_layout(sizes, random.Random(trial))), ("grid", lambda: new_layout(sizes, trial))):
+            started = time.perf_counter()
+            placed = count_placed(run())
+            times, total_placed = results[name]
+            times.append((time.perf_counter() - started) * 1000)
+            results[name] = (times, total_placed + placed)
+    return {name: (statistics.mean(times), total_placed / (count * trials)) for name, (times, total_placed) in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=200)
+    parser.add_argument("--counts", type=int, nargs="+", default=[2, 3, 4, 5, 8, 12])
+    args = parser.parse_args()
+
+    print(f"{'фото':>5} | {'стара, мс':>10} {'розміщено':>10} | {'сітка, мс':>10} {'розміщено':>10}")
+    for count in args.counts:
+        result = bench(count, args.trials)
+        (legacy_ms, legacy_rate), (grid_ms, grid_rate) = result["legacy"], result["grid"]
+        print(f"{count:>5} | {legacy_ms:>10.3f} {legacy_rate:>9.1%} | {grid_ms:>10.3f} {grid_rate:>9.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Розкладка колажу: лише геометрія, без PIL, FastAPI і сховища — модуль можна
+імпортувати з бенчмарків і тестів, не піднімаючи сервер.
+"""
+import math
+import random
+from typing import Optional
+
+COLLAGE_MARGIN = 30
+COLLAGE_MAX_ANGLE = 20
+PHOTO_SIZES_BY_COUNT = {2: 800, 3: 650, 4: 550, 5: 480}
+COLLAGE_PASTE_SLACK = 2  # Image.rotate(expand=True) і рамка можуть дати на 1-2 px більше за геометричні габарити
+
+
+def rotated_size(width: float, height: float, angle: float) -> tuple:
+    """Габарити прямокутника width x height після повороту на angle градусів."""
+    rad = math.radians(angle)
+    cos, sin = abs(math.cos(rad)), abs(math.sin(rad))
+    return width * cos + height * sin, width * sin + height * cos
+
+
+def rotated_box(width: int, height: int, angle: float) -> tuple:
+    """Цілі габарити в пікселях, які займе повернуте фото на полотні (із запасом COLLAGE_PASTE_SLACK)."""
+    bw, bh = rotated_size(width, height, angle)
+    return math.ceil(bw) + COLLAGE_PASTE_SLACK, math.ceil(bh) + COLLAGE_PASTE_SLACK
+
+
+def plan_collage_layout(sizes: list, canvas: tuple, seed=None, max_side: Optional[int] = None,
+                        margin: int = COLLAGE_MARGIN, max_angle: float = COLLAGE_MAX_ANGLE) -> list:
+    """
+    Розміщує фото (sizes — [(w, h), ...]) без перекриттів за один прохід: полотно
+    ділиться на сітку з пропорціями, найвигіднішими для такої кількості фото;
+    межі клітинок — цілі пікселі, тож клітинки не перетинаються. Кожне фото з
+    урахуванням повороту (rotated_box) вписується у свою клітинку й зсувається
+    в ній випадково. Той самий seed дає ту саму розкладку.
+    Повертає [(x, y, w, h, angle), ...]: (x, y) — лівий верхній кут повернутого
+    зображення, (w, h) — розмір фото до повороту.
+    """
+    n = len(sizes)
+    if not n: return []
+    rng = random.Random(seed)
+    width, height = canvas[0] - 2 * margin, canvas[1] - 2 * margin
+    max_side = max_side or PHOTO_SIZES_BY_COUNT.get(n, 600)
+    angles = [rng.uniform(-max_angle, max_angle) for _ in range(n)]
+
+    def scales_for(rows):
+        cols = math.ceil(n / rows)
+        # Найвужча клітинка після округлення меж мінус запас на округлення розмірів фото
+        fit_w, fit_h = width // cols - COLLAGE_PASTE_SLACK - 1, height // rows - COLLAGE_PASTE_SLACK - 1
+        scales = []
+        for (w, h), angle in zip(sizes, angles):
+            bw, bh = rotated_size(w, h, angle)
+            scales.append(max(0.0, min(max_side / max(w, h), fit_w / bw, fit_h / bh)))
+        return scales
+
+    # Обираємо кількість рядків, за якої найменше фото буде найбільшим
+    rows = max(range(1, n + 1), key=lambda r: (min(scales_for(r)), -r))
+    cols = math.ceil(n / rows)
+    scales = scales_for(rows)
+    col_edges = [margin + (c * width) // cols for c in range(cols + 1)]
+    row_edges = [margin + (r * height) // rows for r in range(rows + 1)]
+    order = list(range(n))
+    rng.shuffle(order)  # яке фото в якій клітинці
+    placements = [None] * n
+    for slot, index in enumerate(order):
+        row, col = divmod(slot, cols)
+        in_row = min(cols, n - row * cols)
+        row_offset = (cols - in_row) * (width // cols) // 2  # неповний останній рядок — по центру
+        x0, x1 = col_edges[col] + row_offset, col_edges[col + 1] + row_offset
+        y0, y1 = row_edges[row], row_edges[row + 1]
+        w, h = sizes[index]
+        pw, ph = max(1, int(w * scales[index])), max(1, int(h * scales[index]))
+        bw, bh = rotated_box(pw, ph, angles[index])
+        # Страховка від накопичення округлень: фото ніколи не виходить за свою клітинку
+        while (bw > x1 - x0 or bh > y1 - y0) and max(pw, ph) > 1:
+            pw, ph = max(1, pw - 1), max(1, ph - 1)
+            bw, bh = rotated_box(pw, ph, angles[index])
+        x = x0 + rng.randint(0, max(0, x1 - x0 - bw))
+        y = y0 + rng.randint(0, max(0, y1 - y0 - bh))
+        placements[index] = (x, y, pw, ph, angles[index])
+    return placements
@@ -1,6 +1,8 @@
 # server.py - Фінальна версія з отриманням ОРИГІНАЛЬНОЇ дати
 import asyncio
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError, FileReferenceExpiredError, FileReferenceInvalidError, MediaEmptyError
+from telethon.tl.types import InputPhoto, InputDocument, InputMediaUploadedDocument, DocumentAttributeVideo, DocumentAttributeFilename
 from pydantic import BaseModel
 from typing import List
 import os
@@ -9,21 +11,52 @@ import json
 import time
 import random
 import threading
+import bisect
 import uuid
+import queue
+import sqlite3
 import io
+import mimetypes
+import hashlib
+import base64
+import re
+import zlib
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
 from typing import List, Optional
 import traceback
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import List, Optional, Union
 from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Form, Body, Query
-from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
-from PIL import Image, ImageDraw, ImageFont
+from fastapi import Request
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, Response
+from starlette.requests import ClientDisconnect
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 import ffmpeg
 from hachoir.parser import createParser
 from hachoir.metadata import extractMetadata
+import numpy as np
 import requests
+import requests.adapters
 from gradio_client import Client as GradioClient, file as gradio_file
 from dotenv import load_dotenv
+from collage_layout import PHOTO_SIZES_BY_COUNT, plan_collage_layout
+
+try:
+    # HEIC/HEIF: реєструємо при імпорті, щоб Image.open працював і в процесах пулу прев'ю
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    print("⚠️ pillow-heif не встановлено — HEIC/HEIF файли не відкриватимуться")
+
+try:
+    # Необов'язково: без watchdog стежимо за originals опитуванням
+    from watchdog.observers import Observer as WatchdogObserver
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    WatchdogObserver = None
+    FileSystemEventHandler = object
 
 try:
     # Новий спосіб (Pillow >= 9.1.0)
@@ -42,20 +75,22 @@ app = FastAPI(title="My Personal Cloud API")
 # --- Шляхи ---
 # Використовуємо абсолютні шляхи для надійності
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-STORAGE_PATH = os.path.join(SCRIPT_DIR, "/mnt/storage")
+STORAGE_PATH = os.getenv("STORAGE_PATH", "/mnt/storage")
 ASSETS_FOLDER = os.path.join(SCRIPT_DIR, "assets")
 
 ORIGINALS_PATH = os.path.join(STORAGE_PATH, "originals")
 THUMBNAILS_PATH = os.path.join(STORAGE_PATH, "thumbnails")
 MEMORIES_PATH = os.path.join(STORAGE_PATH, "memories")
 MUSIC_FOLDER = os.path.join(STORAGE_PATH, "music")
+INCOMING_PATH = os.path.join(STORAGE_PATH, "incoming")  # Недокачані файли (той самий диск, що й originals)
+RESIZED_CACHE_PATH = os.path.join(STORAGE_PATH, "cache", "resized")
 
 METADATA_FILE = os.path.join(STORAGE_PATH, "metadata.json")
 SETTINGS_FILE = os.path.join(STORAGE_PATH, "settings.json")
 FRAMES_CONFIG_FILE = os.path.join(ASSETS_FOLDER, "frames_config.json")
 FONT_FILE = os.path.join(ASSETS_FOLDER, "Roboto-Regular.ttf")
 
-for path in [ORIGINALS_PATH, THUMBNAILS_PATH, MEMORIES_PATH, MUSIC_FOLDER, ASSETS_FOLDER]:
+for path in [ORIGINALS_PATH, THUMBNAILS_PATH, MEMORIES_PATH, MUSIC_FOLDER, ASSETS_FOLDER, INCOMING_PATH, RESIZED_CACHE_PATH]:
     os.makedirs(path, exist_ok=True)
 
 
@@ -68,7 +103,7 @@ SESSION_NAME = 'my_server_session' # Назва файлу сесії, який
 
 # Створюємо екземпляр клієнта.
 # Підключення буде виконано при старті сервера.
-client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
+client = TelegramClient(SESSION_NAME, api_id, api_hash)
 
 # Модель для даних, які буде надсилати твій Android-клієнт
 # Новий правильний варіант
@@ -89,113 +124,2328 @@ async def shutdown_event():
     print("🔌 Відключаємось від Telegram...")
     await client.disconnect()
 # --- Налаштування AI ---
-HF_SPACE_CAPTION_URL = "bodyapromax2010/bodyasync-image-caption"
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
-OLLAMA_MODEL_NAME = "qwen3:4b"
-HF_SPACE_COLLAGE_URL = "bodyapromax2010/black-forest-labs-FLUX.1-dev2"
+# Адреси можна перевизначити в .env (напр. на локальні заглушки для тестів)
+HF_SPACE_CAPTION_URL = os.getenv("HF_SPACE_CAPTION_URL", "bodyapromax2010/bodyasync-image-caption")
+OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/generate")
+OLLAMA_MODEL_NAME = os.getenv("OLLAMA_MODEL_NAME", "qwen3:4b")
+HF_SPACE_COLLAGE_URL = os.getenv("HF_SPACE_COLLAGE_URL", "bodyapromax2010/black-forest-labs-FLUX.1-dev2")
 
-# --- Словник для відстеження асинхронних задач ---
-TASKS = {}
 try:
     FONT = ImageFont.truetype(FONT_FILE, 30)
 except IOError:
     FONT = ImageFont.load_default()
 
-# --- Функції для роботи з метаданими (без змін) ---
-# ... (load_metadata, save_metadata) ...
+# ======================================================================
+# БЛОК 2: СХОВИЩЕ МЕТАДАНИХ (SQLite у режимі WAL + копія в RAM)
+# ======================================================================
+LIBRARY_DB_FILE = os.path.join(STORAGE_PATH, "library.db")
+
+class MetadataStore:
+    """
+    Метадані галереї, які постійно живуть у пам'яті.
+    Кожна зміна пишеться в SQLite окремим рядком в одній транзакції,
+    тому запис одного файлу не переписує всю бібліотеку, а паралельні
+    завантаження не затирають записи одне одного.
+
+    У тій самій транзакції ведеться журнал змін (таблиця changes) з
+    монотонною версією — з нього /sync/changes віддає клієнту лише різницю.
+    Для кожного файлу зберігається тільки остання зміна, тож журнал не
+    росте більше за бібліотеку плюс "надгробки" видалених файлів.
+    """
+    def __init__(self, db_path: str, legacy_json_path: Optional[str] = None):
+        self._lock = threading.RLock()
+        self._items = {}
+        self._listeners = []
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS media (filename TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS changes (version INTEGER PRIMARY KEY, filename TEXT NOT NULL, op TEXT NOT NULL, changed REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS changes_filename ON changes (filename)")
+        for filename, data in self._db.execute("SELECT filename, data FROM media"):
+            self._items[filename] = json.loads(data)
+        last_logged = self._db.execute("SELECT MAX(version) FROM changes").fetchone()[0] or 0
+        self.version = max(last_logged, int(self.get_kv("changes_floor") or 0))
+        if not last_logged and self._items and self.get_kv("changes_floor") is None:
+            # База з часів до журналу: усі наявні записи стають першими змінами
+            with self._db: self._log_changes([(filename, "upsert") for filename in self._items])
+        if legacy_json_path and self.get_kv("legacy_json_imported") is None:
+            self._import_legacy_json(legacy_json_path)
+        print(f"🗂️ Метадані завантажено: {len(self._items)} записів")
+
+    def _import_legacy_json(self, json_path: str):
+        """Одноразовий імпорт старого metadata.json (сам файл не змінюється)."""
+        legacy = {}
+        if os.path.exists(json_path):
+            try:
+                with open(json_path, 'r', encoding='utf-8') as f: legacy = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"⚠️ Не вдалося прочитати {json_path}: {e}")
+        new_entries = {k: v for k, v in legacy.items() if k not in self._items}
+        self.put_many(new_entries)
+        self.set_kv("legacy_json_imported", str(time.time()))
+        if new_entries: print(f"📥 Імпортовано {len(new_entries)} записів з {os.path.basename(json_path)}")
+
+    # --- Читання (тільки з RAM) ---
+    def get(self, filename: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._items.get(filename)
+            return dict(entry) if entry is not None else None
+
+    def snapshot(self) -> dict:
+        with self._lock: return {k: dict(v) for k, v in self._items.items()}
+
+    def keys(self) -> list:
+        with self._lock: return list(self._items.keys())
+
+    def __contains__(self, filename) -> bool:
+        return filename in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    # --- Запис (SQLite-транзакція, потім RAM) ---
+    def put(self, filename: str, entry: dict):
+        self.put_many({filename: entry})
+
+    def put_many(self, entries: dict):
+        with self._lock:
+            # Запис без жодної зміни не чіпає ні диск, ні журнал синхронізації
+            entries = {k: v for k, v in entries.items() if self._items.get(k) != v}
+            if not entries: return
+            rows = [(k, json.dumps(v, ensure_ascii=False)) for k, v in entries.items()]
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO media (filename, data) VALUES (?, ?)", rows)
+                self._log_changes([(filename, "upsert") for filename in entries])
+            for filename, entry in entries.items():
+                old = self._items.get(filename)
+                self._items[filename] = dict(entry)
+                self._notify(filename, old, self._items[filename])
+
+    def update(self, filename: str, **fields) -> Optional[dict]:
+        """Оновлює окремі поля існуючого запису. Повертає новий запис або None."""
+        with self._lock:
+            if filename not in self._items: return None
+            entry = {**self._items[filename], **fields}
+            self.put(filename, entry)
+            return dict(entry)
+
+    def delete(self, filename: str) -> bool:
+        with self._lock:
+            if filename not in self._items: return False
+            with self._db:
+                self._db.execute("DELETE FROM media WHERE filename = ?", (filename,))
+                self._log_changes([(filename, "delete")])
+            old = self._items.pop(filename)
+            self._notify(filename, old, None)
+            return True
+
+    # --- Журнал змін для синхронізації клієнтів ---
+    def _log_changes(self, changes: list):
+        """Викликається під self._lock всередині транзакції. Попередні зміни тих самих файлів стають зайвими."""
+        now = time.time()
+        rows = []
+        for filename, op in changes:
+            self.version += 1
+            rows.append((self.version, filename, op, now))
+        self._db.executemany("DELETE FROM changes WHERE filename = ?", [(filename,) for filename, _ in changes])
+        self._db.executemany("INSERT INTO changes (version, filename, op, changed) VALUES (?, ?, ?, ?)", rows)
+
+    def changes_since(self, since: int, limit: int) -> tuple:
+        """Зміни з версією > since у порядку версій. Повертає ([(version, filename, op)], has_more)."""
+        with self._lock:
+            rows = self._db.execute("SELECT version, filename, op FROM changes WHERE version > ? ORDER BY version LIMIT ?", (since, limit + 1)).fetchall()
+        return rows[:limit], len(rows) > limit
+
+    def changes_floor(self) -> int:
+        """Версії, не більші за цю, могли втратити надгробки — клієнтам з таким курсором потрібен повний знімок."""
+        return int(self.get_kv("changes_floor") or 0)
+
+    def compact_changes(self, max_tombstone_age: float) -> int:
+        """Прибирає старі надгробки видалених файлів і піднімає поріг актуальних курсорів."""
+        cutoff = time.time() - max_tombstone_age
+        with self._lock, self._db:
+            newest = self._db.execute("SELECT MAX(version) FROM changes WHERE op = 'delete' AND changed < ?", (cutoff,)).fetchone()[0]
+            if not newest: return 0
+            removed = self._db.execute("DELETE FROM changes WHERE op = 'delete' AND version <= ?", (newest,)).rowcount
+            self._db.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", ("changes_floor", str(max(newest, self.changes_floor()))))
+        return removed
+
+    # --- Підписки на зміни (індекси, кеші) ---
+    def subscribe(self, callback):
+        """callback(filename, old_entry, new_entry) викликається після кожної зміни; new_entry=None при видаленні."""
+        with self._lock:
+            self._listeners.append(callback)
+            for filename, entry in self._items.items(): callback(filename, None, entry)
+
+    def _notify(self, filename, old, new):
+        for callback in self._listeners:
+            try: callback(filename, old, new)
+            except Exception as e: print(f"⚠️ Помилка обробника метаданих: {e}")
+
+    # --- Дрібні службові значення ---
+    def get_kv(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_kv(self, key: str, value: str):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, value))
+
+METADATA = MetadataStore(LIBRARY_DB_FILE, legacy_json_path=METADATA_FILE)
+
 def load_metadata():
-    if not os.path.exists(METADATA_FILE): return {}
-    try:
-        with open(METADATA_FILE, 'r', encoding='utf-8') as f: return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError): return {}
+    """Сумісність зі старим кодом: знімок метаданих з RAM (без читання диска)."""
+    return METADATA.snapshot()
+
+
+class GalleryIndex:
+    """
+    Індекс галереї, відсортований за timestamp (новіші першими).
+    Оновлюється інкрементально з підписки на METADATA, тому сторінка
+    віддається зрізом готового списку без сортування всієї бібліотеки.
+    Ключ сортування: (-timestamp, filename).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []
+        self._keys_by_type = {}
+        self._known = {}  # filename -> (key, type)
+
+    def on_change(self, filename, old, new):
+        with self._lock:
+            self._remove(filename)
+            # Віддаємо тільки ті записи, де є timestamp
+            if new and new.get("timestamp"):
+                key = (-float(new["timestamp"]), filename)
+                bisect.insort(self._keys, key)
+                bisect.insort(self._keys_by_type.setdefault(new.get("type"), []), key)
+                self._known[filename] = (key, new.get("type"))
+
+    def _remove(self, filename):
+        known = self._known.pop(filename, None)
+        if not known: return
+        key, file_type = known
+        for keys in (self._keys, self._keys_by_type.get(file_type, [])):
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key: del keys[i]
+
+    def page(self, after=None, limit=None, file_type=None, date_from=None, date_to=None):
+        """Повертає (список імен файлів, чи є ще записи). after — ключ останнього елемента попередньої сторінки."""
+        with self._lock:
+            keys = self._keys if file_type is None else self._keys_by_type.get(file_type, [])
+            start = bisect.bisect_right(keys, after) if after is not None else 0
+            if date_to is not None: start = max(start, bisect.bisect_left(keys, (-float(date_to), "")))
+            end = len(keys)
+            if date_from is not None: end = bisect.bisect_right(keys, (-float(date_from), "\U0010ffff"))
+            stop = end if limit is None else min(end, start + limit)
+            return [name for _, name in keys[start:stop]], stop < end
+
+    @staticmethod
+    def encode_cursor(filename: str, timestamp: float) -> str:
+        return f"{float(timestamp)!r}|{filename}"
 
-def save_metadata(data):
-    with open(METADATA_FILE, 'w', encoding='utf-8') as f: json.dump(data, f, indent=4, ensure_ascii=False)
+    @staticmethod
+    def decode_cursor(cursor: str):
+        timestamp, sep, filename = cursor.partition("|")
+        if not sep: raise ValueError("bad cursor")
+        return (-float(timestamp), filename)
 
+GALLERY_INDEX = GalleryIndex()
+METADATA.subscribe(GALLERY_INDEX.on_change)
 
-# --- Функції для створення прев'ю (без змін) ---
-# ... (create_photo_thumbnail, create_video_thumbnail) ...
-def create_photo_thumbnail(image_path: str, thumbnail_path: str):
+
+# --- Функції для створення прев'ю ---
+# Кожне фото дає кілька варіантів (renditions) з ОДНОГО зменшеного декодування:
+#   grid   — сітка галереї (preview_size),
+#   detail — перегляд на весь екран (detail_size),
+#   blur   — крихітна заглушка, поки вантажиться grid.
+# Основне прев'ю (поле "thumbnail") — це grid; решта мають суфікс: "фото.detail.webp".
+BLUR_RENDITION_SIZE = 32
+
+def thumbnail_renditions(settings: dict) -> dict:
+    """rendition -> (максимальна сторона, якість)."""
+    return {
+        "grid": (settings.get("preview_size", 400), settings.get("preview_quality", 80)),
+        "detail": (settings.get("detail_size", 1080), settings.get("detail_quality", 80)),
+        "blur": (BLUR_RENDITION_SIZE, 40),
+    }
+
+def rendition_filename(thumbnail_filename: str, rendition: str) -> str:
+    if rendition == "grid": return thumbnail_filename
+    stem, ext = os.path.splitext(thumbnail_filename)
+    return f"{stem}.{rendition}{ext}"
+
+def open_image_reduced(image_path: str, max_side: int) -> Image.Image:
+    """
+    Відкриває фото, декодуючи якомога менше пікселів: JPEG — через draft()
+    (масштабування DCT 1/2..1/8 прямо при декодуванні). Інші формати (HEIC теж)
+    декодуються повністю, а reduce() лише здешевлює подальший LANCZOS.
+    Повертає RGB-зображення, повернуте згідно з EXIF.
+    """
+    with Image.open(image_path) as source:
+        if source.format == "JPEG":
+            source.draft("RGB", (max_side, max_side))
+        source.load()
+        steps = [source]
+        factor = max(source.width, source.height) // (max_side * 2) if max_side else 0  # запас 2x для якісного LANCZOS
+        if factor >= 2: steps.append(steps[-1].reduce(factor))
+        steps.append(ImageOps.exif_transpose(steps[-1]))
+        if steps[-1].mode != "RGB": steps.append(steps[-1].convert("RGB"))
+        img = steps[-1] if steps[-1] is not source else source.copy()
+        # Проміжні копії закриваємо одразу, джерело (і файл) — через with
+        for step in steps[1:]:
+            if step is not img: step.close()
+    return img
+
+def save_renditions(img: Image.Image, thumbnail_path: str, settings: dict) -> dict:
+    """Зберігає всі розміри, зменшуючи кожен наступний з попереднього. Повертає {rendition: ім'я файлу}."""
+    image_format = "WEBP" if settings.get("thumbnail_format", "webp") == "webp" else "JPEG"
+    thumbnail_filename = os.path.basename(thumbnail_path)
+    files = {}
+    current = img
+    for name, (size, quality) in sorted(thumbnail_renditions(settings).items(), key=lambda kv: -kv[1][0]):
+        current = current.copy()
+        current.thumbnail((size, size), LANCZOS_FILTER)
+        filename = rendition_filename(thumbnail_filename, name)
+        if image_format == "WEBP": current.save(os.path.join(THUMBNAILS_PATH, filename), "WEBP", quality=quality, method=4)
+        else: current.save(os.path.join(THUMBNAILS_PATH, filename), "JPEG", quality=quality, optimize=True)
+        files[name] = filename
+    return files
+
+def create_photo_thumbnail(image_path: str, thumbnail_path: str, settings: Optional[dict] = None):
+    """Повертає {rendition: ім'я файлу} або False."""
     try:
-        settings = load_settings()
-        size = (settings.get("preview_size", 400), settings.get("preview_size", 400))
-        quality = settings.get("preview_quality", 80)
-        with Image.open(image_path) as img:
-            if img.format and img.format.upper() in ['HEIC', 'HEIF']:
-                from pillow_heif import register_heif_opener
-                register_heif_opener()
-                img = Image.open(image_path)
-            if img.mode in ("RGBA", "P"): img = img.convert("RGB")
-            img.thumbnail(size)
-            img.save(thumbnail_path, "JPEG", quality=quality, optimize=True)
-        return True
+        settings = settings or load_settings()
+        largest = max(size for size, _ in thumbnail_renditions(settings).values())
+        with open_image_reduced(image_path, largest) as img:
+            return save_renditions(img, thumbnail_path, settings)
     except Exception as e:
         print(f"❌ Помилка фото-прев'ю для {os.path.basename(image_path)}: {e}")
         return False
 
-def create_video_thumbnail(video_path: str, thumbnail_path: str):
+def create_video_thumbnail(video_path: str, thumbnail_path: str, settings: Optional[dict] = None):
+    """Кадр з 1-ї секунди (одразу зменшений FFmpeg) → ті самі renditions, що й для фото."""
     try:
-        settings = load_settings()
-        size = settings.get("preview_size", 400)
-        (ffmpeg.input(video_path, ss=1).filter('scale', size, -1).output(thumbnail_path, vframes=1).overwrite_output().run(capture_stdout=True, capture_stderr=True))
-        return True
+        settings = settings or load_settings()
+        largest = max(size for size, _ in thumbnail_renditions(settings).values())
+        frame, _ = (ffmpeg.input(video_path, ss=1).filter('scale', largest, -1)
+                    .output('pipe:', vframes=1, format='image2', vcodec='mjpeg')
+                    .run(capture_stdout=True, capture_stderr=True))
+        with Image.open(io.BytesIO(frame)) as img:
+            return save_renditions(img.convert("RGB"), thumbnail_path, settings)
     except ffmpeg.Error as e:
         print(f"❌ Помилка FFmpeg для {os.path.basename(video_path)}: {e.stderr.decode()}")
         return False
+    except Exception as e:
+        print(f"❌ Помилка відео-прев'ю для {os.path.basename(video_path)}: {e}")
+        return False
+
+
+# --- Палітра: кілька домінантних кольорів, рахується з прев'ю (не з оригіналу) ---
+PALETTE_SIZE = 5
+PALETTE_SAMPLE_SIDE = 64
+PALETTE_MERGE_DISTANCE = 48  # сума |ΔR|+|ΔG|+|ΔB|, нижче якої два кольори вважаються одним
+
+def extract_palette(img: Image.Image, k: int = PALETTE_SIZE) -> list:
+    """
+    k-means у RGB на зменшеному до 64 px зображенні, повністю векторизовано numpy.
+    Центри стартують з найчисельніших клітинок гістограми 16x16x16, тож результат
+    детермінований. Повертає '#rrggbb' за спаданням частки пікселів.
+    """
+    sample = img.convert("RGB")
+    sample.thumbnail((PALETTE_SAMPLE_SIDE, PALETTE_SAMPLE_SIDE), BICUBIC_FILTER)
+    pixels = np.asarray(sample, dtype=np.float32).reshape(-1, 3)
+    cells = pixels.astype(np.int32) >> 4
+    histogram = np.bincount(cells[:, 0] * 256 + cells[:, 1] * 16 + cells[:, 2], minlength=4096)
+    top = np.argsort(histogram)[::-1][:k]
+    top = top[histogram[top] > 0]
+    centers = np.stack([(top >> 8) & 15, (top >> 4) & 15, top & 15], axis=1).astype(np.float32) * 16 + 8
+    for _ in range(10):
+        labels = ((pixels[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        counts = np.bincount(labels, minlength=len(centers))
+        sums = np.stack([np.bincount(labels, weights=pixels[:, c], minlength=len(centers)) for c in range(3)], axis=1)
+        moved = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        converged = np.abs(moved - centers).max() < 0.5
+        centers = moved
+        if converged: break
+    # Близькі кластери (межа між двома відтінками одного кольору) зливаються в більший
+    kept = []
+    for i in np.argsort(counts)[::-1]:
+        if counts[i] and all(np.abs(centers[i] - centers[j]).sum() > PALETTE_MERGE_DISTANCE for j in kept): kept.append(i)
+    return ["#%02x%02x%02x" % tuple(int(round(v)) for v in centers[i]) for i in kept]
+
+def extract_palette_from_file(path: str) -> Optional[list]:
+    try:
+        with Image.open(path) as img:
+            return extract_palette(img)
+    except Exception:
+        return None
+
+def extract_palette_batch(paths: list) -> list:
+    """Виконується в процесі пулу: палітри для кількох прев'ю за одне завдання."""
+    return [extract_palette_from_file(path) for path in paths]
+
+
+# --- Перцептивний хеш (dHash): схожі кадри серій, "PORTRAIT"/"COVER"-варіанти одного знімка ---
+DHASH_SIDE = 8  # 8x8 порівнянь сусідніх пікселів = 64 біти
+
+def compute_dhash(img: Image.Image) -> str:
+    """
+    dHash: сіре зображення 9x8, біт = "правий сусід яскравіший за піксель" (1 — яскравість зростає вправо).
+    Стійкий до масштабу, стиснення й дрібних правок. Повертає 16 hex-символів.
+    """
+    small = np.asarray(img.convert("L").resize((DHASH_SIDE + 1, DHASH_SIDE), BICUBIC_FILTER), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return np.packbits(bits).tobytes().hex()
+
+def compute_dhash_from_file(path: str) -> Optional[str]:
+    try:
+        with Image.open(path) as img:
+            return compute_dhash(img)
+    except Exception:
+        return None
+
+def compute_dhash_batch(paths: list) -> list:
+    """Виконується в процесі пулу: dHash для кількох прев'ю за одне завдання."""
+    return [compute_dhash_from_file(path) for path in paths]
+
+if hasattr(np, "bitwise_count"):
+    def popcount64(values: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(values)
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    def popcount64(values: np.ndarray) -> np.ndarray:
+        return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+class PerceptualIndex:
+    """
+    dHash усіх записів у суцільному масиві uint64 (~8 байт на фото). Пошук — один
+    векторизований XOR + popcount по всьому масиву, тож 100k фото проглядаються
+    за кілька мілісекунд. Оновлюється з підписки на METADATA; видалення — перенесенням
+    останнього елемента на місце видаленого.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._codes = np.zeros(1024, dtype=np.uint64)
+        self._keys = []
+        self._slots = {}  # filename -> індекс у _codes
+        self.version = 0
+        self._clusters = {}  # max_distance -> (version, clusters)
+
+    def on_change(self, filename: str, old: Optional[dict], new: Optional[dict]):
+        code = (new or {}).get("dhash")
+        if code == (old or {}).get("dhash") and new is not None and (filename in self._slots) == bool(code): return
+        with self._lock:
+            self._remove(filename)
+            if code:
+                if len(self._keys) == len(self._codes):
+                    self._codes = np.concatenate([self._codes, np.zeros(len(self._codes), dtype=np.uint64)])
+                self._codes[len(self._keys)] = int(code, 16)
+                self._slots[filename] = len(self._keys)
+                self._keys.append(filename)
+            self.version += 1
+
+    def _remove(self, filename: str):
+        slot = self._slots.pop(filename, None)
+        if slot is None: return
+        last = len(self._keys) - 1
+        if slot != last:
+            moved = self._keys[last]
+            self._keys[slot], self._codes[slot] = moved, self._codes[last]
+            self._slots[moved] = slot
+        self._keys.pop()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def distance(self, a: str, b: str) -> Optional[int]:
+        with self._lock:
+            if a not in self._slots or b not in self._slots: return None
+            return int(popcount64(self._codes[[self._slots[a]]] ^ self._codes[[self._slots[b]]])[0])
+
+    def similar(self, filename: str, max_distance: int, limit: Optional[int] = None) -> Optional[list]:
+        """[(filename, distance)] за зростанням відстані, без самого файлу. None — хешу ще немає."""
+        with self._lock:
+            slot = self._slots.get(filename)
+            if slot is None: return None
+            distances = popcount64(self._codes[:len(self._keys)] ^ self._codes[slot])
+            hits = np.flatnonzero(distances <= max_distance)
+            hits = hits[hits != slot]
+            hits = hits[np.lexsort((hits, distances[hits]))][:limit]
+            return [(self._keys[i], int(distances[i])) for i in hits]
+
+    def near_any(self, filename: str, others: list, max_distance: int) -> bool:
+        """Чи схожий filename хоча б на один з others (відстань <= max_distance)."""
+        with self._lock:
+            slot = self._slots.get(filename)
+            slots = [self._slots[o] for o in others if o in self._slots]
+            if slot is None or not slots: return False
+            return bool((popcount64(self._codes[slots] ^ self._codes[slot]) <= max_distance).any())
+
+    def clusters(self, max_distance: int) -> list:
+        """
+        Групи майже однакових кадрів (зв'язні компоненти графа "відстань <= max_distance"),
+        найбільші першими. 64 біти діляться на max_distance+1 смуг: за принципом Діріхле пара
+        з такою відстанню збігається хоча б в одній смузі, тож порівнюються лише сусіди
+        у відсортованому за смугою масиві. Результат кешується до наступної зміни індексу.
+        """
+        with self._lock:
+            cached = self._clusters.get(max_distance)
+            if cached and cached[0] == self.version: return cached[1]
+            version, keys, codes = self.version, list(self._keys), self._codes[:len(self._keys)].copy()
+        parent = list(range(len(keys)))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        bands = max_distance + 1
+        edges = [0] + [64 * (b + 1) // bands for b in range(bands)]
+        for start, stop in zip(edges, edges[1:]):
+            band = (codes >> np.uint64(start)) & np.uint64((1 << (stop - start)) - 1)
+            order = np.argsort(band, kind="stable")
+            band, sorted_codes = band[order], codes[order]
+            active, offset = np.arange(len(order) - 1), 1
+            while len(active):
+                active = active[active + offset < len(order)]
+                active = active[band[active] == band[active + offset]]
+                near = active[popcount64(sorted_codes[active] ^ sorted_codes[active + offset]) <= max_distance]
+                for i, j in zip(order[near].tolist(), order[near + offset].tolist()):
+                    root_i, root_j = find(i), find(j)
+                    if root_i != root_j: parent[root_i] = root_j
+                offset += 1
+        groups = {}
+        for i in range(len(keys)): groups.setdefault(find(i), []).append(keys[i])
+        clusters = sorted((sorted(group) for group in groups.values() if len(group) > 1), key=lambda group: (-len(group), group[0]))
+        with self._lock: self._clusters[max_distance] = (version, clusters)
+        return clusters
+
+PHASH_INDEX = PerceptualIndex()
+METADATA.subscribe(PHASH_INDEX.on_change)
+
+
+# ======================================================================
+# БЛОК 3: ФОНОВІ ЗАДАЧІ ТА ПАРАЛЕЛЬНА ГЕНЕРАЦІЯ ПРЕВ'Ю
+# ======================================================================
+SUPPORTED_IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.heic', '.webp']
+SUPPORTED_VIDEO_EXTENSIONS = ['.mp4', '.mov', '.avi', '.mkv', '.webm']
+
+def detect_media_type(filename: str) -> Optional[str]:
+    file_extension = os.path.splitext(filename.lower())[1]
+    if file_extension in SUPPORTED_IMAGE_EXTENSIONS: return "image"
+    if file_extension in SUPPORTED_VIDEO_EXTENSIONS: return "video"
+    return None
+
+def thumbnail_filename_for(filename: str, settings: Optional[dict] = None) -> str:
+    # Файли з підпапок (ключ "папка/фото.jpg") отримують пласке ім'я прев'ю
+    settings = settings or load_settings()
+    ext = "webp" if settings.get("thumbnail_format", "webp") == "webp" else "jpg"
+    return f"{os.path.splitext(filename)[0].replace('/', '__')}.{ext}"
+
+
+FINAL_JOB_STATUSES = ("complete", "failed", "cancelled")
+JOB_PERSIST_INTERVAL = 1.0  # лічильники прогресу пишемо на диск не частіше, ніж раз на секунду
+
+class JobCancelled(Exception):
+    pass
+
+class JobRegistry:
+    """
+    Реєстр фонових задач: статус і прогрес доступні через /jobs/{job_id}
+    та потоком Server-Sent Events. Стан зберігається в SQLite, тож після
+    перезапуску задачі не зникають: незавершені або відновлюються
+    планувальником, або чесно позначаються як failed.
+    """
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._persisted_at = {}
+        self._subscribers = {}  # job_id -> [(loop, asyncio.Event)]
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, status TEXT, data TEXT NOT NULL, updated REAL)")
+        for job_id, data in self._db.execute("SELECT id, data FROM jobs"):
+            self._jobs[job_id] = json.loads(data)
+
+    def create(self, kind: str, **fields) -> str:
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            self._jobs[job_id] = {"id": job_id, "kind": kind, "status": "starting", "created": time.time(), **fields}
+            self._persist(job_id, force=True)
+        return job_id
+
+    def update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None: return
+            status_changed = "status" in fields and fields["status"] != job.get("status")
+            job.update(fields)
+            if status_changed and job["status"] in FINAL_JOB_STATUSES: job.setdefault("finished", time.time())
+            self._persist(job_id, force=status_changed)
+        self._publish(job_id)
+
+    def increment(self, job_id: str, **counters):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None: return
+            for key, delta in counters.items(): job[key] = job.get(key, 0) + delta
+            self._persist(job_id)
+        self._publish(job_id)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def find(self, kind: str, status: str, **match) -> Optional[dict]:
+        with self._lock:
+            for job in self._jobs.values():
+                if job["kind"] == kind and job["status"] == status and all(job.get(k) == v for k, v in match.items()):
+                    return dict(job)
+        return None
+
+    def count(self, kind: str, statuses: tuple) -> int:
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job["kind"] == kind and job["status"] in statuses)
+
+    # --- Скасування ---
+    def cancel(self, job_id: str) -> Optional[dict]:
+        """Задачу в черзі скасовуємо одразу; ту, що виконується, — на найближчій контрольній точці."""
+        job = self.get(job_id)
+        if job is None or job["status"] in FINAL_JOB_STATUSES: return job
+        if job["status"] in ("starting", "queued"): self.update(job_id, status="cancelled")
+        else: self.update(job_id, cancel_requested=True)
+        return self.get(job_id)
+
+    def is_cancelled(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        return bool(job and (job.get("cancel_requested") or job["status"] == "cancelled"))
+
+    def raise_if_cancelled(self, job_id: str):
+        if self.is_cancelled(job_id): raise JobCancelled()
+
+    # --- Після перезапуску та очищення ---
+    def recover(self, schedulers: dict):
+        """Черга відновлюється у відповідних планувальниках, розпочаті задачі завершуються з помилкою."""
+        for job in sorted((self.get(j) for j in list(self._jobs)), key=lambda j: j["created"]):
+            if job["status"] in FINAL_JOB_STATUSES: continue
+            scheduler = schedulers.get(job["kind"])
+            if job["status"] == "queued" and scheduler is not None: scheduler.enqueue(job["id"])
+            else: self.update(job["id"], status="failed", error="Interrupted by server restart")
+
+    def cleanup(self, ttl_seconds: float) -> int:
+        """Прибирає завершені задачі, старші за ttl_seconds."""
+        cutoff = time.time() - ttl_seconds
+        with self._lock:
+            expired = [j for j, job in self._jobs.items() if job["status"] in FINAL_JOB_STATUSES and job.get("finished", job["created"]) < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+                self._persisted_at.pop(job_id, None)
+            with self._db:
+                self._db.executemany("DELETE FROM jobs WHERE id = ?", [(j,) for j in expired])
+        return len(expired)
+
+    def _persist(self, job_id: str, force: bool = False):
+        # Викликається під self._lock
+        now = time.time()
+        if not force and now - self._persisted_at.get(job_id, 0) < JOB_PERSIST_INTERVAL: return
+        job = self._jobs[job_id]
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO jobs (id, kind, status, data, updated) VALUES (?, ?, ?, ?, ?)",
+                             (job_id, job["kind"], job["status"], json.dumps(job, ensure_ascii=False), now))
+        self._persisted_at[job_id] = now
+
+    # --- Server-Sent Events ---
+    def subscribe(self, job_id: str) -> asyncio.Event:
+        event = asyncio.Event()
+        with self._lock: self._subscribers.setdefault(job_id, []).append((asyncio.get_running_loop(), event))
+        return event
+
+    def unsubscribe(self, job_id: str, event: asyncio.Event):
+        with self._lock:
+            subscribers = [s for s in self._subscribers.get(job_id, []) if s[1] is not event]
+            if subscribers: self._subscribers[job_id] = subscribers
+            else: self._subscribers.pop(job_id, None)
+
+    def _publish(self, job_id: str):
+        with self._lock: subscribers = list(self._subscribers.get(job_id, []))
+        for loop, event in subscribers:
+            try: loop.call_soon_threadsafe(event.set)
+            except RuntimeError: pass  # цикл подій уже закрито
+
+
+class JobScheduler:
+    """
+    Черга задач одного типу з фіксованою кількістю потоків-виконавців.
+    handler(job_id, **params) виконується в потоці; прогрес пише в JOBS.
+    """
+    def __init__(self, registry: JobRegistry, kind: str, handler, workers: int, max_queued: int):
+        self.registry, self.kind, self.handler = registry, kind, handler
+        self.workers, self.max_queued = workers, max_queued
+        self._queue = queue.Queue()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._run, name=f"{self.kind}-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, dedupe_key: Optional[str] = None, **params) -> tuple:
+        """
+        Повертає (job_id, чи створено нову задачу). Якщо в черзі вже є задача з тим
+        самим dedupe_key — повертається вона; якщо черга переповнена — None.
+        """
+        if dedupe_key:
+            existing = self.registry.find(self.kind, "queued", dedupe_key=dedupe_key)
+            if existing: return existing["id"], False
+        if self.registry.count(self.kind, ("queued",)) >= self.max_queued: return None, False
+        job_id = self.registry.create(self.kind, params=params, dedupe_key=dedupe_key)
+        self.registry.update(job_id, status="queued", message="Queued")
+        self.enqueue(job_id)
+        return job_id, True
+
+    def enqueue(self, job_id: str):
+        self._queue.put(job_id)
+
+    def _run(self):
+        while True:
+            job_id = self._queue.get()
+            job = self.registry.get(job_id)
+            if job is None or job["status"] != "queued": continue  # скасовано або прибрано
+            self.registry.update(job_id, status="processing", started=time.time())
+            try:
+                self.handler(job_id, **(job.get("params") or {}))
+            except JobCancelled:
+                self.registry.update(job_id, status="cancelled", message="Cancelled")
+            except Exception as e:
+                traceback.print_exc()
+                self.registry.update(job_id, status="failed", error=str(e))
+
+
+JOBS = JobRegistry(LIBRARY_DB_FILE)
+_BACKGROUND_TASKS = set()
+
+def start_job_task(job_id: str, coro):
+    """Запускає корутину задачі в циклі подій; тримає посилання й позначає задачу як failed при винятку."""
+    async def runner():
+        try:
+            await coro
+        except Exception as e:
+            traceback.print_exc()
+            JOBS.update(job_id, status="failed", error=str(e))
+    task = asyncio.create_task(runner())
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+_THUMBNAIL_POOL = None
+_THUMBNAIL_POOL_WORKERS = 0
+_THUMBNAIL_POOL_LOCK = threading.Lock()
+
+def get_thumbnail_pool() -> ProcessPoolExecutor:
+    """Пул процесів для прев'ю. Розмір — settings["thumbnail_workers"] (0 = всі ядра)."""
+    global _THUMBNAIL_POOL, _THUMBNAIL_POOL_WORKERS
+    workers = int(load_settings().get("thumbnail_workers") or 0) or os.cpu_count() or 1
+    with _THUMBNAIL_POOL_LOCK:
+        if _THUMBNAIL_POOL is None or _THUMBNAIL_POOL_WORKERS != workers:
+            if _THUMBNAIL_POOL is not None: _THUMBNAIL_POOL.shutdown(wait=False)
+            _THUMBNAIL_POOL = ProcessPoolExecutor(max_workers=workers)
+            _THUMBNAIL_POOL_WORKERS = workers
+        return _THUMBNAIL_POOL
+
+def thumbnail_settings_signature(settings: dict) -> str:
+    """Підпис налаштувань, з якими будувалось прев'ю; зміна налаштувань = перегенерація."""
+    renditions = thumbnail_renditions(settings)
+    return f"{settings.get('thumbnail_format', 'webp')}:" + ",".join(f"{name}={size}@{quality}" for name, (size, quality) in sorted(renditions.items()))
+
+def is_thumbnail_fresh(original_path: str, thumbnail_path: str, entry: Optional[dict], signature: str) -> bool:
+    """Прев'ю актуальне, якщо воно новіше за оригінал і збудоване з поточними налаштуваннями."""
+    if not entry or entry.get("thumb_sig") != signature: return False
+    try:
+        return os.path.getmtime(thumbnail_path) >= os.path.getmtime(original_path)
+    except OSError:
+        return False
+
+def build_thumbnail(original_path: str, thumbnail_path: str, file_type: str, settings: dict):
+    """Виконується в процесі пулу. Повертає {rendition: ім'я файлу} або False."""
+    if file_type == "image": return create_photo_thumbnail(original_path, thumbnail_path, settings)
+    return create_video_thumbnail(original_path, thumbnail_path, settings)
+
+def build_thumbnail_and_date(original_path: str, thumbnail_path: str, file_type: str, settings: dict, need_thumbnail: bool):
+    """
+    Виконується в процесі пулу: прев'ю (за потреби) + метадані файлу.
+    Повертає (renditions | True | False, info), де info — результат extract_media_info (з timestamp) + palette + dhash.
+    """
+    renditions = True
+    if need_thumbnail:
+        renditions = build_thumbnail(original_path, thumbnail_path, file_type, settings)
+        if not renditions: return False, None
+    info = extract_media_info(original_path)
+    palette = extract_palette_from_file(thumbnail_path)  # grid-прев'ю вже на диску й маленьке
+    if palette: info["palette"] = palette
+    dhash = compute_dhash_from_file(thumbnail_path)
+    if dhash: info["dhash"] = dhash
+    return renditions, info
+
+def remove_thumbnail_files(entry: Optional[dict], keep: tuple = ()):
+    """Видаляє файли прев'ю запису метаданих (усі renditions), крім keep."""
+    if not entry: return
+    names = set((entry.get("renditions") or {}).values())
+    if entry.get("thumbnail"): names.add(entry["thumbnail"])
+    for name in names - set(keep):
+        try: os.remove(os.path.join(THUMBNAILS_PATH, name))
+        except OSError: pass
+
+async def run_in_thumbnail_pool(job_id: str, work: list, on_result):
+    """
+    Запускає work = [(filename, fn, args), ...] у пулі процесів і
+    рахує прогрес у JOBS. on_result(filename, result) викликається в циклі подій.
+    У пулі одночасно не більше завдань, ніж у нього процесів: решта чекає на семафорі,
+    тож скасування зупиняє роботу одразу, а не після того, як пул перебере всю чергу.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_thumbnail_pool()
+    slots = asyncio.Semaphore(getattr(pool, "_max_workers", None) or os.cpu_count() or 1)
+    JOBS.update(job_id, status="processing", total=len(work), done=0)
+
+    async def run_one(filename, fn, args):
+        async with slots:
+            if JOBS.is_cancelled(job_id): return
+            try:
+                result = await loop.run_in_executor(pool, fn, *args)
+            except Exception as e:
+                print(f"Помилка при створенні мініатюри для {filename}: {e}")
+                result = None
+        try:
+            on_result(filename, result)
+        except Exception as e:
+            print(f"⚠️ Помилка обробки результату для {filename}: {e}")
+            JOBS.increment(job_id, failed=1)
+        JOBS.increment(job_id, done=1)
+
+    await asyncio.gather(*(run_one(*item) for item in work))
+    JOBS.update(job_id, status="cancelled" if JOBS.is_cancelled(job_id) else "complete")
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    job = JOBS.get(job_id)
+    if not job: raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = JOBS.cancel(job_id)
+    if not job: raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+async def job_event_stream(job_id: str):
+    """SSE: кожна зміна задачі — подія 'data: {json}'; потік закривається після фінального статусу."""
+    event = JOBS.subscribe(job_id)
+    try:
+        while True:
+            event.clear()
+            job = JOBS.get(job_id)
+            if job is None: break
+            yield f"data: {json.dumps(job, ensure_ascii=False)}\n\n"
+            if job["status"] in FINAL_JOB_STATUSES: break
+            try: await asyncio.wait_for(event.wait(), timeout=15)
+            except asyncio.TimeoutError: yield ": keepalive\n\n"
+    finally:
+        JOBS.unsubscribe(job_id, event)
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str):
+    if not JOBS.get(job_id): raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(job_event_stream(job_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ======================================================================
+# БЛОК 4: КОНВЕЄР ІНЖЕСТУ (потоковий запис + обробка у пулі)
+# ======================================================================
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+INGEST_STATUS_TTL = 3600  # скільки секунд пам'ятати статус завершеного інжесту
+
+_INGEST_POOL = None
+_INGEST_POOL_LOCK = threading.Lock()
+INGEST_STATUS = {}  # ключ метаданих -> {"status": pending|processing|ready|failed, ...}
+_INGEST_STATUS_LOCK = threading.Lock()
+
+def get_ingest_pool() -> ThreadPoolExecutor:
+    """Обмежений пул для обробки завантажених файлів. Розмір — settings["ingest_workers"]."""
+    global _INGEST_POOL
+    with _INGEST_POOL_LOCK:
+        if _INGEST_POOL is None:
+            workers = max(1, int(load_settings().get("ingest_workers") or 2))
+            _INGEST_POOL = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        return _INGEST_POOL
+
+def set_ingest_status(key: str, status: str, **fields):
+    with _INGEST_STATUS_LOCK:
+        INGEST_STATUS[key] = {"status": status, "updated": time.time(), **fields}
+
+def _fsync_directory(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try: os.fsync(fd)
+        finally: os.close(fd)
+    except OSError:
+        pass
+
+def _commit_staged_file(staging_path: str, final_path: str):
+    """Атомарно переносить повністю записаний файл з incoming/ на місце."""
+    try:
+        os.replace(staging_path, final_path)
+    except OSError:
+        shutil.move(staging_path, final_path)  # incoming/ на іншому диску
+    _fsync_directory(os.path.dirname(final_path))
+
+async def stream_upload_to_staging(upload: UploadFile) -> tuple:
+    """
+    Пише тіло запиту шматками у incoming/, не блокуючи цикл подій, і одночасно
+    рахує sha256 (файл не доводиться перечитувати). Робить fsync.
+    Повертає (шлях у incoming/, розмір, sha256).
+    """
+    loop = asyncio.get_running_loop()
+    staging_path = os.path.join(INCOMING_PATH, f"{uuid.uuid4().hex}.part")
+    out = await loop.run_in_executor(None, open, staging_path, "wb")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk: break
+            await loop.run_in_executor(None, lambda: (out.write(chunk), digest.update(chunk)))
+            size += len(chunk)
+        await loop.run_in_executor(None, lambda: (out.flush(), os.fsync(out.fileno())))
+    except BaseException:
+        out.close()
+        _remove_quietly(staging_path)
+        raise
+    out.close()
+    return staging_path, size, digest.hexdigest()
+
+def _remove_quietly(path: str):
+    try: os.remove(path)
+    except OSError: pass
+
+def _candidate_names(filename: str):
+    """photo.jpg, photo (1).jpg, photo (2).jpg, ..."""
+    yield filename
+    stem, ext = os.path.splitext(filename)
+    counter = 1
+    while True:
+        yield f"{stem} ({counter}){ext}"
+        counter += 1
+
+def _link_unique(source_path: str, directory: str, filename: str) -> str:
+    """
+    Створює жорстке посилання на source_path під вільним ім'ям у directory.
+    os.link не перезаписує наявний файл, тож дві одночасні заливки з однаковим
+    ім'ям не затирають одна одну. Повертає остаточний шлях.
+    """
+    for name in _candidate_names(filename):
+        final_path = os.path.join(directory, name)
+        try:
+            os.link(source_path, final_path)
+            return final_path
+        except FileExistsError:
+            continue
+
+def _move_unique(staging_path: str, directory: str, filename: str) -> str:
+    """Переносить файл з incoming/ під вільне ім'я (жорстке посилання + видалення; без нього — копія)."""
+    try:
+        final_path = _link_unique(staging_path, directory, filename)
+        _remove_quietly(staging_path)
+    except OSError:
+        # ФС без жорстких посилань або incoming/ на іншому диску
+        final_path = next(os.path.join(directory, n) for n in _candidate_names(filename) if not os.path.exists(os.path.join(directory, n)))
+        _commit_staged_file(staging_path, final_path)
+        return final_path
+    _fsync_directory(directory)
+    return final_path
+
+class ContentHashIndex:
+    """
+    sha256 вмісту -> ключі метаданих з таким вмістом (для пошуку дублікатів під час заливки).
+    Окремо — заливки в обробці: файл уже в originals, а метаданих ще немає. Без них дві
+    однакові заливки поспіль (чи два однакові файли в пакеті) обидві будували б прев'ю.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._pending = {}  # sha256 -> (ключ, Event, що спрацьовує після коміту чи збою обробки)
+
+    def on_change(self, filename: str, old: Optional[dict], new: Optional[dict]):
+        old_hash, new_hash = (old or {}).get("content_hash"), (new or {}).get("content_hash")
+        if old_hash == new_hash and new is not None: return
+        with self._lock:
+            if old_hash and old_hash in self._keys:
+                self._keys[old_hash].discard(filename)
+                if not self._keys[old_hash]: del self._keys[old_hash]
+            if new_hash and new is not None: self._keys.setdefault(new_hash, set()).add(filename)
+
+    def matches(self, key: str, content_hash: str) -> bool:
+        """Файл ключа має саме цей вміст: хеш у метаданих збігається, а файл не змінювався після підрахунку."""
+        entry = METADATA.get(key) or {}
+        if entry.get("content_hash") != content_hash: return False
+        try: stat = os.stat(os.path.join(ORIGINALS_PATH, key))
+        except OSError: return False
+        return entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime
+
+    def find(self, content_hash: str) -> Optional[str]:
+        """Ключ з таким вмістом: спершу серед закомічених, потім серед заливок в обробці. Або None."""
+        with self._lock: keys = sorted(self._keys.get(content_hash, ()))
+        for key in keys:
+            if self.matches(key, content_hash): return key
+        key = self.pending_key(content_hash)
+        if key and os.path.exists(os.path.join(ORIGINALS_PATH, key)): return key
+        return None
+
+    def pending_key(self, content_hash: str) -> Optional[str]:
+        with self._lock: pending = self._pending.get(content_hash)
+        return pending[0] if pending else None
+
+    def reserve(self, content_hash: str, key: str):
+        """Файл key з цим вмістом уже в originals, метадані будуть пізніше. Перший резерв виграє."""
+        with self._lock: self._pending.setdefault(content_hash, (key, threading.Event()))
+
+    def release(self, content_hash: Optional[str], key: str):
+        """Обробку key завершено (вдало чи ні) — будимо дублікати, що чекають на його прев'ю."""
+        with self._lock:
+            pending = self._pending.get(content_hash)
+            if not pending or pending[0] != key: return
+            del self._pending[content_hash]
+        pending[1].set()
+
+    def wait(self, content_hash: str, key: str):
+        """Блокує потік, доки заливка key з цим вмістом в обробці."""
+        with self._lock: pending = self._pending.get(content_hash)
+        if pending and pending[0] == key: pending[1].wait()
+
+CONTENT_INDEX = ContentHashIndex()
+METADATA.subscribe(CONTENT_INDEX.on_change)
+
+_STORE_UPLOAD_LOCK = threading.Lock()  # пошук дубліката і резерв хешу — одна операція
+
+def store_upload(staging_path: str, directory: str, filename: str, content_hash: str) -> dict:
+    """
+    Кладе залитий файл в originals без перезапису й без зайвих копій. Виконується в потоці.
+      - такий самий вміст під тим самим ім'ям уже є — заливка просто відкидається;
+      - такий самий вміст під іншим ім'ям (зокрема ще в обробці) — нове ім'я стає
+        жорстким посиланням на наявний файл;
+      - ім'я зайняте іншим вмістом — файл отримує ім'я "назва (1).ext".
+    Новий медіа-вміст резервується в CONTENT_INDEX до коміту метаданих — обробник
+    заливки мусить викликати CONTENT_INDEX.release(content_hash, key).
+    Повертає {"path", "key", "duplicate_of", "existing"}.
+    """
+    base_path = os.path.abspath(ORIGINALS_PATH)
+    requested_path = os.path.join(directory, filename)
+    requested_key = os.path.relpath(requested_path, base_path).replace(os.sep, '/')
+    is_media = bool(detect_media_type(filename))
+    with _STORE_UPLOAD_LOCK:
+        # Спершу саме запитане ім'я: інакше інший ключ з тим самим вмістом зробив би з повторної заливки "назва (1).ext"
+        if CONTENT_INDEX.matches(requested_key, content_hash) or CONTENT_INDEX.pending_key(content_hash) == requested_key:
+            _remove_quietly(staging_path)
+            return {"path": requested_path, "key": requested_key, "duplicate_of": None, "existing": True}
+        source_key = CONTENT_INDEX.find(content_hash) if is_media else None
+        if source_key:
+            try:
+                final_path = _link_unique(os.path.join(ORIGINALS_PATH, source_key), directory, filename)
+                _remove_quietly(staging_path)
+                _fsync_directory(directory)
+            except OSError:
+                final_path = _move_unique(staging_path, directory, filename)
+        else:
+            final_path = _move_unique(staging_path, directory, filename)
+        key = os.path.relpath(final_path, base_path).replace(os.sep, '/')
+        if is_media and not source_key: CONTENT_INDEX.reserve(content_hash, key)
+    return {"path": final_path, "key": key, "duplicate_of": source_key, "existing": False}
+
+def _link_or_copy(source: str, destination: str):
+    _remove_quietly(destination)
+    try: os.link(source, destination)
+    except OSError: shutil.copy2(source, destination)
+
+def duplicate_entry(key: str, original_path: str, source_key: str, content_hash: str, source: Optional[dict] = None) -> Optional[dict]:
+    """
+    Запис для файлу, вміст якого вже є в бібліотеці: прев'ю — жорсткі посилання на
+    прев'ю оригіналу, метадані — його ж (або source, якщо оригінал ще не закомічений).
+    None, якщо в оригіналу немає прев'ю.
+    """
+    source = source or METADATA.get(source_key)
+    if not source or not source.get("thumbnail"): return None
+    # Розширення прев'ю — як у джерела (могло бути збудоване ще в JPEG)
+    thumbnail = os.path.splitext(thumbnail_filename_for(key))[0] + os.path.splitext(source["thumbnail"])[1]
+    renditions = {}
+    for name, source_file in (source.get("renditions") or {"grid": source["thumbnail"]}).items():
+        renditions[name] = rendition_filename(thumbnail, name)
+        _link_or_copy(os.path.join(THUMBNAILS_PATH, source_file), os.path.join(THUMBNAILS_PATH, renditions[name]))
+    stat = os.stat(original_path)
+    return {**source, "thumbnail": thumbnail, "renditions": renditions, "size": stat.st_size,
+            "mtime": stat.st_mtime, "content_hash": content_hash, "duplicate_of": source_key}
+
+def ingest_duplicate(key: str, original_path: str, source_key: str, content_hash: str):
+    """Вміст уже є в бібліотеці: прев'ю й метадані беруться з оригіналу, без повторної обробки."""
+    try:
+        set_ingest_status(key, "processing")
+        CONTENT_INDEX.wait(content_hash, source_key)  # оригінал ще обробляється — чекаємо його прев'ю
+        entry = duplicate_entry(key, original_path, source_key, content_hash)
+        if entry is None: return process_ingest(key, original_path, detect_media_type(key), content_hash)
+        METADATA.put(key, entry)
+        set_ingest_status(key, "ready", duplicate_of=source_key)
+    except Exception as e:
+        print(f"❌ Помилка обробки дубліката {key}: {e}")
+        set_ingest_status(key, "failed", error=str(e))
+
+def ingest_entry(key: str, original_path: str, file_type: str, thumbnail_filename: str, renditions, media_info: dict,
+                 settings: dict, content_hash: Optional[str] = None) -> dict:
+    """Запис метаданих за результатом build_thumbnail_and_date; старі прев'ю цього ключа прибираються."""
+    if not renditions: raise RuntimeError("Could not create thumbnail")
+    stat = os.stat(original_path)
+    remove_thumbnail_files(METADATA.get(key), keep=tuple(renditions.values()))
+    return {
+        "type": file_type,
+        "thumbnail": thumbnail_filename,
+        "renditions": renditions,
+        **media_info,
+        "thumb_sig": thumbnail_settings_signature(settings),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        **({"content_hash": content_hash} if content_hash else {}),
+    }
+
+def schedule_faststart(key: str, original_path: str, file_type: str):
+    if file_type == "video" and original_path.lower().endswith(FASTSTART_EXTENSIONS):
+        get_ingest_pool().submit(process_faststart, key, original_path)
+
+def process_ingest(key: str, original_path: str, file_type: str, content_hash: Optional[str] = None):
+    """Прев'ю + дата (у пулі процесів) і коміт метаданих. Виконується в потоці ingest-пулу."""
+    set_ingest_status(key, "processing")
+    try:
+        settings = load_settings()
+        thumbnail_filename = thumbnail_filename_for(key, settings)
+        thumbnail_path = os.path.join(THUMBNAILS_PATH, thumbnail_filename)
+        future = get_thumbnail_pool().submit(build_thumbnail_and_date, original_path, thumbnail_path, file_type, settings, True)
+        renditions, media_info = future.result()
+        METADATA.put(key, ingest_entry(key, original_path, file_type, thumbnail_filename, renditions, media_info, settings, content_hash))
+        set_ingest_status(key, "ready")
+        schedule_faststart(key, original_path, file_type)
+    except Exception as e:
+        print(f"❌ Помилка обробки {key}: {e}")
+        set_ingest_status(key, "failed", error=str(e))
+    finally:
+        CONTENT_INDEX.release(content_hash, key)
+
+def submit_ingest(key: str, original_path: str, file_type: str, content_hash: Optional[str] = None, duplicate_of: Optional[str] = None):
+    now = time.time()
+    with _INGEST_STATUS_LOCK:
+        for stale in [k for k, v in INGEST_STATUS.items() if v["status"] in ("ready", "failed") and now - v["updated"] > INGEST_STATUS_TTL]:
+            del INGEST_STATUS[stale]
+    set_ingest_status(key, "pending")
+    if duplicate_of: get_ingest_pool().submit(ingest_duplicate, key, original_path, duplicate_of, content_hash)
+    else: get_ingest_pool().submit(process_ingest, key, original_path, file_type, content_hash)
+
+def ingest_response(key: str, file_type: str, duplicate_of: Optional[str] = None) -> dict:
+    response = {"filename": key, "type": file_type, "status": "success", "ingest_status": "pending", "status_url": f"/upload/status/{key}"}
+    if duplicate_of: response["duplicate_of"] = duplicate_of
+    return response
+
+async def accept_upload(upload: UploadFile, directory: str) -> dict:
+    """Спільний шлях /upload/ і /files/upload_to_path/: запис + дедуплікація + інжест."""
+    filename = os.path.basename(upload.filename)
+    staging_path, size, content_hash = await stream_upload_to_staging(upload)
+    return await commit_upload(staging_path, directory, filename, content_hash)
+
+async def commit_upload(staging_path: str, directory: str, filename: str, content_hash: str) -> dict:
+    """Повністю записаний файл з incoming/ → originals (з дедуплікацією) → інжест. Відповідь як у /upload/."""
+    stored = await asyncio.get_running_loop().run_in_executor(None, store_upload, staging_path, directory, filename, content_hash)
+    key, file_type = stored["key"], detect_media_type(filename)
+    if stored["existing"]:
+        return {"filename": key, "type": file_type, "status": "success", "ingest_status": "ready" if key in METADATA else "pending",
+                "status_url": f"/upload/status/{key}", "already_exists": True}
+    note_filesystem_change(stored["path"])
+    if not file_type: return {"filename": key, "status": "skipped", "message": "Unsupported file type"}
+    submit_ingest(key, stored["path"], file_type, content_hash, stored["duplicate_of"])
+    return ingest_response(key, file_type, stored["duplicate_of"])
+
+@app.get("/upload/status/{filename:path}")
+async def get_upload_status(filename: str):
+    """Стан обробки завантаженого файлу: pending → processing → ready / failed."""
+    with _INGEST_STATUS_LOCK:
+        state = INGEST_STATUS.get(filename)
+    if state: return {"filename": filename, **state}
+    if filename in METADATA: return {"filename": filename, "status": "ready"}
+    raise HTTPException(status_code=404, detail="Upload not found")
+
+
+# ======================================================================
+# БЛОК 5: КЕШІ ТА УМОВНІ HTTP-ЗАПИТИ (ETag / 304)
+# ======================================================================
+class ByteLRUCache:
+    """LRU-кеш байтів з обмеженням за сумарним розміром, а не кількістю записів."""
+    def __init__(self, max_bytes: int):
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key -> (bytes, extra)
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key, data: bytes, extra=None):
+        if len(data) > self.max_bytes: return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None: self.current_bytes -= len(old[0])
+            self._items[key] = (data, extra)
+            self.current_bytes += len(data)
+            self._evict()
+
+    def resize(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._items:
+            _, (evicted, _) = self._items.popitem(last=False)
+            self.current_bytes -= len(evicted)
+
+    def pop(self, key):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None: self.current_bytes -= len(old[0])
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"items": len(self._items), "bytes": self.current_bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 3) if total else None}
+
+
+def cache_headers(etag: str, mtime: Optional[float] = None, max_age: int = 0) -> dict:
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}" if max_age else "no-cache"}
+    if mtime is not None: headers["Last-Modified"] = formatdate(mtime, usegmt=True)
+    return headers
+
+def is_not_modified(request: Request, etag: str, mtime: Optional[float] = None) -> bool:
+    """True, якщо клієнт уже має актуальну версію (If-None-Match / If-Modified-Since)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and mtime is not None:
+        try: return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError): return False
+    return False
+
+def not_modified_response(headers: dict) -> Response:
+    return Response(status_code=304, headers=headers)
+
+
+# --- Кеш зменшених оригіналів для /original_resized/ (RAM + диск) ---
+RESIZED_CACHE = ByteLRUCache(64 * 1024 * 1024)
+
+def resized_source_id(file_path: str) -> str:
+    return hashlib.sha1(os.path.abspath(file_path).encode("utf-8")).hexdigest()[:16]
+
+def resized_cache_key(file_path: str, stat, settings: dict) -> str:
+    """"{id оригіналу}-{id версії}": за префіксом дискова частина кешу знаходить усі копії файлу й після перезапуску."""
+    variant = f"{stat.st_mtime_ns}|{stat.st_size}|{settings.get('photo_size', 0)}|{settings.get('photo_quality', 100)}"
+    return f"{resized_source_id(file_path)}-{hashlib.sha1(variant.encode('utf-8')).hexdigest()}"
+
+def render_resized_original(file_path: str, max_size: int, quality: int) -> bytes:
+    with Image.open(file_path) as img:
+        if img.mode in ("RGBA", "P"):
+            img = img.convert("RGB")
+        # Якщо max_size > 0 — змінюємо розмір
+        if max_size and max_size > 0:
+            img.thumbnail((max_size, max_size))
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=quality, optimize=True)
+        return buf.getvalue()
+
+class ResizedDiskCache:
+    """
+    Дискова частина кешу /original_resized/ (cache/resized/{digest}.jpg) з обмеженням
+    за сумарним розміром: найдавніше використані файли видаляються першими
+    (порядок відновлюється при старті з mtime, який оновлюється при кожному попаданні).
+    Копії файлу, що змінився або зник з бібліотеки, видаляються одразу (forget_source):
+    ключ починається з id оригіналу (resized_cache_key), тож зв'язок "оригінал → копії"
+    відновлюється з імен файлів і не губиться після перезапуску.
+    """
+    def __init__(self, path: str, max_bytes: int):
+        self._lock = threading.Lock()
+        self.path = path
+        self.max_bytes = max_bytes
+        self._files = None  # digest -> розмір, від найдавніше використаного; індексується ліниво
+        self._by_source = {}  # id оригіналу -> digests
+        self.current_bytes = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _source_of(digest: str) -> str:
+        return digest.split("-", 1)[0]
+
+    def _index(self):
+        if self._files is not None: return
+        found = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith(".jpg"): continue
+            if "-" not in entry.name:
+                # Старий формат ключа без id оригіналу: за ним більше ніхто не прийде
+                _remove_quietly(entry.path); continue
+            try: stat = entry.stat()
+            except OSError: continue
+            found.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        self._files = OrderedDict((digest, size) for _, digest, size in sorted(found))
+        self._by_source = {}
+        for digest in self._files: self._by_source.setdefault(self._source_of(digest), set()).add(digest)
+        self.current_bytes = sum(self._files.values())
+
+    def _file(self, digest: str) -> str:
+        return os.path.join(self.path, f"{digest}.jpg")
+
+    def get(self, digest: str) -> Optional[bytes]:
+        try:
+            with open(self._file(digest), "rb") as f: data = f.read()
+        except OSError:
+            return None
+        with self._lock:
+            self._index()
+            if digest in self._files: self._files.move_to_end(digest)
+        try: os.utime(self._file(digest))
+        except OSError: pass
+        return data
+
+    def put(self, digest: str, data: bytes):
+        disk_path = self._file(digest)
+        tmp_path = f"{disk_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f: f.write(data)
+        os.replace(tmp_path, disk_path)
+        with self._lock:
+            self._index()
+            self.current_bytes += len(data) - self._files.pop(digest, 0)
+            self._files[digest] = len(data)
+            self._by_source.setdefault(self._source_of(digest), set()).add(digest)
+            self._evict()
+
+    def resize(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            if self._files is not None: self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._files:
+            digest, size = self._files.popitem(last=False)
+            self._remove(digest, size)
+
+    def _remove(self, digest: str, size: int):
+        digests = self._by_source.get(self._source_of(digest))
+        if digests is not None:
+            digests.discard(digest)
+            if not digests: del self._by_source[self._source_of(digest)]
+        self.current_bytes -= size
+        self.evicted += 1
+        try: os.remove(self._file(digest))
+        except OSError: pass
+
+    def forget_source(self, source_path: str):
+        """Оригінал змінився або видалений: його зменшені копії більше ніколи не знадобляться."""
+        with self._lock:
+            self._index()
+            for digest in list(self._by_source.get(resized_source_id(source_path), ())):
+                if digest in self._files: self._remove(digest, self._files.pop(digest))
+
+    def clear(self):
+        with self._lock:
+            for name in os.listdir(self.path):
+                try: os.remove(os.path.join(self.path, name))
+                except OSError: pass
+            self._files, self._by_source, self.current_bytes = OrderedDict(), {}, 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._index()
+            return {"files": len(self._files), "bytes": self.current_bytes, "max_bytes": self.max_bytes, "evicted": self.evicted}
+
+RESIZED_DISK_CACHE = ResizedDiskCache(RESIZED_CACHE_PATH, 1024 * 1024 * 1024)
+
+def get_or_render_resized(file_path: str, digest: str, settings: dict) -> bytes:
+    """RAM → диск (content-addressed за ключем) → рендер. Виконується в потоці."""
+    cached = RESIZED_CACHE.get(digest)
+    if cached is not None: return cached[0]
+    data = RESIZED_DISK_CACHE.get(digest)
+    if data is None:
+        data = render_resized_original(file_path, settings.get("photo_size", 0), settings.get("photo_quality", 100))
+        RESIZED_DISK_CACHE.put(digest, data)
+    RESIZED_CACHE.put(digest, data)
+    return data
+
+def on_metadata_change_forget_resized(filename, old, new):
+    if old and (new is None or (old.get("size"), old.get("mtime")) != (new.get("size"), new.get("mtime"))):
+        RESIZED_DISK_CACHE.forget_source(os.path.join(ORIGINALS_PATH, filename))
+
+METADATA.subscribe(on_metadata_change_forget_resized)
+
+# --- RAM-кеш прев'ю: прогортання галереї не будить HDD ---
+THUMBNAIL_CACHE = ByteLRUCache(128 * 1024 * 1024)
+THUMBNAIL_MAX_AGE = 7 * 24 * 3600
+THUMBNAIL_WARMUP = {"status": "idle", "loaded": 0}
+
+def load_thumbnail_into_cache(thumbnail_filename: str):
+    """Читає прев'ю з диска в RAM. Повертає (bytes, etag) або None, якщо файлу немає."""
+    try:
+        with open(os.path.join(THUMBNAILS_PATH, thumbnail_filename), "rb") as f: data = f.read()
+    except OSError:
+        return None
+    etag = f'"{hashlib.sha1(data).hexdigest()}"'
+    THUMBNAIL_CACHE.put(thumbnail_filename, data, etag)
+    return data, etag
+
+def warm_thumbnail_cache():
+    """Завантажує прев'ю найновіших фото в RAM, поки не заповниться ліміт кешу."""
+    THUMBNAIL_WARMUP.update(status="running", loaded=0)
+    names, _ = GALLERY_INDEX.page()
+    for name in names:
+        entry = METADATA.get(name)
+        if not entry or not entry.get("thumbnail"): continue
+        if load_thumbnail_into_cache(entry["thumbnail"]) is None: continue
+        THUMBNAIL_WARMUP["loaded"] += 1
+        if THUMBNAIL_CACHE.current_bytes >= THUMBNAIL_CACHE.max_bytes * 0.95: break
+    THUMBNAIL_WARMUP["status"] = "done"
+    print(f"🧊 RAM-кеш прев'ю прогріто: {THUMBNAIL_WARMUP['loaded']} файлів, {THUMBNAIL_CACHE.current_bytes // 1024} KB")
+
+def on_metadata_change_invalidate_thumbnails(filename, old, new):
+    for entry in (old, new):
+        if not entry: continue
+        for name in {entry.get("thumbnail"), *(entry.get("renditions") or {}).values()} - {None}:
+            THUMBNAIL_CACHE.pop(name)
+
+METADATA.subscribe(on_metadata_change_invalidate_thumbnails)
+
+
+def apply_cache_limits(settings: dict):
+    RESIZED_CACHE.resize(int(settings.get("resized_cache_mb", 64)) * 1024 * 1024)
+    RESIZED_DISK_CACHE.resize(int(settings.get("resized_disk_cache_mb", 1024)) * 1024 * 1024)
+    THUMBNAIL_CACHE.resize(int(settings.get("thumbnail_cache_mb", 128)) * 1024 * 1024)
+    FRAME_ASSETS.variants.resize(int(settings.get("frame_cache_mb", 32)) * 1024 * 1024)
+
+@app.on_event("startup")
+async def configure_caches():
+    settings = load_settings()
+    apply_cache_limits(settings)
+    if settings.get("thumbnail_cache_warmup", True):
+        threading.Thread(target=warm_thumbnail_cache, name="thumbnail-warmup", daemon=True).start()
+
+@app.get("/stats/cache")
+async def get_cache_stats():
+    """Лічильники кешів: якщо hit_rate прев'ю близький до 1, диски під час прогортання сплять."""
+    return {"thumbnails": {**THUMBNAIL_CACHE.stats(), "warmup": dict(THUMBNAIL_WARMUP)}, "resized": {**RESIZED_CACHE.stats(), "disk": RESIZED_DISK_CACHE.stats()}, "captions": CAPTIONS.stats(), "telegram_media": TELEGRAM_MEDIA.stats(), "listings": DIRECTORY_LISTINGS.stats(), "frames": FRAME_ASSETS.stats()}
+
+def clear_resized_cache():
+    """Скидає всі збережені зменшені копії (після зміни photo_size / photo_quality)."""
+    RESIZED_CACHE.clear()
+    RESIZED_DISK_CACHE.clear()
+
+
+# ======================================================================
+# БЛОК 6: СТРІМІНГ ОРИГІНАЛІВ (Range, 304) ТА MP4 FASTSTART
+# ======================================================================
+STREAM_CHUNK_SIZE = 256 * 1024
+FASTSTART_EXTENSIONS = ('.mp4', '.mov', '.m4v')
+
+def _iter_file_range(path: str, start: int, length: int):
+    # Синхронний генератор: Starlette сама ітерує його в пулі потоків
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk: break
+            length -= len(chunk)
+            yield chunk
+
+def _parse_range(range_header: str, size: int):
+    """Повертає (start, end) включно, None — якщо діапазон не підтримується (віддаємо весь файл), або 'invalid'."""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec: return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first == "":
+            suffix = int(last)
+            if suffix <= 0: return "invalid"
+            return max(0, size - suffix), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start: return "invalid"
+    return start, min(end, size - 1)
+
+def media_file_response(request: Request, path: str) -> Response:
+    """
+    Віддає файл з підтримкою умовних запитів (ETag/Last-Modified → 304)
+    і одного діапазону байтів (Range → 206), щоб відео можна було перемотувати.
+    """
+    stat = os.stat(path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = cache_headers(etag, stat.st_mtime)
+    headers["Accept-Ranges"] = "bytes"
+    if is_not_modified(request, etag, stat.st_mtime): return not_modified_response(headers)
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() in (etag, headers["Last-Modified"])):
+        byte_range = _parse_range(range_header, stat.st_size)
+    if byte_range == "invalid":
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+    if byte_range is None:
+        headers["Content-Length"] = str(stat.st_size)
+        return StreamingResponse(_iter_file_range(path, 0, stat.st_size), media_type=media_type, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(_iter_file_range(path, start, end - start + 1), status_code=206, media_type=media_type, headers=headers)
+
+
+def iter_mp4_atoms(f, start: int, end: int):
+    """Перебирає атоми MP4/MOV у діапазоні [start, end), читаючи лише їхні заголовки. Дає (тип, початок даних, кінець)."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < 8: break
+        atom_size, atom_type, header_size = int.from_bytes(header[:4], "big"), header[4:8], 8
+        if atom_size == 1 and len(header) == 16: atom_size, header_size = int.from_bytes(header[8:16], "big"), 16
+        elif atom_size == 0: atom_size = end - offset
+        if atom_size < header_size: break
+        yield atom_type, offset + header_size, min(offset + atom_size, end)
+        offset += atom_size
+
+def mp4_needs_faststart(path: str) -> bool:
+    """Читає лише заголовки атомів верхнього рівня: True, якщо 'moov' стоїть після 'mdat'."""
+    with open(path, "rb") as f:
+        for atom_type, _, _ in iter_mp4_atoms(f, 0, os.fstat(f.fileno()).st_size):
+            if atom_type == b"moov": return False
+            if atom_type == b"mdat": return True
+    return False
+
+def process_faststart(key: str, original_path: str):
+    """
+    Переносить 'moov' на початок MP4/MOV без перекодування (ffmpeg -c copy -movflags +faststart).
+    mtime оригіналу зберігається, щоб прев'ю не вважались застарілими. Виконується в ingest-пулі.
+    """
+    try:
+        if not mp4_needs_faststart(original_path):
+            stat = os.stat(original_path)
+            METADATA.update(key, faststart=True, size=stat.st_size, mtime=stat.st_mtime)
+            return
+        stat = os.stat(original_path)
+        ext = os.path.splitext(original_path)[1].lower()
+        tmp_path = os.path.join(INCOMING_PATH, f"{uuid.uuid4().hex}{ext}")
+        try:
+            (ffmpeg.input(original_path).output(tmp_path, c='copy', map='0', movflags='+faststart')
+             .overwrite_output().run(capture_stdout=True, capture_stderr=True))
+            os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            # Байти змінились: старий хеш зламав би дедуплікацію, кеш Telegram і кеш підписів.
+            # Хеш і розмір рахуємо до заміни, щоб запис оновився одразу після неї, а
+            # поллер не побачив новий файл зі старими size/content_hash
+            fields = {"content_hash": compute_file_hash(tmp_path)}
+            if (METADATA.get(key) or {}).get("duplicate_of"): fields["duplicate_of"] = None
+            new_stat = os.stat(tmp_path)
+            _commit_staged_file(tmp_path, original_path)
+            METADATA.update(key, faststart=True, size=new_stat.st_size, mtime=new_stat.st_mtime, **fields)
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        print(f"🎥 Faststart застосовано: {key}")
+    except ffmpeg.Error as e:
+        print(f"❌ Помилка faststart для {key}: {e.stderr.decode(errors='ignore')[-300:]}")
+    except Exception as e:
+        print(f"❌ Помилка faststart для {key}: {e}")
+
+
+# ======================================================================
+# БЛОК 7: ДОСТАВКА В TELEGRAM (альбоми, паралельне завантаження, FloodWait)
+# ======================================================================
+TELEGRAM_ALBUM_SIZE = 10  # ліміт Telegram на кількість медіа в одному альбомі
+# Лише ці формати Telegram показує як фото/відео; решту (gif, webp, heic, mkv...) шле документами,
+# а один документ у змішаному альбомі валить запит для всіх десяти файлів
+TELEGRAM_PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+TELEGRAM_VIDEO_EXTENSIONS = ('.mp4', '.mov')
+TELEGRAM_THUMB_SIDE = 320  # ліміт Telegram на прев'ю документа
+TELEGRAM_MAX_FLOOD_RETRIES = 5
+
+class TelegramFloodGate:
+    """
+    Спільна пауза для всіх викликів Telegram. Поки немає FloodWait, запити йдуть
+    без жодних затримок; після FloodWait кожен виклик чекає, доки мине вказаний час.
+    """
+    def __init__(self):
+        self.resume_at = 0.0
+        self.flood_waits = 0
+
+    async def call(self, fn, *args, **kwargs):
+        for attempt in range(TELEGRAM_MAX_FLOOD_RETRIES + 1):
+            delay = self.resume_at - time.monotonic()
+            if delay > 0: await asyncio.sleep(delay)
+            try:
+                return await fn(*args, **kwargs)
+            except FloodWaitError as e:
+                if attempt == TELEGRAM_MAX_FLOOD_RETRIES: raise
+                self.flood_waits += 1
+                self.resume_at = max(self.resume_at, time.monotonic() + e.seconds + 1)
+                print(f"   - ⏳ Telegram FloodWait: пауза {e.seconds} с")
+
+TELEGRAM_FLOOD_GATE = TelegramFloodGate()
+
+def telegram_send_kind(filename: str) -> str:
+    """"photo" / "video" — можна в медіа-альбом; "document" — лише з іншими документами."""
+    extension = os.path.splitext(filename.lower())[1]
+    if extension in TELEGRAM_PHOTO_EXTENSIONS: return "photo"
+    if extension in TELEGRAM_VIDEO_EXTENSIONS: return "video"
+    return "document"
+
+def plan_telegram_batches(filenames: list) -> list:
+    """Фото (jpg/png) й відео (mp4/mov) — альбомами по 10; решта — окремими альбомами документів."""
+    media = [f for f in filenames if telegram_send_kind(f) != "document"]
+    documents = [f for f in filenames if telegram_send_kind(f) == "document"]
+    return ([media[i:i + TELEGRAM_ALBUM_SIZE] for i in range(0, len(media), TELEGRAM_ALBUM_SIZE)] +
+            [documents[i:i + TELEGRAM_ALBUM_SIZE] for i in range(0, len(documents), TELEGRAM_ALBUM_SIZE)])
+
+def telegram_video_attributes(filename: str, path: str) -> list:
+    """Тривалість і розміри з метаданих (за потреби — ffprobe), щоб Telegram показав відео з плеєром, а не 1x1 без стрімінгу."""
+    entry = METADATA.get(filename) or {}
+    duration, width, height = entry.get("duration"), entry.get("width"), entry.get("height")
+    if not (duration and width and height):
+        try:
+            probe = ffmpeg.probe(path)
+            stream = next(s for s in probe["streams"] if s.get("codec_type") == "video")
+            duration = float(probe["format"].get("duration") or stream.get("duration") or 0)
+            width, height = int(stream["width"]), int(stream["height"])
+        except Exception as e:
+            print(f"⚠️ Не вдалося прочитати параметри відео {filename}: {e}")
+    return [DocumentAttributeVideo(duration=float(duration or 0), w=int(width or 0), h=int(height or 0), supports_streaming=True),
+            DocumentAttributeFilename(os.path.basename(filename))]
+
+def telegram_video_thumb(filename: str) -> Optional[bytes]:
+    """JPEG до 320 px з готового прев'ю (Telegram не приймає WebP як прев'ю документа)."""
+    thumbnail = (METADATA.get(filename) or {}).get("thumbnail")
+    if not thumbnail: return None
+    try:
+        with Image.open(os.path.join(THUMBNAILS_PATH, thumbnail)) as img:
+            img = img.convert("RGB")
+            img.thumbnail((TELEGRAM_THUMB_SIDE, TELEGRAM_THUMB_SIDE), LANCZOS_FILTER)
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=85)
+            return buf.getvalue()
+    except OSError:
+        return None
+
+def resolve_original_path(filename: str) -> Optional[str]:
+    base_path = os.path.abspath(ORIGINALS_PATH)
+    path = os.path.abspath(os.path.join(base_path, filename))
+    if not path.startswith(base_path + os.sep): return None
+    return path
+
+STALE_TELEGRAM_MEDIA_ERRORS = (FileReferenceExpiredError, FileReferenceInvalidError, MediaEmptyError)
+
+class TelegramMediaStore:
+    """
+    Вже завантажені в Telegram медіа (id + access_hash + file_reference) за sha256
+    вмісту. Той самий файл у будь-який чат надсилається без повторного завантаження;
+    застарілий file_reference оновлюється з повідомлення, де медіа було надіслано.
+    """
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS telegram_media (
+                content_hash TEXT PRIMARY KEY, kind TEXT NOT NULL, media_id INTEGER NOT NULL,
+                access_hash INTEGER NOT NULL, file_reference BLOB, chat TEXT, message_id INTEGER,
+                size INTEGER, reuses INTEGER DEFAULT 0, bytes_saved INTEGER DEFAULT 0, updated REAL)""")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, content_hash: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute("SELECT kind, media_id, access_hash, file_reference, chat, message_id FROM telegram_media WHERE content_hash = ?",
+                                   (content_hash,)).fetchone()
+            if row is None: self.misses += 1; return None
+            self.hits += 1
+        return {"kind": row[0], "id": row[1], "access_hash": row[2], "file_reference": row[3], "chat": row[4], "message_id": row[5]}
+
+    def put(self, content_hash: str, handle: dict, chat: str, message_id: int, size: int):
+        with self._lock, self._db:
+            self._db.execute("""INSERT INTO telegram_media (content_hash, kind, media_id, access_hash, file_reference, chat, message_id, size, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(content_hash) DO UPDATE SET kind = excluded.kind, media_id = excluded.media_id, access_hash = excluded.access_hash,
+                    file_reference = excluded.file_reference, chat = excluded.chat, message_id = excluded.message_id,
+                    size = excluded.size, updated = excluded.updated""",
+                (content_hash, handle["kind"], handle["id"], handle["access_hash"], handle["file_reference"], chat, message_id, size, time.time()))
+
+    def record_reuse(self, content_hash: str, size: int):
+        with self._lock, self._db:
+            self._db.execute("UPDATE telegram_media SET reuses = reuses + 1, bytes_saved = bytes_saved + ? WHERE content_hash = ?", (size, content_hash))
+
+    def delete(self, content_hash: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM telegram_media WHERE content_hash = ?", (content_hash,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, reuses, saved = self._db.execute("SELECT COUNT(*), COALESCE(SUM(reuses), 0), COALESCE(SUM(bytes_saved), 0) FROM telegram_media").fetchone()
+        lookups = self.hits + self.misses
+        return {"entries": count, "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "total_reuses": reuses, "bytes_saved": saved}
+
+TELEGRAM_MEDIA = TelegramMediaStore(LIBRARY_DB_FILE)
+
+def telegram_media_handle(message) -> Optional[dict]:
+    """Витягує id/access_hash/file_reference фото чи документа з надісланого повідомлення."""
+    for kind in ("photo", "document"):
+        media = getattr(message, kind, None)
+        if media is not None and getattr(media, "access_hash", None) is not None:
+            return {"kind": kind, "id": media.id, "access_hash": media.access_hash, "file_reference": media.file_reference}
+    return None
+
+def telegram_input_media(handle: dict):
+    media_class = InputPhoto if handle["kind"] == "photo" else InputDocument
+    return media_class(id=handle["id"], access_hash=handle["access_hash"], file_reference=handle["file_reference"] or b"")
+
+def telegram_chat_ref(chat: str):
+    return int(chat) if chat.lstrip("-").isdigit() else chat
+
+async def run_telegram_delivery_job(job_id: str, filenames: list, target_chat, tg=None):
+    """
+    Завантажує файли паралельно (не більше telegram_upload_concurrency одночасно),
+    потім надсилає їх альбомами. Файли, які вже колись надсилались, беруться з
+    TELEGRAM_MEDIA без завантаження. Статус кожного файлу — у job["files"].
+    tg — клієнт з інтерфейсом Telethon (upload_file / send_file / get_messages);
+    за замовчуванням — userbot.
+    """
+    tg = tg or client
+    gate = TELEGRAM_FLOOD_GATE
+    loop = asyncio.get_running_loop()
+    concurrency = max(1, int(load_settings().get("telegram_upload_concurrency", 3)))
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {f: "pending" for f in filenames}
+    started = time.monotonic()
+    JOBS.update(job_id, status="processing", total=len(filenames), sent=0, failed=0, reused=0,
+                bytes_uploaded=0, bytes_saved=0, files=dict(statuses))
+
+    def set_file_status(filename, status, **counters):
+        statuses[filename] = status
+        elapsed = max(time.monotonic() - started, 1e-6)
+        job = JOBS.get(job_id) or {}
+        uploaded = job.get("bytes_uploaded", 0) + counters.pop("bytes_uploaded", 0)
+        saved = job.get("bytes_saved", 0) + counters.pop("bytes_saved", 0)
+        JOBS.update(job_id, files=dict(statuses), bytes_uploaded=uploaded, bytes_saved=saved,
+                    throughput_bps=int(uploaded / elapsed), flood_waits=gate.flood_waits)
+        if counters: JOBS.increment(job_id, **counters)
+
+    async def upload(item):
+        async with semaphore:
+            if JOBS.is_cancelled(job_id): return None
+            set_file_status(item["filename"], "uploading")
+            try:
+                handle = await gate.call(tg.upload_file, item["path"])
+                if telegram_send_kind(item["filename"]) == "video":
+                    handle = await video_media(item, handle)
+            except Exception as e:
+                print(f"  ❌ Помилка завантаження файлу {item['filename']}: {e}")
+                set_file_status(item["filename"], "failed", failed=1); return None
+        set_file_status(item["filename"], "uploaded", bytes_uploaded=item["size"])
+        item.update(handle=handle, reused=False)
+        return item
+
+    async def video_media(item, handle):
+        """Відео надсилається як InputMediaUploadedDocument з реальними атрибутами й прев'ю."""
+        attributes = await loop.run_in_executor(None, telegram_video_attributes, item["filename"], item["path"])
+        thumb_bytes = await loop.run_in_executor(None, telegram_video_thumb, item["filename"])
+        thumb = await gate.call(tg.upload_file, thumb_bytes, file_name="thumb.jpg") if thumb_bytes else None
+        mime_type = mimetypes.guess_type(item["path"])[0] or "video/mp4"
+        return InputMediaUploadedDocument(file=handle, mime_type=mime_type, attributes=attributes, thumb=thumb)
+
+    async def prepare(filename):
+        path = resolve_original_path(filename)
+        if not path or not os.path.isfile(path):
+            set_file_status(filename, "missing", failed=1); return None
+        item = {"filename": filename, "path": path, "size": os.path.getsize(path)}
+        try: item["content_hash"] = await loop.run_in_executor(None, get_content_hash, filename, path)
+        except OSError: item["content_hash"] = None
+        cached = TELEGRAM_MEDIA.get(item["content_hash"]) if item["content_hash"] else None
+        if cached:
+            item.update(handle=telegram_input_media(cached), reused=True, cached=cached)
+            set_file_status(filename, "cached")
+            return item
+        return await upload(item)
+
+    async def refresh(item):
+        """Оновлює file_reference з повідомлення-джерела; якщо не вийшло — завантажує файл заново."""
+        cached = item["cached"]
+        try:
+            message = await gate.call(tg.get_messages, telegram_chat_ref(cached["chat"]), ids=cached["message_id"])
+            handle = telegram_media_handle(message) if message else None
+        except Exception:
+            handle = None
+        if handle and handle["id"] == cached["id"]:
+            TELEGRAM_MEDIA.put(item["content_hash"], handle, cached["chat"], cached["message_id"], item["size"])
+            item.update(handle=telegram_input_media(handle), cached={**cached, **handle})
+            return item
+        TELEGRAM_MEDIA.delete(item["content_hash"])
+        return await upload(item)
+
+    async def send(ready):
+        handles = [item["handle"] for item in ready]
+        force_document = telegram_send_kind(ready[0]["filename"]) == "document"
+        return await gate.call(tg.send_file, target_chat, handles if len(handles) > 1 else handles[0], force_document=force_document)
+
+    for batch in plan_telegram_batches(filenames):
+        if JOBS.is_cancelled(job_id): break
+        ready = [item for item in await asyncio.gather(*(prepare(f) for f in batch)) if item]
+        if not ready: continue
+        try:
+            try:
+                result = await send(ready)
+            except STALE_TELEGRAM_MEDIA_ERRORS:
+                if not any(item["reused"] for item in ready): raise
+                print("   - ♻️ Застарілі посилання на медіа в Telegram, оновлюю...")
+                ready = [item for item in await asyncio.gather(*(refresh(i) if i["reused"] else asyncio.sleep(0, i) for i in ready)) if item]
+                if not ready: continue
+                result = await send(ready)
+        except Exception as e:
+            print(f"  ❌ Помилка відправки альбому {[item['filename'] for item in ready]}: {e}")
+            for item in ready: set_file_status(item["filename"], "failed", failed=1)
+            continue
+
+        messages = result if isinstance(result, list) else [result]
+        for item, message in zip(ready, messages):
+            if item["reused"]:
+                TELEGRAM_MEDIA.record_reuse(item["content_hash"], item["size"])
+                set_file_status(item["filename"], "sent", sent=1, reused=1, bytes_saved=item["size"])
+                continue
+            handle = telegram_media_handle(message)
+            if handle and item["content_hash"]:
+                TELEGRAM_MEDIA.put(item["content_hash"], handle, str(target_chat), getattr(message, "id", None), item["size"])
+            set_file_status(item["filename"], "sent", sent=1)
+
+    job = JOBS.get(job_id) or {}
+    status = "cancelled" if JOBS.is_cancelled(job_id) else "complete"
+    JOBS.update(job_id, status=status, throughput_bps=int(job.get("bytes_uploaded", 0) / max(time.monotonic() - started, 1e-6)))
+    print(f"📨 Доставку в Telegram завершено: надіслано {job.get('sent', 0)} (без повторного завантаження: {job.get('reused', 0)}), помилок {job.get('failed', 0)}.")
+
+
+# ======================================================================
+# БЛОК 8: СТЕЖЕННЯ ЗА БІБЛІОТЕКОЮ (inotify / опитування + звірка при старті)
+# ======================================================================
+def library_key(path: str) -> Optional[str]:
+    """Ключ метаданих для шляху в originals (відносний шлях через '/') або None."""
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(ORIGINALS_PATH))
+    if rel.startswith(os.pardir) or rel == os.curdir: return None
+    if any(part.startswith(".") for part in rel.split(os.sep)): return None  # приховані/тимчасові файли
+    return rel.replace(os.sep, "/")
+
+def scan_library_files(unreadable: Optional[list] = None) -> dict:
+    """
+    {ключ: (size, mtime)} для всіх медіафайлів у originals (рекурсивно, через scandir).
+    Каталоги й файли, які не вдалося прочитати, додаються в unreadable (ключ каталогу,
+    "" — сам originals): їх відсутність у результаті не означає, що файлів немає.
+    """
+    found = {}
+    stack = [ORIGINALS_PATH]
+    while stack:
+        directory = stack.pop()
+        try: entries = list(os.scandir(directory))
+        except OSError as e:
+            print(f"⚠️ Не вдалося прочитати каталог {directory}: {e}")
+            if unreadable is not None: unreadable.append(library_key(directory) or "")
+            continue
+        for entry in entries:
+            if entry.name.startswith("."): continue
+            try:
+                if entry.is_dir(follow_symlinks=False): stack.append(entry.path); continue
+                if not detect_media_type(entry.name): continue
+                stat = entry.stat()
+            except OSError:
+                if unreadable is not None: unreadable.append(library_key(entry.path))
+                continue
+            found[library_key(entry.path)] = (stat.st_size, stat.st_mtime)
+    return found
+
+def is_under_unreadable(key: str, unreadable: list) -> bool:
+    return any(prefix == "" or key == prefix or key.startswith(prefix + "/") for prefix in unreadable)
+
+def remove_library_entry(key: str):
+    """Файл зник з диска: прибираємо прев'ю і запис метаданих."""
+    entry = METADATA.get(key)
+    if entry is None: return
+    remove_thumbnail_files(entry)
+    METADATA.delete(key)
+    print(f"🗑️ Видалено з бібліотеки: {key}")
+
+def apply_library_change(key: str) -> bool:
+    """
+    Звіряє один файл з метаданими й за потреби віддає його в конвеєр інжесту.
+    Повертає False, якщо файл ще обробляється і перевірку треба повторити пізніше.
+    """
+    path = os.path.join(ORIGINALS_PATH, key)
+    with _INGEST_STATUS_LOCK:
+        state = INGEST_STATUS.get(key)
+    if state and state["status"] in ("pending", "processing"): return False
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        remove_library_entry(key); return True
+    file_type = detect_media_type(key)
+    if not file_type or not os.path.isfile(path): return True
+    entry = METADATA.get(key)
+    if entry and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime: return True
+    submit_ingest(key, path, file_type)
+    return True
+
+class LibraryEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        for path in (getattr(event, "src_path", None), getattr(event, "dest_path", None)):
+            if not path: continue
+            note_filesystem_change(path, is_directory=event.is_directory)
+            self.watcher.note_path(path, is_directory=event.is_directory)
+
+class LibraryWatcher:
+    """
+    Стежить за originals і з затримкою debounce віддає зміни в apply_library_change:
+    серія подій від копіювання великого файлу перетворюється на одну обробку.
+    З watchdog працює на inotify; без нього — порівнює знімки каталогу кожні poll_interval секунд.
+    """
+    def __init__(self, debounce: float = 2.0, poll_interval: float = 30.0):
+        self.debounce, self.poll_interval = debounce, poll_interval
+        self._lock = threading.Lock()
+        self._pending = {}  # ключ -> час останньої події
+        self._observer = None
+        self._running = False
+        self.mode = None
+
+    def start(self):
+        if self._running: return
+        self._running = True
+        if WatchdogObserver is not None:
+            self._observer = WatchdogObserver()
+            self._observer.schedule(LibraryEventHandler(self), ORIGINALS_PATH, recursive=True)
+            self._observer.daemon = True
+            self._observer.start()
+            self.mode = "inotify"
+        else:
+            threading.Thread(target=self._poll_loop, name="library-poll", daemon=True).start()
+            self.mode = "polling"
+        threading.Thread(target=self._flush_loop, name="library-watch", daemon=True).start()
+        print(f"👀 Стежимо за бібліотекою ({self.mode})")
+
+    def stop(self):
+        self._running = False
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+
+    def note(self, key: str):
+        with self._lock: self._pending[key] = time.monotonic()
+
+    def note_path(self, path: str, is_directory: bool = False):
+        key = library_key(path)
+        if key is None: return
+        if not is_directory:
+            if detect_media_type(key): self.note(key)
+            return
+        # Перенесли/видалили каталог: перевіряємо все, що в ньому було і що в ньому є тепер
+        prefix = key + "/"
+        for known in METADATA.keys():
+            if known.startswith(prefix): self.note(known)
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in files: self.note_path(os.path.join(root, name))
+
+    def _poll_loop(self):
+        previous = scan_library_files()
+        while self._running:
+            time.sleep(self.poll_interval)
+            unreadable = []
+            current = scan_library_files(unreadable)
+            for key in set(previous) | set(current):
+                if key not in current and is_under_unreadable(key, unreadable):
+                    current[key] = previous[key]  # каталог тимчасово недоступний — не вважаємо файл зниклим
+                elif previous.get(key) != current.get(key): self.note(key)
+            previous = current
+
+    def _flush_loop(self):
+        while self._running:
+            time.sleep(min(0.5, self.debounce))
+            cutoff = time.monotonic() - self.debounce
+            with self._lock:
+                ready = [k for k, t in self._pending.items() if t <= cutoff]
+                for key in ready: del self._pending[key]
+            for key in ready:
+                try:
+                    if not apply_library_change(key): self.note(key)
+                except Exception as e:
+                    print(f"❌ Помилка обробки зміни {key}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"mode": self.mode, "running": self._running, "pending": len(self._pending)}
+
+LIBRARY_WATCHER = LibraryWatcher()
+
+@app.on_event("startup")
+async def start_library_watcher():
+    """Звірка бібліотеки з метаданими (лише змінені файли) і запуск стеження."""
+    settings = load_settings()
+    job_id = JOBS.create("rescan", new=0, updated=0, removed=0, failed=0, trigger="startup")
+    start_job_task(job_id, run_rescan_job(job_id, settings))
+    if settings.get("library_watch", True):
+        LIBRARY_WATCHER.debounce = float(settings.get("library_watch_debounce", 2.0))
+        LIBRARY_WATCHER.poll_interval = float(settings.get("library_poll_interval", 30))
+        LIBRARY_WATCHER.start()
+
+@app.on_event("shutdown")
+async def stop_library_watcher():
+    LIBRARY_WATCHER.stop()
+
+
+# ======================================================================
+# БЛОК 9: ЛІСТИНГ КАТАЛОГІВ (scandir + кеш за mtime каталогу, розміри тек)
+# ======================================================================
+class DirectoryListingCache:
+    """
+    Вміст каталогів з os.scandir: тип береться з d_type без stat, stat — лише для
+    розміру файлів. Запис дійсний, поки не змінився mtime каталогу, тож повторний
+    перегляд теки коштує один stat. Зміну розміру файлу (mtime каталогу не змінюється)
+    повідомляють вотчер і ендпоінти через invalidate().
+    """
+    def __init__(self, max_dirs: int = 256):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # абсолютний шлях -> (mtime_ns, [item, ...])
+        self.max_dirs = max_dirs
+        self.hits = 0
+        self.misses = 0
+
+    def list(self, directory: str) -> list:
+        mtime_ns = os.stat(directory).st_mtime_ns
+        with self._lock:
+            cached = self._entries.get(directory)
+            if cached and cached[0] == mtime_ns:
+                self._entries.move_to_end(directory)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        items = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(): items.append({"name": entry.name, "type": "directory"})
+                    else: items.append({"name": entry.name, "type": "file", "size": entry.stat().st_size})
+                except OSError:
+                    continue  # файл зник під час перегляду
+        items.sort(key=lambda x: (0 if x["type"] == "directory" else 1, x["name"].lower()))
+        with self._lock:
+            self._entries[directory] = (mtime_ns, items)
+            self._entries.move_to_end(directory)
+            while len(self._entries) > self.max_dirs: self._entries.popitem(last=False)
+        return items
+
+    def invalidate(self, directory: str):
+        with self._lock: self._entries.pop(directory, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"directories": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0}
+
+class DirectorySizeIndex:
+    """
+    Сумарний розмір і кількість файлів для кожної теки в originals (рекурсивно).
+    Будується одним обходом при першому запиті, далі оновлюється точково:
+    зміна одного файлу додає різницю розмірів усім теками-предкам.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file_sizes = {}  # відносний шлях файлу -> розмір
+        self._totals = {}  # відносний шлях теки ('' — корінь) -> [байти, файли]
+        self.built_at = None
+
+    @staticmethod
+    def _ancestors(rel_path: str):
+        parts = rel_path.split("/")[:-1]
+        yield ""
+        for i in range(1, len(parts) + 1): yield "/".join(parts[:i])
+
+    def _apply(self, rel_path: str, new_size: Optional[int]):
+        # Викликається під self._lock
+        old_size = self._file_sizes.pop(rel_path, None)
+        if new_size is not None: self._file_sizes[rel_path] = new_size
+        delta_bytes = (new_size or 0) - (old_size or 0)
+        delta_files = (new_size is not None) - (old_size is not None)
+        if not delta_bytes and not delta_files: return
+        for directory in self._ancestors(rel_path):
+            totals = self._totals.setdefault(directory, [0, 0])
+            totals[0] += delta_bytes
+            totals[1] += delta_files
+
+    @staticmethod
+    def _walk(root: str):
+        stack = [root]
+        while stack:
+            try: entries = list(os.scandir(stack.pop()))
+            except OSError: continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False): stack.append(entry.path)
+                    else: yield os.path.relpath(entry.path, ORIGINALS_PATH).replace(os.sep, "/"), entry.stat().st_size
+                except OSError:
+                    continue
+
+    def build(self):
+        files = dict(self._walk(ORIGINALS_PATH))
+        with self._lock:
+            self._file_sizes, self._totals = {}, {}
+            for rel_path, size in files.items(): self._apply(rel_path, size)
+            self.built_at = time.time()
+
+    def ensure_built(self, max_age: Optional[float] = None):
+        if self.built_at is None or (max_age is not None and time.time() - self.built_at > max_age): self.build()
+
+    def refresh(self, path: str, is_directory: bool = False):
+        """Перечитує розмір файлу (або всього піддерева для теки) після зміни на диску."""
+        if self.built_at is None: return
+        rel_path = os.path.relpath(os.path.abspath(path), os.path.abspath(ORIGINALS_PATH)).replace(os.sep, "/")
+        if rel_path.startswith(os.pardir): return
+        if not is_directory:
+            try: new_size = os.stat(path).st_size if os.path.isfile(path) else None
+            except OSError: new_size = None
+            with self._lock: self._apply(rel_path, new_size)
+            return
+        prefix = rel_path + "/"
+        fresh = dict(self._walk(path)) if os.path.isdir(path) else {}
+        with self._lock:
+            for stale in [f for f in self._file_sizes if f.startswith(prefix) and f not in fresh]: self._apply(stale, None)
+            for f, size in fresh.items(): self._apply(f, size)
+
+    def get(self, rel_dir: str) -> tuple:
+        with self._lock:
+            totals = self._totals.get(rel_dir.strip("/"), (0, 0))
+            return totals[0], totals[1]
+
+DIRECTORY_LISTINGS = DirectoryListingCache()
+DIRECTORY_SIZES = DirectorySizeIndex()
+DIRECTORY_SIZES_MAX_AGE = 600  # без inotify зовнішні зміни підхоплюються повним перерахунком не частіше, ніж раз на 10 хв
+
+def note_filesystem_change(path: str, is_directory: bool = False):
+    """Зміна в originals: скидаємо лістинг батьківської теки й оновлюємо розміри."""
+    DIRECTORY_LISTINGS.invalidate(os.path.dirname(os.path.abspath(path)))
+    if is_directory: DIRECTORY_LISTINGS.invalidate(os.path.abspath(path))
+    DIRECTORY_SIZES.refresh(path, is_directory=is_directory)
+
+def list_directory_page(requested_path: str, rel_path: str, offset: int, limit: Optional[int], with_sizes: bool) -> tuple:
+    """Виконується в потоці. Повертає (items сторінки, загальна кількість)."""
+    items = DIRECTORY_LISTINGS.list(requested_path)
+    if not rel_path:
+        # Файли галереї в корені показуються у віртуальній теці "Галерея"
+        items = [x for x in items if x["type"] != "file" or x["name"] not in METADATA]
+    page = items[offset:offset + limit] if limit else items[offset:]
+    if with_sizes:
+        DIRECTORY_SIZES.ensure_built(None if LIBRARY_WATCHER.mode == "inotify" else DIRECTORY_SIZES_MAX_AGE)
+        prefix = f"{rel_path.strip('/')}/" if rel_path.strip("/") else ""
+        page = [{**x, **dict(zip(("size", "files"), DIRECTORY_SIZES.get(prefix + x["name"])))} if x["type"] == "directory" else x for x in page]
+    return page, len(items)
 
 
 # =================================================================
-# НОВА ФУНКЦІЯ ДЛЯ ОТРИМАННЯ ОРИГІНАЛЬНОЇ ДАТИ
+# МЕТАДАНІ ФАЙЛУ: ДАТА, РОЗМІРИ, ОРІЄНТАЦІЯ, ТРИВАЛІСТЬ, GPS
 # =================================================================
+# Читаються тільки заголовки: для фото — EXIF (PIL не декодує пікселі, доки
+# не викликано load()), для MP4/MOV — атоми moov/mvhd/tkhd/udta. Один файл
+# відкривається один раз; hachoir лишається запасним варіантом для інших відео.
+EXIF_DATETIME, EXIF_ORIENTATION, EXIF_IFD, EXIF_GPS_IFD = 0x0132, 0x0112, 0x8769, 0x8825
+EXIF_DATETIME_ORIGINAL = 0x9003
+MP4_EPOCH_OFFSET = 2082844800  # секунд між 1904-01-01 (епоха QuickTime) і 1970-01-01
+ISO6709_PATTERN = re.compile(rb"([+-]\d{1,2}\.\d+)([+-]\d{1,3}\.\d+)")
+
+def _exif_gps(gps_ifd) -> Optional[list]:
+    def to_degrees(value):
+        d, m, s = (float(x) for x in value)
+        return d + m / 60 + s / 3600
+    try:
+        lat, lon = to_degrees(gps_ifd[2]), to_degrees(gps_ifd[4])
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return None
+    if gps_ifd.get(1) == "S": lat = -lat
+    if gps_ifd.get(3) == "W": lon = -lon
+    return [round(lat, 6), round(lon, 6)]
+
+def extract_image_info(file_path: str) -> dict:
+    info = {}
+    with Image.open(file_path) as img:  # лише заголовок, без декодування
+        width, height = img.size
+        exif = img.getexif()
+    orientation = exif.get(EXIF_ORIENTATION, 1)
+    # Розміри — такими, як фото показується (після повороту за EXIF)
+    if orientation in (5, 6, 7, 8): width, height = height, width
+    info.update(width=width, height=height, orientation=orientation)
+    date_value = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+    if date_value:
+        try:
+            # Формат 'YYYY:MM:DD HH:MM:SS'
+            info.update(timestamp=int(datetime.strptime(str(date_value).strip("\x00 ")[:19], '%Y:%m:%d %H:%M:%S').timestamp()), date_source="exif")
+        except ValueError:
+            pass
+    gps = _exif_gps(exif.get_ifd(EXIF_GPS_IFD))
+    if gps: info["gps"] = gps
+    return info
+
+def extract_mp4_info(file_path: str) -> dict:
+    """Дата (mvhd, UTC), тривалість, розміри відеодоріжки (tkhd) і GPS (ISO 6709 з udta/meta)."""
+    info = {}
+    with open(file_path, "rb") as f:
+        moov = next(((start, end) for t, start, end in iter_mp4_atoms(f, 0, os.fstat(f.fileno()).st_size) if t == b"moov"), None)
+        if moov is None: return info
+        for atom_type, start, end in iter_mp4_atoms(f, *moov):
+            if atom_type == b"mvhd":
+                f.seek(start)
+                data = f.read(32)
+                if data[:1] == b"\x01":  # version 1: 64-бітні поля
+                    created, timescale, duration = int.from_bytes(data[4:12], "big"), int.from_bytes(data[20:24], "big"), int.from_bytes(data[24:32], "big")
+                else:
+                    created, timescale, duration = int.from_bytes(data[4:8], "big"), int.from_bytes(data[12:16], "big"), int.from_bytes(data[16:20], "big")
+                if created > MP4_EPOCH_OFFSET: info.update(timestamp=created - MP4_EPOCH_OFFSET, date_source="mvhd")
+                if timescale: info["duration"] = round(duration / timescale, 3)
+            elif atom_type == b"trak" and "width" not in info:
+                tkhd = next(((s, e) for t, s, e in iter_mp4_atoms(f, start, end) if t == b"tkhd"), None)
+                if tkhd:
+                    f.seek(tkhd[1] - 8)  # ширина й висота — останні 8 байт tkhd (16.16 fixed)
+                    data = f.read(8)
+                    width, height = int.from_bytes(data[:4], "big") >> 16, int.from_bytes(data[4:], "big") >> 16
+                    if width and height: info.update(width=width, height=height)
+            elif atom_type in (b"udta", b"meta") and "gps" not in info and end - start <= 1024 * 1024:
+                f.seek(start)
+                match = ISO6709_PATTERN.search(f.read(end - start))
+                if match: info["gps"] = [float(match.group(1)), float(match.group(2))]
+    return info
+
+def extract_video_info_hachoir(file_path: str) -> dict:
+    info = {}
+    parser = createParser(file_path)
+    if not parser: return info
+    with parser:
+        metadata = extractMetadata(parser)
+    if not metadata: return info
+    if metadata.has('creation_date'):
+        timestamp = metadata.get('creation_date').timestamp()
+        if timestamp > 0: info.update(timestamp=timestamp, date_source="hachoir")  # нульова дата контейнера = 1904 рік
+    if metadata.has('width') and metadata.has('height'): info.update(width=metadata.get('width'), height=metadata.get('height'))
+    if metadata.has('duration'): info["duration"] = round(metadata.get('duration').total_seconds(), 3)
+    return info
+
+def extract_media_info(file_path: str) -> dict:
+    """
+    Один прохід по заголовку файлу. Повертає timestamp (завжди; без дати в
+    метаданих — mtime) і, якщо є: width, height, orientation, duration, gps.
+    """
+    lower = file_path.lower()
+    info = {}
+    try:
+        if detect_media_type(lower) == "image":
+            info = extract_image_info(file_path)
+        elif lower.endswith(FASTSTART_EXTENSIONS + ('.3gp',)):
+            info = extract_mp4_info(file_path)
+        elif detect_media_type(lower) == "video":
+            info = extract_video_info_hachoir(file_path)
+    except Exception:
+        pass  # Пошкоджений заголовок — лишається fallback на mtime
+    if "timestamp" not in info: info.update(timestamp=os.path.getmtime(file_path), date_source="mtime")
+    return info
+
+def extract_media_info_batch(file_paths: list) -> list:
+    """Виконується в процесі пулу: кілька файлів за одне завдання, щоб не платити за IPC на кожен."""
+    infos = []
+    for path in file_paths:
+        try: infos.append(extract_media_info(path))
+        except OSError: infos.append(None)  # файл зник між переліком і обробкою
+    return infos
+
 def get_original_date(file_path: str) -> float:
     """
     Намагається отримати оригінальну дату створення з метаданих файлу.
     Якщо не вдається, повертає дату зміни файлу в системі.
     """
-    try:
-        # Для фотографій (JPEG/HEIC)
-        if file_path.lower().endswith(('.jpg', '.jpeg', '.heic')):
-            with Image.open(file_path) as img:
-                exif_data = img._getexif()
-                if exif_data:
-                    for tag, value in exif_data.items():
-                        tag_name = TAGS.get(tag, tag)
-                        if tag_name == 'DateTimeOriginal':
-                            # Формат 'YYYY:MM:DD HH:MM:SS'
-                            dt_obj = datetime.strptime(value, '%Y:%m:%d %H:%M:%S')
-                            print(f"✅ Знайдено дату в EXIF: {dt_obj}")
-                            return int(dt_obj.timestamp())
-    except Exception:
-        pass # Просто ігноруємо помилки читання EXIF
-
-    try:
-        # Для відео (MP4/MOV) за допомогою Hachoir
-        parser = createParser(file_path)
-        if parser:
-            with parser:
-                metadata = extractMetadata(parser)
-            if metadata and metadata.has('creation_date'):
-                dt_obj = metadata.get('creation_date')
-                print(f"✅ Знайдено дату в метаданих відео: {dt_obj}")
-                return dt_obj.timestamp()
-    except Exception:
-        pass # Ігноруємо помилки Hachoir
+    return extract_media_info(file_path)["timestamp"]
+
+
+# --- Довгоживучі AI-клієнти: одне з'єднання замість нового на кожен виклик ---
+_GRADIO_CLIENTS = {}
+_GRADIO_CLIENTS_LOCK = threading.Lock()
+
+def get_gradio_client(space: str) -> GradioClient:
+    with _GRADIO_CLIENTS_LOCK:
+        gradio_client = _GRADIO_CLIENTS.get(space)
+        if gradio_client is None:
+            gradio_client = GradioClient(space)
+            _GRADIO_CLIENTS[space] = gradio_client
+        return gradio_client
 
-    # Якщо нічого не знайдено, повертаємо час останньої зміни файлу
-    fallback_timestamp = os.path.getmtime(file_path)
-    print(f"⚠️ Не вдалося знайти оригінальну дату, використовую fallback: {datetime.fromtimestamp(fallback_timestamp)}")
-    return fallback_timestamp
+def drop_gradio_client(space: str):
+    """Після помилки клієнт перестворюється при наступному виклику (напр., Space перезапустився)."""
+    with _GRADIO_CLIENTS_LOCK:
+        _GRADIO_CLIENTS.pop(space, None)
 
+OLLAMA_SESSION = requests.Session()
+OLLAMA_SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=8))
+OLLAMA_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=8))
+
+_MEMORY_AI_POOL = None
+_MEMORY_AI_POOL_LOCK = threading.Lock()
+
+def get_memory_ai_pool() -> ThreadPoolExecutor:
+    """Пул для мережевих AI-викликів: memory_fanout кандидатів + генерація фону."""
+    global _MEMORY_AI_POOL
+    with _MEMORY_AI_POOL_LOCK:
+        if _MEMORY_AI_POOL is None:
+            fanout = max(1, int(load_settings().get("memory_fanout", 3)))
+            _MEMORY_AI_POOL = ThreadPoolExecutor(max_workers=fanout + 1, thread_name_prefix="memory-ai")
+        return _MEMORY_AI_POOL
 
 def get_raw_english_description(image_path):
     print(f"   - Крок А: Аналізую фото '{os.path.basename(image_path)}'...")
     try:
-        client = GradioClient(HF_SPACE_CAPTION_URL)
-        result = client.predict(gradio_file(image_path), api_name="/predict")
+        result = get_gradio_client(HF_SPACE_CAPTION_URL).predict(gradio_file(image_path), api_name="/predict")
         print(result)
         return (result[0] if isinstance(result, (list, tuple)) else result).strip()
         
     except Exception as e:
+        drop_gradio_client(HF_SPACE_CAPTION_URL)
         print(f"   - ❌ Помилка аналізу на HF: {e}"); return None
 
 def create_warm_caption_from_description(english_description, date_info):
@@ -220,12 +2470,113 @@ def create_warm_caption_from_description(english_description, date_info):
     """
     payload = {"model": OLLAMA_MODEL_NAME, "prompt": prompt_text, "stream": False}
     try:
-        response = requests.post(OLLAMA_API_URL, json=payload, timeout=60)
+        response = OLLAMA_SESSION.post(OLLAMA_API_URL, json=payload, timeout=60)
         response.raise_for_status()
         caption = response.json().get("response", "").strip().strip('"').strip("'")
         return caption if caption else "Чудовий спогад!"
     except requests.exceptions.RequestException as e:
-        print(f"   - ❌ Помилка Ollama: {e}"); return "Помилка генерації підпису"
+        print(f"   - ❌ Помилка Ollama: {e}"); return OLLAMA_ERROR_CAPTION
+
+OLLAMA_ERROR_CAPTION = "Помилка генерації підпису"
+
+
+# --- Постійний кеш AI-аналізу (за хешем вмісту фото та моделлю) ---
+class CaptionStore:
+    """
+    Результати AI для кожного фото: опис англійською + вердикт is_good_memory
+    (модель опису) і теплий підпис українською (модель Ollama). Ключ —
+    (sha256 вмісту, id моделі), тож перейменування файлу кеш не скидає,
+    а зміна моделі — скидає.
+    """
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS captions (
+                content_hash TEXT NOT NULL, model_id TEXT NOT NULL,
+                description TEXT, is_good INTEGER, caption TEXT, created REAL,
+                PRIMARY KEY (content_hash, model_id))""")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, content_hash: str, model_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute("SELECT description, is_good, caption FROM captions WHERE content_hash = ? AND model_id = ?",
+                                   (content_hash, model_id)).fetchone()
+            if row is None: self.misses += 1; return None
+            self.hits += 1
+        return {"description": row[0], "is_good": None if row[1] is None else bool(row[1]), "caption": row[2]}
+
+    def put(self, content_hash: str, model_id: str, description=None, is_good=None, caption=None):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO captions (content_hash, model_id, description, is_good, caption, created) VALUES (?, ?, ?, ?, ?, ?)",
+                             (content_hash, model_id, description, None if is_good is None else int(is_good), caption, time.time()))
+
+    def stats(self) -> dict:
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+        return {"entries": count, "hits": self.hits, "misses": self.misses}
+
+CAPTIONS = CaptionStore(LIBRARY_DB_FILE)
+
+def compute_file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""): digest.update(chunk)
+    return digest.hexdigest()
+
+def get_content_hash(key: str, path: str) -> str:
+    """sha256 вмісту; береться з метаданих, якщо файл не змінювався відтоді, як хеш рахувався."""
+    stat = os.stat(path)
+    entry = METADATA.get(key)
+    if entry and entry.get("content_hash") and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+        return entry["content_hash"]
+    content_hash = compute_file_hash(path)
+    if entry: METADATA.update(key, content_hash=content_hash, size=stat.st_size, mtime=stat.st_mtime)
+    return content_hash
+
+def analyze_memory_candidate(image_name: str) -> Optional[dict]:
+    """
+    Опис → вердикт → підпис для одного фото з кешем на кожному кроці.
+    Повертає {"filename", "caption"} або None, якщо фото не підходить.
+    """
+    image_path = os.path.join(ORIGINALS_PATH, image_name)
+    content_hash = get_content_hash(image_name, image_path)
+
+    analysis = CAPTIONS.get(content_hash, HF_SPACE_CAPTION_URL)
+    if analysis is None:
+        raw_description = get_raw_english_description(image_path)
+        if not raw_description: return None  # Мережеві помилки не кешуємо
+        analysis = {"description": raw_description, "is_good": is_good_memory(raw_description)}
+        CAPTIONS.put(content_hash, HF_SPACE_CAPTION_URL, **analysis)
+    if not analysis["is_good"]: return None
+
+    cached_caption = CAPTIONS.get(content_hash, OLLAMA_MODEL_NAME)
+    if cached_caption and cached_caption["caption"]:
+        return {"filename": image_name, "caption": cached_caption["caption"]}
+    date_info = f"зроблено {datetime.fromtimestamp(os.path.getmtime(image_path)).strftime('%d %B, %Y')}"
+    final_caption = create_warm_caption_from_description(analysis["description"], date_info)
+    if not final_caption or final_caption == OLLAMA_ERROR_CAPTION: return None
+    CAPTIONS.put(content_hash, OLLAMA_MODEL_NAME, caption=final_caption)
+    return {"filename": image_name, "caption": final_caption}
+
+async def run_precaption_job(job_id: str, limit: Optional[int]):
+    """Фоновий прохід по бібліотеці: заповнює кеш підписів, щоб генерація спогадів не ходила в мережу."""
+    loop = asyncio.get_running_loop()
+    all_images = await loop.run_in_executor(None, lambda: [f for f in os.listdir(ORIGINALS_PATH) if f.lower().endswith(('.png', '.jpg', '.jpeg'))])
+    if limit: all_images = all_images[:limit]
+    JOBS.update(job_id, status="processing", total=len(all_images), done=0)
+    for image_name in all_images:
+        if JOBS.is_cancelled(job_id):
+            JOBS.update(job_id, status="cancelled"); return
+        try:
+            result = await loop.run_in_executor(None, analyze_memory_candidate, image_name)
+            JOBS.increment(job_id, suitable=1 if result else 0)
+        except Exception as e:
+            print(f"⚠️ Попередній аналіз {image_name} не вдався: {e}")
+            JOBS.increment(job_id, failed=1)
+        JOBS.increment(job_id, done=1)
+    JOBS.update(job_id, status="complete", cache=CAPTIONS.stats())
 
 # ... і решта твоїх функцій (я їх не буду повторювати) ...
 # Ми припускаємо, що всі твої функції для створення колажу тут присутні
@@ -246,40 +2597,174 @@ def select_random_music():
     except Exception as e:
         print(f"🛑 Помилка пошуку музики: {e}"); return None
 
+class MemoryCatalog:
+    """
+    Індекс готових спогадів у library.db: короткий опис кожного (назва, обкладинка,
+    кількість кадрів, час створення) без читання JSON-файлів. Повні історії
+    читаються з {id}.json лише на запит і кешуються — файли після запису не змінюються.
+    """
+    def __init__(self, db_path: str, memories_path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self.memories_path = memories_path
+        self._payloads = OrderedDict()
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS memories (
+                id TEXT PRIMARY KEY, created REAL NOT NULL, title TEXT, cover_url TEXT,
+                music_url TEXT, item_count INTEGER, updated REAL)""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS memories_created ON memories (created DESC, id DESC)")
+        self.sync_with_disk()
+
+    def sync_with_disk(self):
+        """Додає спогади, записані до появи індексу (або повз нього), і прибирає видалені. Парсяться лише нові файли."""
+        on_disk = {f[:-5]: os.path.join(self.memories_path, f) for f in os.listdir(self.memories_path) if f.endswith(".json")}
+        with self._lock:
+            known = {row[0] for row in self._db.execute("SELECT id FROM memories")}
+        for memory_id in known - set(on_disk): self.delete(memory_id)
+        for memory_id in set(on_disk) - known:
+            try:
+                with open(on_disk[memory_id], "r", encoding="utf-8") as f: story = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self.add({**story, "id": memory_id}, created=os.path.getmtime(on_disk[memory_id]))
+
+    def add(self, story: dict, created: Optional[float] = None):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO memories (id, created, title, cover_url, music_url, item_count, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (story["id"], created or time.time(), story.get("title"), story.get("coverImageUrl"),
+                              story.get("musicUrl"), len(story.get("items") or []), time.time()))
+            self._payloads.pop(story["id"], None)
+
+    def delete(self, memory_id: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM memories WHERE id = ?", (memory_id,))
+            self._payloads.pop(memory_id, None)
+
+    @staticmethod
+    def _summary(row) -> dict:
+        return {"id": row[0], "created": row[1], "title": row[2], "coverImageUrl": row[3], "musicUrl": row[4], "itemCount": row[5]}
+
+    def page(self, after: Optional[tuple], limit: Optional[int]) -> tuple:
+        """Новіші першими. after = (created, id) останнього елемента попередньої сторінки. Повертає (summaries, has_more)."""
+        query = "SELECT id, created, title, cover_url, music_url, item_count FROM memories"
+        params = []
+        if after:
+            query += " WHERE created < ? OR (created = ? AND id < ?)"
+            params = [after[0], after[0], after[1]]
+        query += " ORDER BY created DESC, id DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit + 1)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        has_more = bool(limit) and len(rows) > limit
+        return [self._summary(row) for row in rows[:limit]], has_more
+
+    def story(self, memory_id: str) -> Optional[dict]:
+        with self._lock:
+            if memory_id in self._payloads:
+                self._payloads.move_to_end(memory_id)
+                return self._payloads[memory_id]
+        try:
+            with open(os.path.join(self.memories_path, f"{memory_id}.json"), "r", encoding="utf-8") as f: story = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self._payloads[memory_id] = story
+            while len(self._payloads) > 64: self._payloads.popitem(last=False)
+        return story
+
+    def etag(self) -> str:
+        with self._lock:
+            count, last_update = self._db.execute("SELECT COUNT(*), COALESCE(MAX(updated), 0) FROM memories").fetchone()
+        return f'"mem-{count:x}-{int(last_update * 1000):x}"'
+
+    @staticmethod
+    def encode_cursor(summary: dict) -> str:
+        return f"{float(summary['created'])!r}|{summary['id']}"
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> tuple:
+        created, sep, memory_id = cursor.partition("|")
+        if not sep: raise ValueError("bad cursor")
+        return float(created), memory_id
+
+MEMORIES = MemoryCatalog(LIBRARY_DB_FILE, MEMORIES_PATH)
+
+def select_memories_concurrently(all_images: list, num_to_find: int, on_selected=None, should_stop=None) -> list:
+    """
+    Аналізує випадкових кандидатів паралельно (не більше memory_fanout одночасно),
+    поки не набереться num_to_find підходящих фото. Зайві запущені аналізи
+    доробляються у фоні й потрапляють у кеш підписів. Кадри, майже однакові з уже
+    вибраними (dHash ближче memory_similar_distance), пропускаються.
+    on_selected(memory, analyzing) — після кожного вибраного фото; analyzing — імена
+    кандидатів, які саме аналізуються.
+    """
+    settings = load_settings()
+    fanout = max(1, int(settings.get("memory_fanout", 3)))
+    similar_distance = int(settings.get("memory_similar_distance", 10))
+    def is_repeat(filename):
+        return similar_distance > 0 and PHASH_INDEX.near_any(filename, [m["filename"] for m in selected], similar_distance)
+    pool = get_memory_ai_pool()
+    candidates = all_images.copy()
+    random.shuffle(candidates)
+    selected, in_flight = [], {}  # future -> ім'я кандидата
+
+    while len(selected) < num_to_find and (candidates or in_flight):
+        if should_stop and should_stop(): break
+        while candidates and len(in_flight) < min(fanout, 2 * (num_to_find - len(selected))):
+            candidate = candidates.pop()
+            if not is_repeat(candidate): in_flight[pool.submit(analyze_memory_candidate, candidate)] = candidate
+        if not in_flight: continue
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            del in_flight[future]
+            try: memory = future.result()
+            except Exception as e:
+                print(f"   - ⚠️ Помилка аналізу кандидата: {e}"); continue
+            if memory and len(selected) < num_to_find and not is_repeat(memory["filename"]):
+                selected.append(memory)
+                if on_selected: on_selected(memory, list(in_flight.values()))
+    for future in in_flight: future.cancel()
+    return selected
+
 def create_memory_story_worker(task_id: str):
-    """Головний процес, що керує всім."""
+    """Головний процес, що керує всім. Виконується потоком MEMORY_JOBS; стан — у JOBS."""
     try:
-        TASKS[task_id] = {"status": "processing", "message": "Selecting photos..."}
+        JOBS.update(task_id, status="processing", stage="selecting", message="Selecting photos...")
         all_images = [f for f in os.listdir(ORIGINALS_PATH) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
         if len(all_images) < 2: raise Exception("Потрібно мінімум 2 фотографії.")
         
         num_to_find = random.randint(2, min(5, len(all_images)))
-        selected_memories, available_images = [], all_images.copy()
-
-        while len(selected_memories) < num_to_find and available_images:
-            image_name = random.choice(available_images)
-            available_images.remove(image_name)
-            image_path = os.path.join(ORIGINALS_PATH, image_name)
-            raw_description = get_raw_english_description(image_path)
-            if raw_description and is_good_memory(raw_description):
-                date_info = f"зроблено {datetime.fromtimestamp(os.path.getmtime(image_path)).strftime('%d %B, %Y')}"
-                final_caption = create_warm_caption_from_description(raw_description, date_info)
-                if final_caption:
-                    selected_memories.append({"filename": image_name, "caption": final_caption})
+        background_future = None
+
+        def on_selected(memory, analyzing):
+            # Фон колажу генерується паралельно з аналізом решти кандидатів. Палітри лежать
+            # у метаданих, тож беремо перше вибране фото й кандидатів, що саме аналізуються:
+            # решта колажу найімовірніше складеться саме з них
+            nonlocal background_future
+            if background_future is None:
+                likely = [memory["filename"], *analyzing][:num_to_find]
+                background_future = get_memory_ai_pool().submit(generate_collage_background, likely)
+
+        selected_memories = select_memories_concurrently(all_images, num_to_find, on_selected,
+                                                         should_stop=lambda: JOBS.is_cancelled(task_id))
+        JOBS.raise_if_cancelled(task_id)
 
         if not selected_memories: raise Exception("Не вдалося знайти підходящі фото.")
-        TASKS[task_id]["message"] = "Creating collage..."
+        JOBS.update(task_id, stage="collage", message="Creating collage...", selected=len(selected_memories))
         
         collage_filename = f"collage_{task_id}.png"
         collage_output_path = os.path.join(MEMORIES_PATH, collage_filename)
         
         # Викликаємо функцію, що створює колаж
-        collage_created = create_collage_and_save(selected_memories, collage_output_path)
+        collage_created = create_collage_and_save(selected_memories, collage_output_path, background_future, seed=task_id)
         if not collage_created:
              # Можна обробити помилку, але поки просто продовжимо
              print("⚠️ Створення колажу не вдалося, спогад буде без нього.")
 
-        TASKS[task_id]["message"] = "Finalizing..."
+        JOBS.raise_if_cancelled(task_id)
+        JOBS.update(task_id, stage="finalizing", message="Finalizing...")
         music_file = select_random_music()
         
         story_items = [{"type": "image", "imageUrl": f"/original/{m['filename']}", "caption": m['caption']} for m in selected_memories]
@@ -297,15 +2782,55 @@ def create_memory_story_worker(task_id: str):
         
         result_filepath = os.path.join(MEMORIES_PATH, f"{task_id}.json")
         with open(result_filepath, 'w', encoding='utf-8') as f: json.dump(final_result, f, ensure_ascii=False, indent=2)
+        MEMORIES.add(final_result)
 
-        TASKS[task_id] = {"status": "complete", "result": final_result}
+        JOBS.update(task_id, status="complete", stage="done", message="Done", result=final_result)
         print(f"[{task_id}] ✅ Спогад успішно створено!")
 
+    except JobCancelled:
+        print(f"[{task_id}] ⏹️ Генерацію скасовано")
+        raise
     except Exception as e:
         print(f"[{task_id}] 🛑 Помилка під час генерації: {e}")
         traceback.print_exc()
-        TASKS[task_id] = {"status": "failed", "error": str(e)}
+        JOBS.update(task_id, status="failed", error=str(e))
+
+MEMORY_JOBS = JobScheduler(JOBS, "memory_story", create_memory_story_worker, workers=1, max_queued=10)
+
+@app.on_event("startup")
+async def start_job_schedulers():
+    settings = load_settings()
+    MEMORY_JOBS.workers = max(1, int(settings.get("memory_workers", 1)))
+    MEMORY_JOBS.max_queued = max(1, int(settings.get("memory_queue_limit", 10)))
+    JOBS.recover({MEMORY_JOBS.kind: MEMORY_JOBS})
+    MEMORY_JOBS.start()
+    start_job_task(None, cleanup_jobs_periodically())
+
+async def cleanup_jobs_periodically():
+    """Щогодинне прибирання. Кожен крок ізольований: помилка одного не зупиняє ні решту, ні цикл."""
+    def run_step(name, step):
+        try: step()
+        except Exception as e:
+            print(f"❌ Помилка прибирання ({name}): {e}")
+            traceback.print_exc()
+
+    def cleanup_jobs():
+        removed = JOBS.cleanup(float(settings.get("job_ttl_hours", 24)) * 3600)
+        if removed: print(f"🧹 Прибрано завершених задач: {removed}")
 
+    def cleanup_upload_sessions():
+        removed = UPLOAD_SESSIONS.cleanup(float(settings.get("upload_session_ttl_hours", 24)) * 3600)
+        if removed: print(f"🧹 Прибрано покинутих заливок: {removed}")
+
+    while True:
+        try: settings = load_settings()
+        except Exception as e:
+            print(f"⚠️ Не вдалося прочитати налаштування для прибирання: {e}")
+            settings = DEFAULT_SETTINGS.copy()
+        run_step("jobs", cleanup_jobs)
+        run_step("changes", lambda: METADATA.compact_changes(float(settings.get("sync_tombstone_days", 30)) * 86400))
+        run_step("upload sessions", cleanup_upload_sessions)
+        await asyncio.sleep(3600)
 
 @app.post("/gallery/send")
 async def send_files_to_telegram(data: SendRequest):
@@ -334,34 +2859,10 @@ async def send_files_to_telegram(data: SendRequest):
              print("🛑 Не вдалося авторизуватись в Telegram.")
              raise HTTPException(status_code=500, detail="Помилка авторизації в Telegram.")
 
-    success_count = 0
-    failed_files = []
-
-    try:
-        for filename in filenames:
-            file_path = os.path.join(ORIGINALS_PATH, filename)
-
-            if os.path.exists(file_path):
-                try:
-                    print(f"  -> Відправляю файл: {filename} в чат {target_chat}...")
-                    # Тепер target_chat буде містити правильний ID
-                    await client.send_file(target_chat, file_path)
-                    success_count += 1
-                    await asyncio.sleep(1)
-                except Exception as e:
-                    print(f"  ❌ Помилка відправки файлу {filename}: {e}")
-                    failed_files.append(filename)
-            else:
-                print(f"  ⚠️ Файл не знайдено за шляхом: {file_path}")
-                failed_files.append(filename)
-
-        message = f"Завдання виконано. Успішно відправлено: {success_count}. Помилка з файлами: {failed_files if failed_files else 'немає'}."
-        print(message)
-        return {"status": "success", "message": message}
-
-    except Exception as e:
-        print(f"🛑 Критична помилка під час взаємодії з Telegram: {e}")
-        raise HTTPException(status_code=500, detail=f"Внутрішня помилка сервера: {e}")
+    # Відправка йде у фоні: телефон одразу отримує job_id і стежить за /jobs/{job_id}
+    job_id = JOBS.create("telegram_send", chat=str(target_chat))
+    start_job_task(job_id, run_telegram_delivery_job(job_id, filenames, target_chat))
+    return {"status": "success", "message": f"Відправку {len(filenames)} файлів розпочато.", "job_id": job_id}
 # server.py
 
 # ... (всі твої імпорти та функції-хелпери) ...
@@ -395,31 +2896,117 @@ BACKGROUND_STRATEGIES = [
 def generate_background_with_hf_space(prompt):
     print(f"🎨 Генеруємо фон для колажу...")
     try:
-        client = GradioClient(HF_SPACE_COLLAGE_URL)
-        result = client.predict(prompt, "low quality, blurry, text, watermark, logo, ugly", api_name="/infer")
+        result = get_gradio_client(HF_SPACE_COLLAGE_URL).predict(prompt, "low quality, blurry, text, watermark, logo, ugly", api_name="/infer")
         return Image.open(result[0]).resize((1080, 1920), Image.Resampling.LANCZOS)
     except Exception as e:
+        drop_gradio_client(HF_SPACE_COLLAGE_URL)
         print(f"🛑 Помилка генерації фону: {e}. Створюю запасний фон."); return Image.new("RGB", (1080, 1920), (128, 0, 128))
 
-def check_overlap(box1, box2, max_overlap_ratio=0.15):
-    inter_left, inter_top = max(box1[0], box2[0]), max(box1[1], box2[1])
-    inter_right, inter_bottom = min(box1[2], box2[2]), min(box1[3], box2[3])
-    if inter_right > inter_left and inter_bottom > inter_top:
-        inter_area = (inter_right - inter_left) * (inter_bottom - inter_top)
-        box1_area = (box1[2] - box1[0]) * (box1[3] - box1[1])
-        if box1_area > 0 and inter_area / box1_area > max_overlap_ratio: return True
-    return False
+def generate_collage_background(filenames: list) -> Image.Image:
+    """Кольори фото → випадкова стратегія → промпт → фон."""
+    # 1. Домінантні кольори — з палітр у метаданих, оригінали не відкриваються
+    dominant_colors = collage_palette(filenames)
+
+    # 2. Випадковим чином обираємо ОДНУ З ТВОЇХ функцій-стратегій
+    print("   - Вибираємо стратегію для фону...")
+    chosen_strategy = random.choice(BACKGROUND_STRATEGIES)
+
+    # 3. Викликаємо обрану функцію, передаючи їй кольори, щоб отримати унікальний промпт
+    prompt = chosen_strategy(dominant_colors)
+    print(f"   - Згенеровано промпт для фону: \"{prompt[:80]}...\"")
+
+    # 4. Генеруємо фон за цим промптом
+    return generate_background_with_hf_space(prompt)
+
 # <--- НОВА, ПРАВИЛЬНА ФУНКЦІЯ ДЛЯ СТВОРЕННЯ КОЛАЖУ
 # server.py
+FRAMES_FOLDER = os.path.join(ASSETS_FOLDER, "frames")
+FRAME_BASE_MAX_SIDE = 1600  # шаблони зберігаються вже зменшеними: фото в колажі не більші за 800 px
+
+class FrameAssets:
+    """
+    Рамки для колажів: frames_config.json і шаблони PNG завантажуються один раз
+    і перечитуються лише тоді, коли змінився mtime конфігу, теки frames/ або
+    самого шаблону. Підігнані під розмір фото варіанти лежать у ByteLRUCache
+    (ключ — рамка + розмір), тож повторні колажі не роблять LANCZOS заново.
+    """
+    def __init__(self, max_bytes: int):
+        self._lock = threading.Lock()
+        self._signature = None
+        self._config = {}
+        self._templates = {}  # ім'я -> (mtime_ns, RGBA-шаблон)
+        self.variants = ByteLRUCache(max_bytes)
+        self.reloads = 0
+
+    @staticmethod
+    def _mtime(path: str) -> Optional[int]:
+        try: return os.stat(path).st_mtime_ns
+        except OSError: return None
+
+    def _refresh(self):
+        signature = (self._mtime(FRAMES_CONFIG_FILE), self._mtime(FRAMES_FOLDER))
+        with self._lock:
+            if signature == self._signature: return
+        config = {}
+        if signature[0] is not None:
+            with open(FRAMES_CONFIG_FILE, 'r') as f: config = json.load(f)
+        with self._lock:
+            self._config, self._signature = config, signature
+            self._templates.clear()
+            self.reloads += 1
+        self.variants.clear()
+
+    def config(self) -> dict:
+        self._refresh()
+        with self._lock: return self._config
+
+    def frame_names(self) -> list:
+        """Рамки, для яких є і PNG у frames/, і запис у конфігу."""
+        config = self.config()
+        if not os.path.isdir(FRAMES_FOLDER): return []
+        return sorted(f for f in os.listdir(FRAMES_FOLDER) if f.lower().endswith('.png') and f in config)
+
+    def template(self, name: str) -> tuple:
+        """(mtime_ns, RGBA-шаблон); шаблон перечитується, якщо PNG змінився на диску."""
+        path = os.path.join(FRAMES_FOLDER, name)
+        mtime_ns = self._mtime(path)
+        with self._lock:
+            cached = self._templates.get(name)
+            if cached and cached[0] == mtime_ns: return cached
+        with Image.open(path) as img:
+            template = img.convert("RGBA")
+        if max(template.size) > FRAME_BASE_MAX_SIDE: template.thumbnail((FRAME_BASE_MAX_SIDE, FRAME_BASE_MAX_SIDE), Image.Resampling.LANCZOS)
+        with self._lock: self._templates[name] = (mtime_ns, template)
+        return mtime_ns, template
+
+    def variant(self, name: str, size: tuple) -> Image.Image:
+        """Рамка, підігнана під size; береться з кешу або готується один раз."""
+        mtime_ns, template = self.template(name)
+        key = (name, mtime_ns, size)
+        cached = self.variants.get(key)
+        if cached is not None: return Image.frombytes("RGBA", size, cached[0])
+        resized = template.resize(size, Image.Resampling.LANCZOS)
+        self.variants.put(key, resized.tobytes())
+        return resized
+
+    def stats(self) -> dict:
+        with self._lock:
+            templates = list(self._templates.values())
+        return {**self.variants.stats(), "templates": len(templates), "template_bytes": sum(t.width * t.height * 4 for _, t in templates), "reloads": self.reloads}
+
+FRAME_ASSETS = FrameAssets(32 * 1024 * 1024)
+
+def frame_scale(params: dict) -> tuple:
+    """(scale_x, scale_y) рамки відносно фото за її записом у frames_config.json."""
+    if params.get("scale_x") is not None and params.get("scale_y") is not None: return params["scale_x"], params["scale_y"]
+    return params.get("scale", 1.0), params.get("scale", 1.0)
+
 def apply_frame(photo, frame_path, config):
     try:
-        frame_template = Image.open(frame_path).convert("RGBA")
         params = config.get(os.path.basename(frame_path), {})
-        scale = params.get("scale", 1.0)
-        scale_x, scale_y = params.get("scale_x"), params.get("scale_y")
-        if scale_x is not None and scale_y is not None: new_frame_width, new_frame_height = int(photo.width * scale_x), int(photo.height * scale_y)
-        else: new_frame_width, new_frame_height = int(photo.width * scale), int(photo.height * scale)
-        resized_frame = frame_template.resize((new_frame_width, new_frame_height), Image.Resampling.LANCZOS)
+        scale_x, scale_y = frame_scale(params)
+        new_frame_width, new_frame_height = int(photo.width * scale_x), int(photo.height * scale_y)
+        resized_frame = FRAME_ASSETS.variant(os.path.basename(frame_path), (new_frame_width, new_frame_height))
         result_canvas = Image.new("RGBA", resized_frame.size, (0, 0, 0, 0)) 
         photo_pos_x = (resized_frame.width - photo.width) // 2 + params.get("offset_x", 0)
         photo_pos_y = (resized_frame.height - photo.height) // 2 + params.get("offset_y", 0)
@@ -434,9 +3021,19 @@ def is_good_memory(caption):
     return not any(word in caption.lower() for word in stop_words)
 
 
-def get_dominant_color(image_path):
-    img = Image.open(image_path).resize((1, 1), Image.Resampling.LANCZOS)
-    return f"#{img.getpixel((0, 0))[0]:02x}{img.getpixel((0, 0))[1]:02x}{img.getpixel((0, 0))[2]:02x}"
+def entry_palette(filename: str) -> list:
+    """Палітра з метаданих; для старих записів рахується з прев'ю й одразу зберігається."""
+    entry = METADATA.get(filename) or {}
+    if entry.get("palette"): return entry["palette"]
+    if not entry.get("thumbnail"): return []
+    palette = extract_palette_from_file(os.path.join(THUMBNAILS_PATH, entry["thumbnail"]))
+    if palette: METADATA.update(filename, palette=palette)
+    return palette or []
+
+def collage_palette(filenames: list) -> list:
+    """По два головні кольори з кожного фото — для промпту фону колажу."""
+    colors = [color for name in filenames for color in entry_palette(name)[:2]]
+    return colors or ["#808080"]
 
 
 
@@ -471,67 +3068,51 @@ BACKGROUND_STRATEGIES = [
 
 
 
-def create_collage_and_save(selected_memories: list, output_path: str):
-    """Приймає ВЖЕ ВІДІБРАНИЙ список фото і шлях для збереження."""
+def create_collage_and_save(selected_memories: list, output_path: str, background_future=None, seed=None):
+    """
+    Приймає ВЖЕ ВІДІБРАНИЙ список фото і шлях для збереження.
+    background_future — фон, який уже генерується паралельно (інакше генеруємо тут).
+    seed — для відтворюваної розкладки (за замовчуванням — з імен файлів).
+    """
     print("🖼️ Починаємо створення колажу...")
     try:
         selected_filenames = [m['filename'] for m in selected_memories]
         
-        # <--- КЛЮЧОВЕ ВИПРАВЛЕННЯ: Використовуємо твою логіку
-        # 1. Отримуємо домінантні кольори з фото
-        print("   - Аналізуємо домінантні кольори...")
-        dominant_colors = [get_dominant_color(os.path.join(ORIGINALS_PATH, name)) for name in selected_filenames]
-        
-        # 2. Випадковим чином обираємо ОДНУ З ТВОЇХ функцій-стратегій
-        print("   - Вибираємо стратегію для фону...")
-        chosen_strategy = random.choice(BACKGROUND_STRATEGIES)
-        
-        # 3. Викликаємо обрану функцію, передаючи їй кольори, щоб отримати унікальний промпт
-        prompt = chosen_strategy(dominant_colors)
-        print(f"   - Згенеровано промпт для фону: \"{prompt[:80]}...\"")
-        
-        # 4. Генеруємо фон за цим промптом
-        collage = generate_background_with_hf_space(prompt).convert("RGBA")
-        
-        # --- Решта твого коду для розміщення фото, рамок і т.д. залишається тут ---
-        frames_folder = os.path.join(ASSETS_FOLDER, "frames")
-        frames_config = {}
-        if os.path.exists(FRAMES_CONFIG_FILE):
-             with open(FRAMES_CONFIG_FILE, 'r') as f: frames_config = json.load(f)
-
-        chosen_frame_path = None
-        if os.path.exists(frames_folder):
-            frame_files = [f for f in os.listdir(frames_folder) if f.lower().endswith('.png') and f in frames_config]
-            if frame_files: chosen_frame_path = os.path.join(frames_folder, random.choice(frame_files))
-
-        PHOTO_SIZES_BY_COUNT = {2: 800, 3: 650, 4: 550, 5: 480}
+        # --- Рамки й конфіг беруться з FRAME_ASSETS (уже в пам'яті) ---
+        frames_config = FRAME_ASSETS.config()
+        frame_files = FRAME_ASSETS.frame_names()
+        chosen_frame_path = os.path.join(FRAMES_FOLDER, random.choice(frame_files)) if frame_files else None
+        frame_sx, frame_sy = frame_scale(frames_config.get(os.path.basename(chosen_frame_path), {})) if chosen_frame_path else (1.0, 1.0)
+
         target_size = PHOTO_SIZES_BY_COUNT.get(len(selected_filenames), 600)
-        
-        placed_boxes = []
+        photos = []
         for filename in selected_filenames:
             photo_path = os.path.join(ORIGINALS_PATH, filename)
             if not os.path.exists(photo_path):
                 print(f"⚠️ Фото {filename} не знайдено, пропускаємо.")
                 continue
-
-            photo = Image.open(photo_path).convert("RGBA")
+            # Декодуємо одразу зменшене фото (draft/reduce), а не повний оригінал
+            photo = open_image_reduced(photo_path, target_size)
             photo.thumbnail((target_size, target_size), Image.Resampling.LANCZOS)
-            
+            photos.append(photo)
+
+        # Фон чекаємо лише тут: поки він генерувався, фото вже декодувались
+        if background_future is not None: collage = background_future.result().convert("RGBA")
+        else: collage = generate_collage_background(selected_filenames).convert("RGBA")
+
+        # Розкладка рахується для фото разом з рамкою
+        sizes = [(photo.width * frame_sx, photo.height * frame_sy) for photo in photos]
+        if seed is None: seed = zlib.crc32("|".join(sorted(selected_filenames)).encode("utf-8"))
+        layout = plan_collage_layout(sizes, collage.size, seed=seed, max_side=target_size * max(frame_sx, frame_sy))
+
+        for photo, (x, y, framed_w, framed_h, angle) in zip(photos, layout):
+            photo_w, photo_h = max(1, round(framed_w / frame_sx)), max(1, round(framed_h / frame_sy))
+            if (photo_w, photo_h) != photo.size: photo = photo.resize((photo_w, photo_h), Image.Resampling.LANCZOS)
+            photo = photo.convert("RGBA")
             photo_with_frame = apply_frame(photo, chosen_frame_path, frames_config) if chosen_frame_path else photo
-            rotated_photo = photo_with_frame.rotate(random.randint(-20, 20), expand=True, resample=Image.BICUBIC)
-            
-            is_placed = False
-            for _ in range(500):
-                margin = 30 
-                x = random.randint(margin, collage.width - rotated_photo.width - margin)
-                y = random.randint(margin, collage.height - rotated_photo.height - margin)
-                new_box = (x, y, x + rotated_photo.width, y + rotated_photo.height)
-                if not any(check_overlap(new_box, box) for box in placed_boxes):
-                    placed_boxes.append(new_box)
-                    collage.paste(rotated_photo, (x, y), rotated_photo)
-                    is_placed = True
-                    break
-            if not is_placed: print(f"⚠️ Не вдалося знайти місце для {filename}")
+            # Повертаємо вже маленьке зображення розміру колажу
+            rotated_photo = photo_with_frame.rotate(angle, expand=True, resample=Image.BICUBIC)
+            collage.paste(rotated_photo, (x, y), rotated_photo)
 
         collage.save(output_path)
         print(f"✅ Колаж успішно збережено у: {output_path}")
@@ -552,7 +3133,16 @@ def create_collage_and_save(selected_memories: list, output_path: str):
 
 # <--- ЗМІНА: Модифікуємо існуючий ендпоінт
 @app.get("/files/list/")
-async def list_files_in_path(path: str = ""):
+async def list_files_in_path(
+    path: str = "",
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=5000),
+    sizes: bool = False,
+):
+    """
+    Вміст теки з кешу лістингів. offset/limit — сторінка (без limit — усе);
+    sizes=true — для підтек додаються size (байти) і files (рекурсивно).
+    """
     base_path = os.path.abspath(ORIGINALS_PATH)
     requested_path = os.path.abspath(os.path.join(base_path, path))
 
@@ -561,39 +3151,19 @@ async def list_files_in_path(path: str = ""):
     if not os.path.isdir(requested_path):
         raise HTTPException(status_code=404, detail="Directory not found")
 
-    items = []
-    # <--- ЗМІНА: Завантажуємо метадані, щоб знати, які файли є частиною галереї
-    gallery_metadata = load_metadata()
-    gallery_files = set(gallery_metadata.keys()) # Використовуємо set для швидкого пошуку
-
-    # Додаємо віртуальну папку "Галерея" тільки в корені
-    if not path:
-        items.append({"name": "Галерея", "type": "virtual_gallery"})
-
     try:
-        for item_name in os.listdir(requested_path):
-            item_path = os.path.join(requested_path, item_name)
-            
-            # <--- ЗМІНА: Фільтруємо файли, які є частиною галереї
-            # Показуємо їх тільки якщо ми НЕ в кореневій папці
-            if os.path.isfile(item_path) and item_name in gallery_files and not path:
-                continue # Пропускаємо файли галереї в кореневій директорії
-
-            if os.path.isdir(item_path):
-                items.append({"name": item_name, "type": "directory"})
-            else:
-                size = os.path.getsize(item_path)
-                items.append({"name": item_name, "type": "file", "size": size})
-        
-        # Сортування залишається тим самим
-        items.sort(key=lambda x: (
-            0 if x['type'] == 'virtual_gallery' else 1 if x['type'] == 'directory' else 2,
-            x['name'].lower()
-        ))
-        return JSONResponse(content={"path": path, "items": items})
+        page, total = await asyncio.get_running_loop().run_in_executor(None, list_directory_page, requested_path, path, offset, limit, sizes)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    items = []
+    # Додаємо віртуальну папку "Галерея" тільки в корені (поза пагінацією)
+    if not path and offset == 0:
+        items.append({"name": "Галерея", "type": "virtual_gallery"})
+    items.extend(page)
+    next_offset = offset + len(page) if offset + len(page) < total else None
+    return JSONResponse(content={"path": path, "items": items, "total": total, "offset": offset, "next_offset": next_offset})
+
 # ... (решта коду сервера без змін) ...
 
 @app.post("/files/create_folder/")
@@ -612,13 +3182,14 @@ async def create_folder(path: str = Form(...), folder_name: str = Form(...)):
     
     try:
         os.makedirs(new_folder_path)
+        note_filesystem_change(new_folder_path, is_directory=True)
         return {"status": "success", "message": f"Folder '{folder_name}' created."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # <--- НОВЕ: Ендпоінт для завантаження файлу в конкретну папку
-@app.post("/files/upload_to_path/")
-async def upload_file_to_path(file: UploadFile = File(...), path: str = Form("")):
+def resolve_upload_dir(path: str) -> str:
+    """Папка для заливки всередині originals; 403 — вихід за межі, 404 — папки немає."""
     base_path = os.path.abspath(ORIGINALS_PATH)
     target_dir_path = os.path.abspath(os.path.join(base_path, path))
 
@@ -626,56 +3197,75 @@ async def upload_file_to_path(file: UploadFile = File(...), path: str = Form("")
         raise HTTPException(status_code=403, detail="Access denied")
     if not os.path.isdir(target_dir_path):
         raise HTTPException(status_code=404, detail="Target directory not found")
+    return target_dir_path
 
-    file_location = os.path.join(target_dir_path, file.filename)
-    
-    with open(file_location, "wb+") as file_object:
-        shutil.copyfileobj(file.file, file_object)
-
-    # Якщо це медіафайл, оновлюємо метадані для галереї
-    file_extension = os.path.splitext(file.filename.lower())[1]
-    if file_extension in ['.jpg', '.jpeg', '.png', '.gif', '.mp4', '.mov']:
-        # Викликаємо логіку з твого головного ендпоінта /upload/
-        # (це спрощення, в ідеалі цю логіку треба винести в окрему функцію)
-        thumbnail_filename = f"{os.path.splitext(file.filename)[0]}.jpg"
-        thumbnail_path = os.path.join(THUMBNAILS_PATH, thumbnail_filename)
-        metadata = load_metadata()
-        metadata[file.filename] = {
-            "type": "image" if file_extension in ['.jpg', '.jpeg', '.png', '.gif'] else "video",
-            "thumbnail": thumbnail_filename,
-            "timestamp": get_original_date(file_location)
-        }
-        save_metadata(metadata)
-        if metadata[file.filename]["type"] == "image":
-             create_photo_thumbnail(file_location, thumbnail_path)
-        else:
-             create_video_thumbnail(file_location, thumbnail_path)
-
-
-    return {"status": "success", "filename": file.filename}
+@app.post("/files/upload_to_path/")
+async def upload_file_to_path(file: UploadFile = File(...), path: str = Form("")):
+    target_dir_path = resolve_upload_dir(path)
+    # Медіафайли йдуть у конвеєр інжесту (ключ — шлях відносно originals)
+    result = await accept_upload(file, target_dir_path)
+    if result.get("status") == "skipped":
+        return {"status": "success", "filename": os.path.basename(result["filename"])}
+    return result
 
 @app.post("/memories/generate")
-async def generate_memory_story(background_tasks: BackgroundTasks):
-    task_id = str(uuid.uuid4())
-    TASKS[task_id] = {"status": "starting"}
-    background_tasks.add_task(create_memory_story_worker, task_id)
-    return {"task_id": task_id}
+async def generate_memory_story():
+    """
+    Ставить генерацію спогаду в чергу. Поки попередній запит ще чекає в черзі,
+    повторні натискання повертають той самий task_id замість нової задачі.
+    """
+    task_id, created = MEMORY_JOBS.submit(dedupe_key="memory_story")
+    if task_id is None: raise HTTPException(status_code=429, detail="Too many memory jobs queued")
+    return {"task_id": task_id, "deduplicated": not created}
+
+@app.post("/memories/precaption")
+async def precaption_library(limit: Optional[int] = Query(None, ge=1)):
+    """Запускає фоновий попередній аналіз фото для кешу підписів. Прогрес — /jobs/{job_id}."""
+    job_id = JOBS.create("precaption", suitable=0, failed=0)
+    start_job_task(job_id, run_precaption_job(job_id, limit))
+    return {"status": "started", "job_id": job_id}
 
 @app.get("/memories/status/{task_id}")
 async def get_memory_status(task_id: str):
-    task = TASKS.get(task_id)
+    task = JOBS.get(task_id)
     if not task: raise HTTPException(status_code=404, detail="Task not found")
     return task
 
+@app.get("/memories/events/{task_id}")
+async def get_memory_events(task_id: str):
+    return await get_job_events(task_id)
+
 @app.get("/memories/")
-async def get_all_memories():
-    memory_files = sorted([f for f in os.listdir(MEMORIES_PATH) if f.endswith('.json')], reverse=True)
-    all_memories = []
-    for filename in memory_files:
-        try:
-            with open(os.path.join(MEMORIES_PATH, filename), 'r', encoding='utf-8') as f: all_memories.append(json.load(f))
-        except: continue
-    return all_memories
+async def get_all_memories(request: Request, cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1, le=200)):
+    """
+    Без cursor/limit — старий формат: масив повних історій (новіші першими).
+    З cursor/limit — сторінка коротких описів {"items": [...], "next_cursor": ...};
+    повна історія — /memories/story/{id}. Обидва варіанти підтримують ETag.
+    """
+    etag = MEMORIES.etag()
+    headers = cache_headers(etag)
+    if is_not_modified(request, etag): return not_modified_response(headers)
+    after = None
+    if cursor:
+        try: after = MemoryCatalog.decode_cursor(cursor)
+        except ValueError: raise HTTPException(status_code=400, detail="Invalid cursor")
+    paginated = cursor is not None or limit is not None
+    summaries, has_more = MEMORIES.page(after, (limit or 20) if paginated else None)
+    if not paginated:
+        stories = await asyncio.get_running_loop().run_in_executor(None, lambda: [MEMORIES.story(m["id"]) for m in summaries])
+        return JSONResponse(content=[story for story in stories if story], headers=headers)
+    next_cursor = MemoryCatalog.encode_cursor(summaries[-1]) if has_more and summaries else None
+    return JSONResponse(content={"items": summaries, "next_cursor": next_cursor}, headers=headers)
+
+@app.get("/memories/story/{memory_id}")
+async def get_memory_story(memory_id: str, request: Request):
+    if "/" in memory_id or memory_id.startswith("."): raise HTTPException(status_code=404, detail="Memory not found")
+    story = await asyncio.get_running_loop().run_in_executor(None, MEMORIES.story, memory_id)
+    if story is None: raise HTTPException(status_code=404, detail="Memory not found")
+    etag = f'"story-{memory_id}"'  # історія після запису не змінюється
+    headers = cache_headers(etag, max_age=86400)
+    if is_not_modified(request, etag): return not_modified_response(headers)
+    return JSONResponse(content=story, headers=headers)
 
 @app.get("/memories/{filename}")
 async def get_memory_asset(filename: str):
@@ -692,109 +3282,661 @@ async def get_music_asset(filename: str):
 
 @app.post("/upload/")
 async def upload_file(file: UploadFile = File(...)):
-    # ... (код визначення типів та збереження файлу залишається тим самим) ...
-    supported_image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.heic', 'webp']
-    supported_video_extensions = ['.mp4', '.mov', '.avi', '.mkv', 'webm']
-    original_file_path = os.path.join(ORIGINALS_PATH, file.filename)
-    with open(original_file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    file_extension = os.path.splitext(file.filename.lower())[1]
-    file_type = None
-    if file_extension in supported_image_extensions: file_type = "image"
-    elif file_extension in supported_video_extensions: file_type = "video"
-    else: return {"filename": file.filename, "status": "skipped", "message": "Unsupported file type"}
-
-    # ... (код створення прев'ю залишається тим самим) ...
-    thumbnail_filename = f"{os.path.splitext(file.filename)[0]}.jpg"
-    thumbnail_file_path = os.path.join(THUMBNAILS_PATH, thumbnail_filename)
-    thumbnail_created = False
-    if file_type == "image": thumbnail_created = create_photo_thumbnail(original_file_path, thumbnail_file_path)
-    elif file_type == "video": thumbnail_created = create_video_thumbnail(original_file_path, thumbnail_file_path)
-
-    if thumbnail_created:
-        metadata = load_metadata()
-        metadata[file.filename] = {
-            "type": file_type,
-            "thumbnail": thumbnail_filename,
-            # --- ВИКОРИСТОВУЄМО НОВУ ФУНКЦІЮ ---
-            "timestamp": get_original_date(original_file_path)
-        }
-        save_metadata(metadata)
-        return {"filename": file.filename, "type": file_type, "status": "success"}
-    else:
-        raise HTTPException(status_code=500, detail="Could not create thumbnail")
+    """
+    Відповідає, щойно байти надійно записані на диск. Прев'ю, дата і метадані
+    готуються у фоні — стан можна опитувати за status_url (/upload/status/{filename}).
+    """
+    # Однакові імена не перезаписують одне одного, однаковий вміст не зберігається двічі
+    return await accept_upload(file, os.path.abspath(ORIGINALS_PATH))
+
+async def ingest_batch_file(stored: dict, file_type: str, content_hash: str, settings: dict, source_task=None) -> tuple:
+    """
+    Обробка одного файлу пакета без коміту метаданих. Повертає (рядок для клієнта, запис | None).
+    source_task — обробка оригіналу з цього ж пакета, якщо файл — його дублікат.
+    """
+    loop = asyncio.get_running_loop()
+    key, path, source_key = stored["key"], stored["path"], stored["duplicate_of"]
+    result = {"filename": key, "type": file_type, "status": "success"}
+    if source_key: result["duplicate_of"] = source_key
+    try:
+        if source_key:
+            if source_task is not None:
+                # Метадані оригіналу закомітяться лише разом з усім пакетом — беремо їх з його обробки
+                _, source = await source_task
+            else:
+                await loop.run_in_executor(None, CONTENT_INDEX.wait, content_hash, source_key)
+                source = None
+            # Оригінал не вдалося обробити — дублікат обробляється як звичайний файл
+            entry = await loop.run_in_executor(None, duplicate_entry, key, path, source_key, content_hash, source)
+            if entry: return result, entry
+        thumbnail_filename = thumbnail_filename_for(key, settings)
+        renditions, media_info = await loop.run_in_executor(
+            get_thumbnail_pool(), build_thumbnail_and_date, path, os.path.join(THUMBNAILS_PATH, thumbnail_filename), file_type, settings, True)
+        entry = await loop.run_in_executor(None, ingest_entry, key, path, file_type, thumbnail_filename, renditions, media_info, settings, content_hash)
+        return result, entry
+    except Exception as e:
+        print(f"❌ Помилка обробки {key}: {e}")
+        set_ingest_status(key, "failed", error=str(e))
+        return {**result, "status": "failed", "error": str(e)}, None
+
+async def commit_upload_batch(pending: list, results: asyncio.Queue, total: int, reserved: list):
+    """
+    Чекає обробку всіх файлів пакета (рядки йдуть у results у порядку готовності)
+    і комітить метадані одним put_many. Працює незалежно від того, чи клієнт ще читає відповідь.
+    reserved — [(sha256, ключ)] нового вмісту пакета; резерви знімаються після коміту.
+    """
+    entries, failed, committed = {}, 0, False
+    try:
+        for done in asyncio.as_completed(pending):
+            result, entry = await done
+            if entry: entries[result["filename"]] = entry
+            else: failed += 1
+            results.put_nowait(result)
+        if entries: await asyncio.get_running_loop().run_in_executor(None, METADATA.put_many, entries)
+        committed = True
+        for key, entry in entries.items():
+            set_ingest_status(key, "ready", **({"duplicate_of": entry["duplicate_of"]} if entry.get("duplicate_of") else {}))
+            schedule_faststart(key, os.path.join(ORIGINALS_PATH, key), entry["type"])
+        results.put_nowait({"status": "complete", "files": total, "committed": len(entries), "failed": failed, "version": METADATA.version})
+    except Exception as e:
+        traceback.print_exc()
+        if not committed:
+            for key in entries: set_ingest_status(key, "failed", error=str(e))
+        results.put_nowait({"status": "failed", "files": total, "committed": len(entries) if committed else 0, "error": str(e)})
+    finally:
+        for content_hash, key in reserved: CONTENT_INDEX.release(content_hash, key)
+        # Без цього рядка NDJSON-відповідь чекала б вічно
+        results.put_nowait(None)
+
+@app.post("/upload/batch/")
+async def upload_batch(files: List[UploadFile] = File(...), path: str = Form("")):
+    """
+    Багато файлів одним multipart-запитом. Файли пишуться на диск по черзі, а прев'ю/дата
+    кожного вже записаного рахуються в пулі процесів паралельно із записом наступних.
+    Відповідь — NDJSON: по рядку на файл у міру готовності, останній рядок
+    {"status": "complete", ...} — після єдиного коміту метаданих усього пакета
+    (до нього нові файли ще не видно в /gallery/).
+    """
+    target_dir_path = resolve_upload_dir(path)
+    loop = asyncio.get_running_loop()
+    settings = load_settings()
+    results, pending = asyncio.Queue(), []
+    reserved, sources = [], {}  # sources: sha256 -> (ключ, обробка) для дублікатів усередині пакета
+    try:
+        for upload in files:
+            filename = os.path.basename(upload.filename or "")
+            if not filename:
+                results.put_nowait({"filename": filename, "status": "failed", "error": "Empty filename"}); continue
+            try:
+                staging_path, size, content_hash = await stream_upload_to_staging(upload)
+                stored = await loop.run_in_executor(None, store_upload, staging_path, target_dir_path, filename, content_hash)
+            except OSError as e:
+                results.put_nowait({"filename": filename, "status": "failed", "error": str(e)}); continue
+            key, file_type = stored["key"], detect_media_type(filename)
+            if not stored["existing"] and file_type and not stored["duplicate_of"]: reserved.append((content_hash, key))
+            if stored["existing"]:
+                results.put_nowait({"filename": key, "type": file_type, "status": "success", "already_exists": True}); continue
+            note_filesystem_change(stored["path"])
+            if not file_type:
+                results.put_nowait({"filename": key, "status": "skipped", "message": "Unsupported file type"}); continue
+            set_ingest_status(key, "processing")
+            source_key, source_task = sources.get(content_hash, (None, None))
+            task = asyncio.ensure_future(ingest_batch_file(stored, file_type, content_hash, settings,
+                                                           source_task if stored["duplicate_of"] == source_key else None))
+            sources.setdefault(content_hash, (key, task))
+            pending.append(task)
+    except BaseException:
+        # Пакет обірвався до коміту: без зняття резервів дублікати цих файлів чекали б вічно
+        for content_hash, key in reserved: CONTENT_INDEX.release(content_hash, key)
+        raise
+    start_job_task(None, commit_upload_batch(pending, results, len(files), reserved))
+
+    async def stream_results():
+        while (line := await results.get()) is not None:
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+# --- Відновлювані заливки (у стилі tus): створити сесію, дописувати PATCH-ами з Upload-Offset, HEAD — прогрес ---
+CHECKSUM_MISMATCH_STATUS = 460  # як у розширенні checksum протоколу tus
+
+class UploadSessions:
+    """
+    Сесії відновлюваних заливок у library.db; дані — incoming/{id}.upload (той самий диск,
+    що й originals, тож готовий файл переноситься без копіювання). Зміщення в базі
+    оновлюється лише після fsync, тож після падіння сервера дописування продовжується
+    з останнього гарантовано записаного байта.
+    """
+    def __init__(self, db_path: str, incoming_path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self.incoming_path = incoming_path
+        self._active = set()  # сесії, в які зараз іде PATCH
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS upload_sessions (
+                id TEXT PRIMARY KEY, filename TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL,
+                upload_offset INTEGER NOT NULL DEFAULT 0, sha256 TEXT, created REAL, updated REAL)""")
+
+    def data_path(self, session_id: str) -> str:
+        return os.path.join(self.incoming_path, f"{session_id}.upload")
+
+    def create(self, filename: str, path: str, size: int, sha256: Optional[str]) -> dict:
+        session_id = uuid.uuid4().hex
+        open(self.data_path(session_id), "wb").close()
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO upload_sessions (id, filename, path, size, upload_offset, sha256, created, updated) VALUES (?, ?, ?, ?, 0, ?, ?, ?)",
+                             (session_id, filename, path, size, sha256, now, now))
+        return self.get(session_id)
+
+    def get(self, session_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute("SELECT id, filename, path, size, upload_offset, sha256, created, updated FROM upload_sessions WHERE id = ?",
+                                   (session_id,)).fetchone()
+        if not row: return None
+        return dict(zip(("id", "filename", "path", "size", "offset", "sha256", "created", "updated"), row))
+
+    def set_offset(self, session_id: str, offset: int):
+        with self._lock, self._db:
+            self._db.execute("UPDATE upload_sessions SET upload_offset = ?, updated = ? WHERE id = ?", (offset, time.time(), session_id))
+
+    def acquire(self, session_id: str) -> bool:
+        """Одна сесія — один PATCH одночасно."""
+        with self._lock:
+            if session_id in self._active: return False
+            self._active.add(session_id)
+            return True
+
+    def release(self, session_id: str):
+        with self._lock: self._active.discard(session_id)
+
+    def delete(self, session_id: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+        _remove_quietly(self.data_path(session_id))
+
+    def cleanup(self, max_age: float) -> int:
+        """Видаляє сесії без активності довше max_age і осиротілі файли incoming/ (*.upload, *.part) такого ж віку."""
+        cutoff = time.time() - max_age
+        with self._lock:
+            stale = [row[0] for row in self._db.execute("SELECT id FROM upload_sessions WHERE updated < ?", (cutoff,))
+                     if row[0] not in self._active]
+            known = {row[0] for row in self._db.execute("SELECT id FROM upload_sessions")}
+        for session_id in stale: self.delete(session_id)
+        removed = len(stale)
+        for name in os.listdir(self.incoming_path):
+            stem, ext = os.path.splitext(name)
+            if ext not in (".upload", ".part") or (ext == ".upload" and stem in known): continue
+            path = os.path.join(self.incoming_path, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path); removed += 1
+            except OSError: pass
+        return removed
+
+UPLOAD_SESSIONS = UploadSessions(LIBRARY_DB_FILE, INCOMING_PATH)
+
+class UploadSessionRequest(BaseModel):
+    filename: str
+    size: int
+    path: str = ""  # папка всередині originals
+    sha256: Optional[str] = None  # хеш усього файлу; перевіряється перед переносом в originals
+
+def upload_session_headers(session: dict) -> dict:
+    return {"Upload-Offset": str(session["offset"]), "Upload-Length": str(session["size"]), "Cache-Control": "no-store"}
+
+def parse_upload_checksum(header: Optional[str]):
+    """'Upload-Checksum: sha256 <base64>' → (об'єкт хешу, очікуваний digest) або (None, None)."""
+    if not header: return None, None
+    algorithm, _, value = header.strip().partition(" ")
+    if algorithm.lower() not in ("sha1", "sha256", "md5"):
+        raise HTTPException(status_code=400, detail=f"Unsupported checksum algorithm: {algorithm}")
+    try: expected = base64.b64decode(value.strip(), validate=True)
+    except ValueError: raise HTTPException(status_code=400, detail="Bad Upload-Checksum value")
+    return hashlib.new(algorithm.lower()), expected
 
+async def append_upload_chunk(data_path: str, offset: int, limit: int, stream, digest) -> tuple:
+    """
+    Дописує тіло PATCH у файл сесії з offset (хвіст після offset, якщо він лишився
+    від обірваного запиту, відрізається), не більше limit байт. Повертає
+    (записано байт, чи обірвалося з'єднання, чи перевищено limit).
+    """
+    loop = asyncio.get_running_loop()
+    out = await loop.run_in_executor(None, open, data_path, "r+b")
+    written, disconnected, too_large = 0, False, False
+    try:
+        await loop.run_in_executor(None, lambda: (out.truncate(offset), out.seek(offset)))
+        try:
+            async for chunk in stream:
+                if written + len(chunk) > limit:
+                    too_large = True; break
+                await loop.run_in_executor(None, lambda: (out.write(chunk), digest and digest.update(chunk)))
+                written += len(chunk)
+        except ClientDisconnect:
+            disconnected = True
+        await loop.run_in_executor(None, lambda: (out.flush(), os.fsync(out.fileno())))
+    finally:
+        out.close()
+    return written, disconnected, too_large
+
+@app.post("/upload/sessions", status_code=201)
+async def create_upload_session(data: UploadSessionRequest):
+    """Нова відновлювана заливка. Дані — PATCH на upload_url з заголовком Upload-Offset."""
+    filename = os.path.basename(data.filename)
+    if not filename: raise HTTPException(status_code=400, detail="Empty filename")
+    if data.size <= 0: raise HTTPException(status_code=400, detail="Size must be positive")
+    resolve_upload_dir(data.path)
+    session = await asyncio.get_running_loop().run_in_executor(
+        None, UPLOAD_SESSIONS.create, filename, data.path, data.size, data.sha256.lower() if data.sha256 else None)
+    upload_url = f"/upload/sessions/{session['id']}"
+    return JSONResponse({"id": session["id"], "upload_url": upload_url, "offset": 0, "size": session["size"]},
+                        status_code=201, headers={"Location": upload_url, **upload_session_headers(session)})
+
+@app.head("/upload/sessions/{session_id}")
+async def head_upload_session(session_id: str):
+    session = UPLOAD_SESSIONS.get(session_id)
+    if not session: raise HTTPException(status_code=404, detail="Upload session not found")
+    return Response(status_code=200, headers=upload_session_headers(session))
+
+@app.get("/upload/sessions/{session_id}")
+async def get_upload_session(session_id: str):
+    session = UPLOAD_SESSIONS.get(session_id)
+    if not session: raise HTTPException(status_code=404, detail="Upload session not found")
+    return JSONResponse(session, headers=upload_session_headers(session))
+
+@app.patch("/upload/sessions/{session_id}")
+async def patch_upload_session(session_id: str, request: Request):
+    """
+    Дописує шматок з позиції Upload-Offset (має збігатися з поточною, інакше 409 — клієнт
+    робить HEAD і продовжує звідти). Необов'язковий Upload-Checksum перевіряє шматок:
+    при розбіжності він відкидається (460). Обрив з'єднання без Upload-Checksum зберігає
+    те, що встигло дійти. Останній шматок переносить файл в originals і запускає інжест.
+    """
+    try: offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError): raise HTTPException(status_code=400, detail="Upload-Offset header required")
+    digest, expected = parse_upload_checksum(request.headers.get("upload-checksum"))
+    if not UPLOAD_SESSIONS.acquire(session_id):
+        if not UPLOAD_SESSIONS.get(session_id): raise HTTPException(status_code=404, detail="Upload session not found")
+        raise HTTPException(status_code=409, detail="Upload in progress")
+    try:
+        # Читаємо сесію лише під замком: попередній PATCH міг тим часом зсунути зміщення
+        # або завершити заливку й видалити сесію
+        session = UPLOAD_SESSIONS.get(session_id)
+        if not session: raise HTTPException(status_code=404, detail="Upload session not found")
+        if offset != session["offset"]:
+            return JSONResponse({"detail": "Offset mismatch"}, status_code=409, headers=upload_session_headers(session))
+        data_path = UPLOAD_SESSIONS.data_path(session_id)
+        written, disconnected, too_large = await append_upload_chunk(data_path, offset, session["size"] - offset, request.stream(), digest)
+        if too_large or (digest and (disconnected or digest.digest() != expected)):
+            await asyncio.get_running_loop().run_in_executor(None, os.truncate, data_path, offset)
+            if too_large: raise HTTPException(status_code=413, detail="Chunk exceeds declared upload size")
+            if disconnected: return Response(status_code=400)
+            return JSONResponse({"detail": "Checksum mismatch"}, status_code=CHECKSUM_MISMATCH_STATUS, headers=upload_session_headers(session))
+        UPLOAD_SESSIONS.set_offset(session_id, offset + written)
+        session = {**session, "offset": offset + written}
+        if session["offset"] < session["size"]:
+            return Response(status_code=204, headers=upload_session_headers(session))
+        # Файл повний — переносимо, навіть якщо клієнт обірвав з'єднання після останнього байта:
+        # інакше сесія зависла б повною, а наступний PATCH не мав би що дописати
+        return await finish_upload_session(session, data_path)
+    finally:
+        UPLOAD_SESSIONS.release(session_id)
+
+async def finish_upload_session(session: dict, data_path: str):
+    """Звіряє sha256 усього файлу (якщо клієнт його дав) і атомарно переносить в originals."""
+    loop = asyncio.get_running_loop()
+    content_hash = await loop.run_in_executor(None, compute_file_hash, data_path)
+    if session["sha256"] and session["sha256"] != content_hash:
+        # Де саме зіпсовано — невідомо, тож сесія не продовжується
+        UPLOAD_SESSIONS.delete(session["id"])
+        return JSONResponse({"detail": "File checksum mismatch"}, status_code=CHECKSUM_MISMATCH_STATUS)
+    result = await commit_upload(data_path, resolve_upload_dir(session["path"]), session["filename"], content_hash)
+    UPLOAD_SESSIONS.delete(session["id"])
+    return JSONResponse(result, headers=upload_session_headers(session))
+
+@app.delete("/upload/sessions/{session_id}", status_code=204)
+async def delete_upload_session(session_id: str):
+    if not UPLOAD_SESSIONS.get(session_id): raise HTTPException(status_code=404, detail="Upload session not found")
+    if not UPLOAD_SESSIONS.acquire(session_id): raise HTTPException(status_code=409, detail="Upload in progress")
+    try: UPLOAD_SESSIONS.delete(session_id)
+    finally: UPLOAD_SESSIONS.release(session_id)
+    return Response(status_code=204)
+
+
+def gallery_item(name: str, value: dict) -> dict:
+    """Компактний запис для клієнта (і для /gallery/, і для /sync/changes)."""
+    item = {"filename": name, "type": value["type"], "thumbnail": value["thumbnail"], "timestamp": value.get("timestamp")}
+    # Розміри й тривалість дають клієнту зарезервувати місце в сітці до завантаження прев'ю
+    for field in ("width", "height", "duration"):
+        if field in value: item[field] = value[field]
+    return item
 
 # --- ЕНДПОІНТ get_gallery/ ЗАЛИШАЄТЬСЯ БЕЗ ЗМІН, він вже готовий ---
 @app.get("/gallery/")
-async def get_gallery_list():
-    metadata = load_metadata()
-    if not metadata: return []
-    # Використовуємо .get() для безпечного отримання timestamp, на випадок старих записів
-    sorted_items = sorted(metadata.items(), key=lambda item: item[1].get('timestamp', 0), reverse=True)
-    gallery_list = [
-        {"filename": key, "type": value["type"], "thumbnail": value["thumbnail"], "timestamp": value.get("timestamp")}
-        for key, value in sorted_items if value.get("timestamp") # Віддаємо тільки ті, де є timestamp
-    ]
-    return JSONResponse(content=gallery_list)
+async def get_gallery_list(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    media_type: Optional[str] = Query(None, alias="type"),
+    date_from: Optional[float] = None,
+    date_to: Optional[float] = None,
+):
+    """
+    Без cursor/limit — старий формат: повний масив (вже відсортований індексом).
+    З cursor/limit — сторінка {"items": [...], "next_cursor": ...}.
+    date_from/date_to — unix timestamp, включно.
+    """
+    after = None
+    if cursor:
+        try: after = GalleryIndex.decode_cursor(cursor)
+        except ValueError: raise HTTPException(status_code=400, detail="Invalid cursor")
+    paginated = cursor is not None or limit is not None
+    # Відповідь повністю визначається версією метаданих і параметрами запиту
+    etag = f'"gal-{METADATA.version:x}-' + hashlib.sha1(str(request.query_params).encode("utf-8")).hexdigest()[:12] + '"'
+    headers = cache_headers(etag)
+    if is_not_modified(request, etag): return not_modified_response(headers)
+    names, has_more = GALLERY_INDEX.page(after, (limit or 100) if paginated else None, media_type, date_from, date_to)
+
+    gallery_list = []
+    for name in names:
+        value = METADATA.get(name)
+        if value is None: continue
+        gallery_list.append(gallery_item(name, value))
+    if not paginated: return JSONResponse(content=gallery_list, headers=headers)
+
+    next_cursor = None
+    if has_more and gallery_list:
+        last = gallery_list[-1]
+        next_cursor = GalleryIndex.encode_cursor(last["filename"], last["timestamp"])
+    return JSONResponse(content={"items": gallery_list, "next_cursor": next_cursor}, headers=headers)
+
+@app.get("/sync/changes")
+async def get_sync_changes(since: int = Query(0, ge=0), limit: int = Query(500, ge=1, le=5000), snapshot: bool = False):
+    """
+    Зміни метаданих після версії since: {"upserts": [...], "deletes": [...], "next": ..., "has_more": ...}.
+    Клієнт зберігає next і передає його як since наступного разу; поки has_more — докачує.
+    reset=true — курсор застарий (або since=0): клієнт відкидає локальну копію, а пакети
+    до has_more=false складають повний знімок; під час докачування знімка передається snapshot=true.
+    """
+    current = METADATA.version
+    reset = not snapshot and (since == 0 or since < METADATA.changes_floor() or since > current)  # since > current — курсор з іншої бази
+    if reset: since = 0
+    rows, has_more = METADATA.changes_since(since, limit)
+    upserts, deletes = [], []
+    for _, filename, op in rows:
+        value = METADATA.get(filename) if op == "upsert" else None
+        if value is not None: upserts.append(gallery_item(filename, value))
+        else: deletes.append(filename)
+    next_version = rows[-1][0] if has_more else max(current, rows[-1][0] if rows else since)
+    return {"reset": reset, "snapshot": reset or snapshot, "upserts": upserts, "deletes": deletes,
+            "next": next_version, "has_more": has_more, "version": current}
 
 
 @app.get("/thumbnail/{filename}")
-# ... (без змін) ...
-async def get_thumbnail(filename: str):
-    file_path = os.path.join(THUMBNAILS_PATH, filename)
-    if os.path.exists(file_path): return FileResponse(file_path)
-    raise HTTPException(status_code=404, detail="Thumbnail not found")
+async def get_thumbnail(filename: str, request: Request, size: str = "grid"):
+    """
+    Прев'ю віддається з RAM; диск читається лише при промаху кешу.
+    size=grid|detail|blur — обирає rendition для основного прев'ю filename.
+    """
+    if size not in ("grid", "detail", "blur"): raise HTTPException(status_code=400, detail="Unknown size")
+    filename = rendition_filename(filename, size)
+    cached = THUMBNAIL_CACHE.get(filename)
+    if cached is None:
+        cached = await asyncio.get_running_loop().run_in_executor(None, load_thumbnail_into_cache, filename)
+        if cached is None: raise HTTPException(status_code=404, detail="Thumbnail not found")
+    data, etag = cached
+    headers = cache_headers(etag, max_age=THUMBNAIL_MAX_AGE)
+    if is_not_modified(request, etag): return not_modified_response(headers)
+    media_type = mimetypes.guess_type(filename)[0] or "image/jpeg"
+    return Response(content=data, media_type=media_type, headers=headers)
 
-@app.get("/original/{filename}")
-# ... (без змін) ...
-async def get_original_file(filename: str):
-    file_path = os.path.join(ORIGINALS_PATH, filename)
-    if os.path.exists(file_path): return FileResponse(file_path)
+@app.get("/original/{filename:path}")
+async def get_original_file(filename: str, request: Request):
+    base_path = os.path.abspath(ORIGINALS_PATH)
+    file_path = os.path.abspath(os.path.join(base_path, filename))
+    if not file_path.startswith(base_path + os.sep):
+        raise HTTPException(status_code=403, detail="Access denied")
+    if os.path.isfile(file_path): return media_file_response(request, file_path)
     raise HTTPException(status_code=404, detail="File not found")
 
-@app.post("/gallery/rescan")
-async def rescan_storage():
-    # ... (цей код треба теж оновити, щоб він використовував get_original_date) ...
-    supported_image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.heic', 'webp']
-    supported_video_extensions = ['.mp4', '.mov', '.avi', '.mkv', 'webm']
-    metadata = load_metadata()
-    original_files = os.listdir(ORIGINALS_PATH)
-    processed_count, updated_count = 0, 0
-    
-    for filename in original_files:
+def collect_rescan_work(settings: dict) -> tuple:
+    """
+    Звіряє диск з метаданими. Обробляються лише нові файли та ті, у яких змінились
+    size/mtime; записи без файлу на диску повертаються як removed. Старим записам
+    без size/mtime ці поля просто дописуються — без повторної обробки.
+    Виконується в потоці — обхід каталогів на HDD повільний.
+    """
+    signature = thumbnail_settings_signature(settings)
+    unreadable = []
+    on_disk = scan_library_files(unreadable)
+    # Збій читання каталогу (EACCES/EIO) не повинен стерти метадані, прев'ю й підписи його файлів
+    removed = [key for key in METADATA.keys() if key not in on_disk and not is_under_unreadable(key, unreadable)]
+    work = []
+    for filename, (size, mtime) in on_disk.items():
+        entry = METADATA.get(filename)
+        if entry and 'timestamp' in entry:
+            if "size" not in entry or "mtime" not in entry:
+                METADATA.update(filename, size=size, mtime=mtime); continue
+            if entry["size"] == size and entry["mtime"] == mtime: continue
+        changed = bool(entry and 'timestamp' in entry)
+        file_type = detect_media_type(filename)
         original_file_path = os.path.join(ORIGINALS_PATH, filename)
-        # Перескануємо, тільки якщо запис неповний (немає timestamp)
-        if filename in metadata and 'timestamp' in metadata[filename]: continue
-            
-        if filename in metadata: updated_count += 1
-        else: processed_count += 1
-
-        file_extension = os.path.splitext(filename.lower())[1]
-        file_type = None
-        if file_extension in supported_image_extensions: file_type = "image"
-        elif file_extension in supported_video_extensions: file_type = "video"
-        else: continue
-
-        thumbnail_filename = f"{os.path.splitext(filename)[0]}.jpg"
+        thumbnail_filename = thumbnail_filename_for(filename, settings)
         thumbnail_file_path = os.path.join(THUMBNAILS_PATH, thumbnail_filename)
-        
-        if not os.path.exists(thumbnail_file_path):
-            created = False
-            if file_type == "image": created = create_photo_thumbnail(original_file_path, thumbnail_file_path)
-            elif file_type == "video": created = create_video_thumbnail(original_file_path, thumbnail_file_path)
-            if not created: continue
-
-        # --- ВИКОРИСТОВУЄМО НОВУ ФУНКЦІЮ І ТУТ ---
-        metadata[filename] = {
-            "type": file_type,
-            "thumbnail": thumbnail_filename,
-            "timestamp": get_original_date(original_file_path)
-        }
+        need_thumbnail = changed or not os.path.exists(thumbnail_file_path)
+        work.append((filename, build_thumbnail_and_date,
+                     (original_file_path, thumbnail_file_path, file_type, settings, need_thumbnail),
+                     {"type": file_type, "thumbnail": thumbnail_filename, "thumb_sig": signature if need_thumbnail else None,
+                      "is_new": entry is None, "changed": changed, "size": size, "mtime": mtime}))
+    return work, removed
+
+async def run_rescan_job(job_id: str, settings: dict):
+    loop = asyncio.get_running_loop()
+    work, removed = await loop.run_in_executor(None, collect_rescan_work, settings)
+    for key in removed: remove_library_entry(key)
+    JOBS.update(job_id, removed=len(removed))
+    info = {filename: extra for filename, _, _, extra in work}
+
+    def on_result(filename, result):
+        renditions, media_info = result if result else (False, None)
+        if not renditions:
+            JOBS.increment(job_id, failed=1); return
+        extra = info[filename]
+        entry = {"type": extra["type"], "thumbnail": extra["thumbnail"], **media_info, "size": extra["size"], "mtime": extra["mtime"]}
+        if extra["thumb_sig"]:
+            remove_thumbnail_files(METADATA.get(filename), keep=tuple(renditions.values()) if isinstance(renditions, dict) else ())
+            entry.update(thumb_sig=extra["thumb_sig"], renditions=renditions)
+        # --- Кожен файл комітимо одразу: галерея наповнюється під час сканування ---
+        # Для зміненого файлу старі похідні поля (хеш, faststart...) вже недійсні
+        base = {} if extra["changed"] else (METADATA.get(filename) or {})
+        METADATA.put(filename, {**base, **entry})
+        JOBS.increment(job_id, new=1 if extra["is_new"] else 0, updated=0 if extra["is_new"] else 1)
+
+    await run_in_thumbnail_pool(job_id, [(f, fn, args) for f, fn, args, _ in work], on_result)
+
+@app.post("/gallery/rescan")
+async def rescan_storage():
+    """
+    Ручна звірка бібліотеки з диском (зазвичай не потрібна — зміни підхоплює LIBRARY_WATCHER).
+    Запускається у фоні й одразу повертає job_id (прогрес — /jobs/{job_id}).
+    """
+    job_id = JOBS.create("rescan", new=0, updated=0, removed=0, failed=0)
+    start_job_task(job_id, run_rescan_job(job_id, load_settings()))
+    return {"status": "started", "job_id": job_id, "message": "Scan started."}
+
+METADATA_BATCH_SIZE = 64
+
+async def run_metadata_backfill_job(job_id: str):
+    """Дочитує розміри/орієнтацію/тривалість/GPS для записів, створених до появи extract_media_info."""
+    keys = [key for key in METADATA.keys() if "date_source" not in (METADATA.get(key) or {})]
+    batches = [keys[i:i + METADATA_BATCH_SIZE] for i in range(0, len(keys), METADATA_BATCH_SIZE)]
+    JOBS.update(job_id, files=len(keys))
+
+    def on_result(batch_id, infos):
+        batch = batches[int(batch_id)]
+        for key, media_info in zip(batch, infos or []):
+            if media_info and key in METADATA: METADATA.update(key, **media_info)
+        JOBS.increment(job_id, updated=sum(1 for media_info in infos or [] if media_info))
+
+    work = [(str(i), extract_media_info_batch, ([os.path.join(ORIGINALS_PATH, key) for key in batch],)) for i, batch in enumerate(batches)]
+    await run_in_thumbnail_pool(job_id, work, on_result)
+
+@app.post("/gallery/metadata/backfill")
+async def backfill_media_metadata():
+    """Паралельно (пакетами у пулі процесів) заповнює нові поля метаданих для старих записів."""
+    job_id = JOBS.create("metadata_backfill", updated=0)
+    start_job_task(job_id, run_metadata_backfill_job(job_id))
+    return {"status": "started", "job_id": job_id}
+
+async def run_palette_backfill_job(job_id: str):
+    """Рахує палітри з прев'ю для записів, створених до появи палітр."""
+    pending = [(key, entry["thumbnail"]) for key, entry in ((key, METADATA.get(key) or {}) for key in METADATA.keys())
+               if not entry.get("palette") and entry.get("thumbnail")]
+    batches = [pending[i:i + METADATA_BATCH_SIZE] for i in range(0, len(pending), METADATA_BATCH_SIZE)]
+    JOBS.update(job_id, files=len(pending))
+
+    def on_result(batch_id, palettes):
+        updated = 0
+        for (key, _), palette in zip(batches[int(batch_id)], palettes or []):
+            if palette and key in METADATA:
+                METADATA.update(key, palette=palette); updated += 1
+        JOBS.increment(job_id, updated=updated)
+
+    work = [(str(i), extract_palette_batch, ([os.path.join(THUMBNAILS_PATH, thumbnail) for _, thumbnail in batch],))
+            for i, batch in enumerate(batches)]
+    await run_in_thumbnail_pool(job_id, work, on_result)
+
+@app.post("/gallery/palette/backfill")
+async def backfill_palettes():
+    """Заповнює палітри для наявної бібліотеки (пакетами у пулі процесів). Прогрес — /jobs/{job_id}."""
+    job_id = JOBS.create("palette_backfill", updated=0)
+    start_job_task(job_id, run_palette_backfill_job(job_id))
+    return {"status": "started", "job_id": job_id}
+
+DEDUPE_REPORT_LIMIT = 100
+
+def run_dedupe_job(job_id: str, apply: bool):
+    """
+    Шукає однакові файли в бібліотеці: кандидати групуються за розміром, хешуються
+    лише групи з кількох файлів, вже зв'язані жорстким посиланням файли пропускаються.
+    apply=True замінює кожен дублікат жорстким посиланням на перший файл групи.
+    Виконується в потоці.
+    """
+    by_size = {}
+    for key in METADATA.keys():
+        try: stat = os.stat(os.path.join(ORIGINALS_PATH, key))
+        except OSError: continue
+        by_size.setdefault(stat.st_size, []).append((key, stat))
+    candidates = [group for size, group in by_size.items() if size > 0 and len({(st.st_dev, st.st_ino) for _, st in group}) > 1]
+    JOBS.update(job_id, status="processing", total=sum(len(group) for group in candidates), done=0)
+
+    groups, reclaimable, reclaimed = [], 0, 0
+    for group in candidates:
+        if JOBS.is_cancelled(job_id): break
+        by_hash = {}
+        for key, stat in sorted(group, key=lambda item: item[0]):
+            try: by_hash.setdefault(get_content_hash(key, os.path.join(ORIGINALS_PATH, key)), []).append((key, stat))
+            except OSError: pass
+            JOBS.increment(job_id, done=1)
+        for content_hash, files in by_hash.items():
+            (keep, keep_stat), seen = files[0], {(files[0][1].st_dev, files[0][1].st_ino)}
+            duplicates = []
+            for key, stat in files[1:]:
+                if (stat.st_dev, stat.st_ino) in seen: continue
+                seen.add((stat.st_dev, stat.st_ino))
+                duplicates.append(key)
+            if not duplicates: continue
+            reclaimable += keep_stat.st_size * len(duplicates)
+            groups.append({"content_hash": content_hash, "size": keep_stat.st_size, "keep": keep, "duplicates": duplicates})
+            if apply: reclaimed += keep_stat.st_size * replace_with_links(keep, duplicates)
+
+    groups.sort(key=lambda group: group["size"] * len(group["duplicates"]), reverse=True)
+    JOBS.update(job_id, status="cancelled" if JOBS.is_cancelled(job_id) else "complete", groups=groups[:DEDUPE_REPORT_LIMIT], group_count=len(groups),
+                reclaimable_bytes=reclaimable, reclaimed_bytes=reclaimed, applied=apply)
+
+def replace_with_links(keep: str, duplicates: list) -> int:
+    """Атомарно підміняє кожен дублікат жорстким посиланням на keep. Повертає кількість підмінених."""
+    source = os.path.join(ORIGINALS_PATH, keep)
+    replaced = 0
+    for key in duplicates:
+        path = os.path.join(ORIGINALS_PATH, key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.dedupe"
+        try:
+            os.link(source, temp_path)
+            os.replace(temp_path, path)
+        except OSError as e:
+            _remove_quietly(temp_path)
+            print(f"⚠️ Не вдалося замінити {key} посиланням: {e}")
+            continue
+        stat = os.stat(path)
+        METADATA.update(key, size=stat.st_size, mtime=stat.st_mtime, duplicate_of=keep)
+        replaced += 1
+    return replaced
+
+@app.post("/gallery/dedupe")
+async def dedupe_library(apply: bool = False):
+    """
+    Звіт про однакові файли в originals (apply=false) або їх заміна жорсткими
+    посиланнями (apply=true). Результат — у /jobs/{job_id}: групи, reclaimable_bytes, reclaimed_bytes.
+    """
+    job_id = JOBS.create("dedupe", applied=apply)
+    loop = asyncio.get_running_loop()
+    start_job_task(job_id, loop.run_in_executor(None, run_dedupe_job, job_id, apply))
+    return {"status": "started", "job_id": job_id}
+
+async def run_dhash_backfill_job(job_id: str):
+    """Рахує dHash з прев'ю для записів, створених до появи перцептивного індексу."""
+    pending = [(key, entry["thumbnail"]) for key, entry in ((key, METADATA.get(key) or {}) for key in METADATA.keys())
+               if not entry.get("dhash") and entry.get("thumbnail")]
+    batches = [pending[i:i + METADATA_BATCH_SIZE] for i in range(0, len(pending), METADATA_BATCH_SIZE)]
+    JOBS.update(job_id, files=len(pending))
+
+    def on_result(batch_id, hashes):
+        updated = 0
+        for (key, _), dhash in zip(batches[int(batch_id)], hashes or []):
+            if dhash and key in METADATA:
+                METADATA.update(key, dhash=dhash); updated += 1
+        JOBS.increment(job_id, updated=updated)
+
+    work = [(str(i), compute_dhash_batch, ([os.path.join(THUMBNAILS_PATH, thumbnail) for _, thumbnail in batch],))
+            for i, batch in enumerate(batches)]
+    await run_in_thumbnail_pool(job_id, work, on_result)
+
+@app.post("/gallery/dhash/backfill")
+async def backfill_dhashes():
+    """Заповнює перцептивні хеші для наявної бібліотеки (пакетами у пулі процесів). Прогрес — /jobs/{job_id}."""
+    job_id = JOBS.create("dhash_backfill", updated=0)
+    start_job_task(job_id, run_dhash_backfill_job(job_id))
+    return {"status": "started", "job_id": job_id}
+
+@app.get("/gallery/similar/{filename:path}")
+async def get_similar_photos(filename: str, max_distance: int = Query(10, ge=0, le=64), limit: int = Query(50, ge=1, le=500)):
+    """Схожі кадри (за dHash прев'ю), найближчі першими. distance — кількість різних бітів з 64."""
+    if filename not in METADATA: raise HTTPException(status_code=404, detail="File not found")
+    matches = PHASH_INDEX.similar(filename, max_distance, limit)
+    if matches is None: raise HTTPException(status_code=409, detail="Perceptual hash not computed yet (see /gallery/dhash/backfill)")
+    items = []
+    for name, distance in matches:
+        entry = METADATA.get(name)
+        if entry: items.append({**gallery_item(name, entry), "distance": distance})
+    return {"filename": filename, "items": items}
+
+@app.get("/gallery/near_duplicates")
+async def get_near_duplicates(max_distance: int = Query(4, ge=0, le=6), offset: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=500)):
+    """
+    Групи майже однакових кадрів (серії, "PORTRAIT"/"COVER"-варіанти), найбільші першими.
+    Перший прохід по бібліотеці рахується в потоці; далі — з кешу до наступної зміни.
+    """
+    clusters = await asyncio.get_running_loop().run_in_executor(None, PHASH_INDEX.clusters, max_distance)
+    page = []
+    for group in clusters[offset:offset + limit]:
+        entries = [(name, METADATA.get(name)) for name in group]
+        items = sorted((gallery_item(name, entry) for name, entry in entries if entry), key=lambda item: item.get("timestamp") or 0)
+        page.append({"size": len(items), "items": items})
+    return {"clusters": page, "total": len(clusters), "next_offset": offset + limit if offset + limit < len(clusters) else None}
 
-    save_metadata(metadata)
-    message = f"Scan complete. New: {processed_count}. Updated: {updated_count}."
-    return {"status": "success", "message": message}
+@app.get("/gallery/watch")
+async def get_library_watch_status():
+    return LIBRARY_WATCHER.stats()
 
 # --- Глобальні налаштування ---
 SETTINGS_FILE = os.path.join(STORAGE_PATH, "settings.json")
@@ -803,6 +3945,27 @@ DEFAULT_SETTINGS = {
     "preview_quality": 80,
     "photo_size": 0,      # 0 = оригінал
     "photo_quality": 100,
+    "thumbnail_workers": 0,  # 0 = всі ядра
+    "ingest_workers": 2,
+    "resized_cache_mb": 64,  # RAM-кеш для /original_resized/
+    "resized_disk_cache_mb": 1024,  # ліміт cache/resized/ на диску (найдавніше використані видаляються)
+    "thumbnail_cache_mb": 128,  # RAM-кеш прев'ю
+    "thumbnail_cache_warmup": True,  # прогрівати кеш прев'ю при старті
+    "frame_cache_mb": 32,  # RAM-кеш підігнаних під фото рамок для колажів
+    "thumbnail_format": "webp",  # "webp" або "jpeg"
+    "detail_size": 1080,
+    "detail_quality": 80,
+    "memory_fanout": 3,  # скільки кандидатів у спогад аналізувати одночасно
+    "memory_workers": 1,  # скільки спогадів генерується одночасно
+    "memory_queue_limit": 10,  # більше задач у черзі — відповідь 429
+    "memory_similar_distance": 10,  # не брати в спогад кадри, ближчі за dHash до вже вибраних (0 = вимкнено)
+    "job_ttl_hours": 24,  # скільки зберігати завершені задачі
+    "upload_session_ttl_hours": 24,  # недокачані відновлювані заливки без активності видаляються
+    "sync_tombstone_days": 30,  # клієнт, що не синхронізувався довше, отримає повний знімок
+    "telegram_upload_concurrency": 3,  # скільки файлів одночасно завантажувати в Telegram
+    "library_watch": True,  # підхоплювати зміни в originals автоматично
+    "library_watch_debounce": 2.0,  # секунд тиші після останньої події перед обробкою файлу
+    "library_poll_interval": 30,  # період опитування, якщо watchdog не встановлено
 }
 
 def load_settings():
@@ -825,10 +3988,14 @@ async def get_settings():
 @app.post("/settings/")
 async def update_settings(data: dict = Body(...)):
     settings = load_settings()
+    old_settings = dict(settings)
     for key in DEFAULT_SETTINGS:
         if key in data:
             settings[key] = data[key]
     save_settings(settings)
+    if any(settings.get(k) != old_settings.get(k) for k in ("photo_size", "photo_quality")):
+        await asyncio.get_running_loop().run_in_executor(None, clear_resized_cache)
+    apply_cache_limits(settings)
     return {"status": "success", "settings": settings}
 
 @app.post("/thumbnails/clear_cache/")
@@ -838,6 +4005,7 @@ async def clear_thumbnails_cache():
             fpath = os.path.join(THUMBNAILS_PATH, fname)
             if os.path.isfile(fpath):
                 os.remove(fpath)
+        THUMBNAIL_CACHE.clear()
         return {"status": "success", "message": "Thumbnail cache cleared"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -845,84 +4013,84 @@ async def clear_thumbnails_cache():
 print("🚀 Сервер готовий до роботи! (v_final, з оригінальною датою)")
 
 @app.get("/original_resized/{filename}")
-async def get_resized_original(filename: str):
+async def get_resized_original(filename: str, request: Request):
+    """
+    Зменшена копія оригіналу. Результат кешується в RAM і на диску за ключем
+    (шлях, mtime, розмір, photo_size, photo_quality), тож повторні запити не
+    декодують фото, а клієнт з актуальним ETag отримує 304.
+    """
     file_path = os.path.join(ORIGINALS_PATH, filename)
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
     settings = load_settings()
-    max_size = settings.get("photo_size", 0)
-    quality = settings.get("photo_quality", 100)
     ext = os.path.splitext(filename.lower())[1]
-    # Якщо не зображення — просто віддаємо файл
+    # Якщо не зображення — просто віддаємо файл (з Range для відео)
     if ext not in [".jpg", ".jpeg", ".png", ".heic", ".webp"]:
-        return FileResponse(file_path)
+        return media_file_response(request, file_path)
+    stat = os.stat(file_path)
+    digest = resized_cache_key(file_path, stat, settings)
+    headers = cache_headers(f'"{digest}"', stat.st_mtime)
+    if is_not_modified(request, headers["ETag"], stat.st_mtime):
+        return not_modified_response(headers)
     try:
-        with Image.open(file_path) as img:
-            # HEIC/HEIF підтримка
-            if img.format and img.format.upper() in ['HEIC', 'HEIF']:
-                from pillow_heif import register_heif_opener
-                register_heif_opener()
-                img = Image.open(file_path)
-            if img.mode in ("RGBA", "P"):
-                img = img.convert("RGB")
-            # Якщо max_size > 0 — змінюємо розмір
-            if max_size and max_size > 0:
-                img.thumbnail((max_size, max_size))
-            buf = io.BytesIO()
-            img.save(buf, "JPEG", quality=quality, optimize=True)
-            buf.seek(0)
-            return StreamingResponse(buf, media_type="image/jpeg")
+        data = await asyncio.get_running_loop().run_in_executor(None, get_or_render_resized, file_path, digest, settings)
+        return Response(content=data, media_type="image/jpeg", headers=headers)
     except Exception as e:
         print(f"Помилка стискання: {e}")
         return FileResponse(file_path)
 
-@app.post("/thumbnails/generate_all/")
-async def generate_all_thumbnails():
-    """
-    Генерує мініатюри для всіх медіафайлів у ORIGINALS_PATH згідно з поточними налаштуваннями.
-    """
-    supported_image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.heic', 'webp']
-    supported_video_extensions = ['.mp4', '.mov', '.avi', '.mkv', 'webm']
-    metadata = load_metadata()
-    original_files = os.listdir(ORIGINALS_PATH)
-    generated, failed = 0, 0
-
-    for filename in original_files:
+def collect_thumbnail_work(settings: dict, force: bool) -> tuple:
+    """Повертає (робота, кількість пропущених актуальних прев'ю). Виконується в потоці."""
+    signature = thumbnail_settings_signature(settings)
+    work, skipped = [], 0
+    for filename in os.listdir(ORIGINALS_PATH):
+        file_type = detect_media_type(filename)
+        if not file_type: continue
         original_file_path = os.path.join(ORIGINALS_PATH, filename)
-        file_extension = os.path.splitext(filename.lower())[1]
-        file_type = None
-        if file_extension in supported_image_extensions:
-            file_type = "image"
-        elif file_extension in supported_video_extensions:
-            file_type = "video"
-        else:
-            continue
+        thumbnail_file_path = os.path.join(THUMBNAILS_PATH, thumbnail_filename_for(filename, settings))
+        if not force and is_thumbnail_fresh(original_file_path, thumbnail_file_path, METADATA.get(filename), signature):
+            skipped += 1; continue
+        work.append((filename, build_thumbnail, (original_file_path, thumbnail_file_path, file_type, settings)))
+    return work, skipped
 
-        thumbnail_filename = f"{os.path.splitext(filename)[0]}.jpg"
-        thumbnail_file_path = os.path.join(THUMBNAILS_PATH, thumbnail_filename)
+async def run_generate_all_job(job_id: str, settings: dict, force: bool):
+    work, skipped = await asyncio.get_running_loop().run_in_executor(None, collect_thumbnail_work, settings, force)
+    JOBS.update(job_id, skipped=skipped)
+    signature = thumbnail_settings_signature(settings)
 
-        try:
-            if file_type == "image":
-                created = create_photo_thumbnail(original_file_path, thumbnail_file_path)
-            else:
-                created = create_video_thumbnail(original_file_path, thumbnail_file_path)
-            if created:
-                generated += 1
-            else:
-                failed += 1
-        except Exception as e:
-            print(f"Помилка при створенні мініатюри для {filename}: {e}")
-            failed += 1
+    stale_entries = []
+
+    def on_result(filename, renditions):
+        if not renditions:
+            JOBS.increment(job_id, failed=1); return
+        for name in renditions.values(): THUMBNAIL_CACHE.pop(name)
+        old_entry = METADATA.get(filename)
+        if old_entry:
+            stale_entries.append((old_entry, tuple(renditions.values())))
+            METADATA.update(filename, thumbnail=renditions["grid"], renditions=renditions, thumb_sig=signature)
+        JOBS.increment(job_id, generated=1)
+
+    await run_in_thumbnail_pool(job_id, work, on_result)
+    # Прев'ю зі старими іменами (напр. .jpg після переходу на WebP) більше не потрібні
+    await asyncio.get_running_loop().run_in_executor(None, lambda: [remove_thumbnail_files(e, keep) for e, keep in stale_entries])
 
-    return {"status": "success", "generated": generated, "failed": failed}
+@app.post("/thumbnails/generate_all/")
+async def generate_all_thumbnails(force: bool = False):
+    """
+    Генерує мініатюри для всіх медіафайлів у ORIGINALS_PATH згідно з поточними налаштуваннями.
+    Працює у фоні в пулі процесів; актуальні прев'ю пропускаються (force=true — перегенерувати все).
+    """
+    job_id = JOBS.create("generate_thumbnails", generated=0, skipped=0, failed=0)
+    start_job_task(job_id, run_generate_all_job(job_id, load_settings(), force))
+    return {"status": "started", "job_id": job_id}
 
 @app.get("/original_with_path/")
-async def get_original_with_path(path: str = Query(...)):
+async def get_original_with_path(request: Request, path: str = Query(...)):
     base_path = os.path.abspath(ORIGINALS_PATH)
     requested_file = os.path.abspath(os.path.join(base_path, path))
     if not requested_file.startswith(base_path):
         raise HTTPException(status_code=403, detail="Access denied")
     if not os.path.isfile(requested_file):
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(requested_file)
+    return media_file_response(request, requested_file)
 
@@ -0,0 +1,25 @@
+import importlib
+import os
+import sys
+import tempfile
+
+import pytest
+
+# server.py на імпорті створює теки сховища, library.db і сесію Telethon у поточній теці —
+# усе це має опинитися в тимчасовій теці, а не в /mnt/storage чи в робочій копії
+_STORAGE = tempfile.mkdtemp(prefix="server-tests-")
+os.environ["STORAGE_PATH"] = _STORAGE
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "test")
+
+
+@pytest.fixture(scope="session")
+def server():
+    if "server" not in sys.modules:
+        cwd = os.getcwd()
+        os.chdir(_STORAGE)
+        try:
+            importlib.import_module("server")
+        finally:
+            os.chdir(cwd)
+    return sys.modules["server"]
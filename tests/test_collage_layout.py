@@ -0,0 +1,37 @@
+import random
+
+import pytest
+
+from collage_layout import COLLAGE_MARGIN, plan_collage_layout, rotated_box
+
+CANVAS = (1080, 1920)
+ASPECTS = [(4, 3), (3, 4), (16, 9), (9, 16), (1, 1)]
+
+
+def layout_boxes(count: int, seed: int) -> list:
+    rng = random.Random(seed)
+    sizes = []
+    for _ in range(count):
+        aw, ah = rng.choice(ASPECTS)
+        sizes.append((aw * 100 * rng.uniform(0.5, 2), ah * 100 * rng.uniform(0.5, 2)))
+    boxes = []
+    for x, y, w, h, angle in plan_collage_layout(sizes, CANVAS, seed=seed):
+        bw, bh = rotated_box(w, h, angle)
+        boxes.append((x, y, x + bw, y + bh))
+    return boxes
+
+
+@pytest.mark.parametrize("count", range(1, 51))
+def test_layout_has_no_overlaps_and_stays_inside(count):
+    for seed in range(5):
+        boxes = layout_boxes(count, seed)
+        assert len(boxes) == count
+        for i, (left, top, right, bottom) in enumerate(boxes):
+            assert COLLAGE_MARGIN <= left < right <= CANVAS[0] - COLLAGE_MARGIN
+            assert COLLAGE_MARGIN <= top < bottom <= CANVAS[1] - COLLAGE_MARGIN
+            for other in boxes[i + 1:]:
+                assert min(right, other[2]) <= max(left, other[0]) or min(bottom, other[3]) <= max(top, other[1])
+
+
+def test_layout_is_reproducible_from_seed():
+    assert layout_boxes(7, 42) == layout_boxes(7, 42)
@@ -0,0 +1,114 @@
+import io
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+CALL_DELAY = 0.3
+PHOTOS = 5
+
+
+class StubOllama(BaseHTTPRequestHandler):
+    """Ollama /api/generate: фіксована затримка, відповідь — підпис."""
+    calls = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        started = time.monotonic()
+        time.sleep(CALL_DELAY)
+        StubOllama.calls.append((started, time.monotonic()))
+        body = json.dumps({"response": "Теплий спогад з моря"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubGradioClient:
+    """Обидва HF Space: /predict — опис фото, /infer — фон колажу."""
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.lock = threading.Lock()
+        self.describe_calls = []
+        self.background_calls = []
+
+    def predict(self, *args, api_name):
+        started = time.monotonic()
+        time.sleep(CALL_DELAY)
+        with self.lock:
+            if api_name == "/predict":
+                self.describe_calls.append((started, time.monotonic()))
+                return "a dog running on the beach"
+            self.background_calls.append((started, time.monotonic(), args[0]))
+            path = str(self.tmp_path / f"background{len(self.background_calls)}.png")
+        Image.new("RGB", (64, 112), (20, 40, 60)).save(path)
+        return [path]
+
+
+@pytest.fixture
+def stub_ollama(server, monkeypatch):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubOllama)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    StubOllama.calls = []
+    monkeypatch.setattr(server, "OLLAMA_API_URL", f"http://127.0.0.1:{httpd.server_port}/api/generate")
+    yield StubOllama
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def photos(server):
+    names = []
+    for i in range(PHOTOS):
+        name = f"memory_{i}.jpg"
+        buffer = io.BytesIO()
+        Image.new("RGB", (96, 64), (40 * i, 200 - 30 * i, 90)).save(buffer, "JPEG")
+        with open(os.path.join(server.ORIGINALS_PATH, name), "wb") as f:
+            f.write(buffer.getvalue())
+        server.METADATA.put(name, {"type": "image", "palette": [f"#{40 * i:02x}c850"]})
+        names.append(name)
+    yield names
+    for name in names:
+        server.METADATA.delete(name)
+        os.remove(os.path.join(server.ORIGINALS_PATH, name))
+
+
+def test_background_overlaps_captioning(server, stub_ollama, photos, tmp_path, monkeypatch):
+    gradio = StubGradioClient(tmp_path)
+    monkeypatch.setattr(server, "get_gradio_client", lambda space: gradio)
+    monkeypatch.setattr(server.random, "randint", lambda low, high: high)  # брати всі PHOTOS фото
+    palette_sources = []
+    real_background = server.generate_collage_background
+
+    def spy_background(filenames):
+        palette_sources.append(list(filenames))
+        return real_background(filenames)
+
+    monkeypatch.setattr(server, "generate_collage_background", spy_background)
+    task_id = server.JOBS.create("memory_story")
+
+    started = time.monotonic()
+    server.create_memory_story_worker(task_id)
+    elapsed = time.monotonic() - started
+
+    job = server.JOBS.get(task_id)
+    assert job["status"] == "complete", job
+    assert len(job["result"]["items"]) == PHOTOS + 1  # фото + колаж
+    assert len(gradio.background_calls) == 1
+    background_started = gradio.background_calls[0][0]
+    # Фон генерувався, поки ще йшов аналіз/підписування решти кандидатів
+    last_caption_finished = max(finished for _, finished in stub_ollama.calls)
+    assert background_started < last_caption_finished
+    # Палітра фону — не лише з першого вибраного фото, а й з кандидатів, що аналізувались поруч
+    assert len(palette_sources) == 1 and len(palette_sources[0]) > 1
+    # 5 фото x (опис + підпис) + фон послідовно — це 11 викликів; паралельно — значно менше
+    serial = (2 * PHOTOS + 1) * CALL_DELAY
+    assert elapsed < serial * 0.7
@@ -0,0 +1,140 @@
+import asyncio
+import itertools
+import os
+import shutil
+import time
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from telethon.errors import FileReferenceExpiredError, FloodWaitError
+from telethon.tl.types import InputMediaUploadedDocument
+
+
+class FakeTelegram:
+    """Підмножина Telethon, яку використовує доставка: upload_file / send_file / get_messages."""
+    def __init__(self, flood_waits=0, stale_references=False):
+        self.uploads = []
+        self.sends = []
+        self.flood_waits = flood_waits
+        self.flood_times = []
+        self.stale_references = stale_references
+        self.messages = {}
+        self._ids = itertools.count(1)
+
+    async def upload_file(self, file, file_name=None):
+        if self.flood_waits:
+            self.flood_waits -= 1
+            self.flood_times.append(time.monotonic())
+            raise FloodWaitError(request=None, capture=0)
+        self.uploads.append((file, time.monotonic()))
+        return SimpleNamespace(name=file_name or os.path.basename(file))
+
+    def _message(self, media, force_document):
+        kind = "document" if force_document or isinstance(media, InputMediaUploadedDocument) else "photo"
+        uploaded = SimpleNamespace(id=next(self._ids), access_hash=42, file_reference=b"fresh")
+        message = SimpleNamespace(id=next(self._ids), photo=None, document=None)
+        setattr(message, kind, uploaded)
+        self.messages[message.id] = message
+        return message
+
+    async def send_file(self, chat, files, force_document=False):
+        if self.stale_references and any(getattr(f, "file_reference", None) == b"stale" for f in (files if isinstance(files, list) else [files])):
+            raise FileReferenceExpiredError(request=None)
+        self.sends.append((chat, files, force_document))
+        if isinstance(files, list): return [self._message(f, force_document) for f in files]
+        return self._message(files, force_document)
+
+    async def get_messages(self, chat, ids):
+        return self.messages.get(ids)
+
+
+@pytest.fixture
+def library(server):
+    """Тека в originals з унікальним вмістом (кеш TELEGRAM_MEDIA спільний на всю сесію)."""
+    folder = f"tg_{uuid.uuid4().hex[:8]}"
+    os.makedirs(os.path.join(server.ORIGINALS_PATH, folder))
+
+    def make(name, data=None):
+        key = f"{folder}/{name}"
+        with open(os.path.join(server.ORIGINALS_PATH, key), "wb") as f:
+            f.write(data or f"{key}-{uuid.uuid4().hex}".encode())
+        return key
+
+    yield make
+    shutil.rmtree(os.path.join(server.ORIGINALS_PATH, folder))
+
+
+@pytest.fixture(autouse=True)
+def fresh_flood_gate(server, monkeypatch):
+    monkeypatch.setattr(server, "TELEGRAM_FLOOD_GATE", server.TelegramFloodGate())
+
+
+def deliver(server, filenames, tg, chat="me"):
+    job_id = server.JOBS.create("telegram_send")
+    asyncio.run(server.run_telegram_delivery_job(job_id, filenames, chat, tg=tg))
+    return server.JOBS.get(job_id)
+
+
+def test_media_are_grouped_into_albums_and_documents_sent_apart(server, library):
+    photos = [library(f"p{i:02}.jpg") for i in range(12)]
+    video = library("clip.mp4")
+    server.METADATA.put(video, {"type": "video", "duration": 3.5, "width": 640, "height": 360})
+    document = library("anim.gif")
+    tg = FakeTelegram()
+
+    job = deliver(server, photos + [video, document], tg)
+
+    assert job["status"] == "complete"
+    assert job["sent"] == 14 and job["failed"] == 0
+    assert [len(files) if isinstance(files, list) else 1 for _, files, _ in tg.sends] == [10, 3, 1]
+    assert [force_document for _, _, force_document in tg.sends] == [False, False, True]
+    album_video = tg.sends[1][1][-1]
+    assert isinstance(album_video, InputMediaUploadedDocument)
+    assert album_video.attributes[0].duration == 3.5 and album_video.attributes[0].w == 640
+    server.METADATA.delete(video)
+
+
+def test_flood_wait_pauses_and_retries(server, library):
+    photos = [library(f"p{i}.jpg") for i in range(3)]
+    tg = FakeTelegram(flood_waits=1)
+
+    job = deliver(server, photos, tg)
+
+    assert job["status"] == "complete" and job["sent"] == 3
+    assert job["flood_waits"] == 1
+    assert len(tg.uploads) == 3
+    # Після FloodWait (0 с + 1 с запасу) жоден виклик не йде раніше, ніж мине пауза
+    assert min(at for _, at in tg.uploads) >= tg.flood_times[0] + 0.9
+
+
+def test_already_sent_files_are_not_uploaded_again(server, library):
+    photos = [library(f"p{i}.jpg") for i in range(4)]
+    first = FakeTelegram()
+    deliver(server, photos, first, chat="alice")
+    assert len(first.uploads) == 4
+
+    second = FakeTelegram()
+    second.messages = first.messages
+    job = deliver(server, photos, second, chat="bob")
+
+    assert job["sent"] == 4 and job["reused"] == 4
+    assert second.uploads == []
+    assert job["bytes_saved"] == sum(os.path.getsize(os.path.join(server.ORIGINALS_PATH, p)) for p in photos)
+
+
+def test_stale_file_reference_is_refreshed_from_the_source_message(server, library):
+    photo = library("p.jpg")
+    first = FakeTelegram()
+    deliver(server, [photo], first, chat="alice")
+    content_hash = server.get_content_hash(photo, os.path.join(server.ORIGINALS_PATH, photo))
+    cached = server.TELEGRAM_MEDIA.get(content_hash)
+    server.TELEGRAM_MEDIA.put(content_hash, {**cached, "file_reference": b"stale"}, cached["chat"], cached["message_id"], 1)
+
+    second = FakeTelegram(stale_references=True)
+    second.messages = first.messages
+    job = deliver(server, [photo], second, chat="bob")
+
+    assert job["sent"] == 1 and job["reused"] == 1
+    assert second.uploads == []
+    assert second.sends[0][1].file_reference == b"fresh"
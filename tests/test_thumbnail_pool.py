@@ -0,0 +1,59 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+WORKERS = 2
+
+
+def slow_square(value):
+    time.sleep(0.02)
+    return value * value
+
+
+def test_cancel_stops_submitting_new_work(server, monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=WORKERS)
+    monkeypatch.setattr(server, "get_thumbnail_pool", lambda: pool)
+    job_id = server.JOBS.create("test")
+    work = [(f"f{i}.jpg", slow_square, (i,)) for i in range(40)]
+    processed, in_flight, peak = [], [0], [0]
+    real_submit = pool.submit
+
+    def counting_submit(fn, *args):
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        future = real_submit(fn, *args)
+        future.add_done_callback(lambda _: in_flight.__setitem__(0, in_flight[0] - 1))
+        return future
+
+    monkeypatch.setattr(pool, "submit", counting_submit)
+
+    def on_result(filename, result):
+        processed.append(filename)
+        if len(processed) == 5:
+            server.JOBS.cancel(job_id)
+
+    try:
+        asyncio.run(server.run_in_thumbnail_pool(job_id, work, on_result))
+    finally:
+        pool.shutdown(wait=True)
+
+    assert len(processed) < len(work)
+    assert len(processed) <= 5 + WORKERS
+    assert peak[0] <= WORKERS
+    job = server.JOBS.get(job_id)
+    assert job["status"] == "cancelled"
+    assert job["done"] == len(processed)
+
+
+def test_all_work_runs_when_not_cancelled(server, monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=WORKERS)
+    monkeypatch.setattr(server, "get_thumbnail_pool", lambda: pool)
+    job_id = server.JOBS.create("test")
+    results = {}
+    try:
+        asyncio.run(server.run_in_thumbnail_pool(
+            job_id, [(f"f{i}.jpg", slow_square, (i,)) for i in range(10)], results.__setitem__))
+    finally:
+        pool.shutdown(wait=True)
+    assert results == {f"f{i}.jpg": i * i for i in range(10)}
+    assert server.JOBS.get(job_id)["status"] == "complete"